@@ -1,14 +1,30 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import sys
 try:
     from setuptools import setup
+    from setuptools.command.build_py import build_py
 except ImportError:
     from distutils.core import setup
+    from distutils.command.build_py import build_py
+
+
+class BuildPy(build_py):
+    '''Leave out the asyncio client, it can't be byte-compiled before python 3.6.'''
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info < (3, 6):
+            modules = [m for m in modules if m[:2] != ("uiautomator", "aio")]
+        return modules
 
 
 requires = [
     "urllib3>=1.7.1"
 ]
+extras_require = {
+    'array': ['numpy', 'Pillow']  # d.screenshot_array(), PIL for devices without exec-out
+}
 test_requires = [
     'nose>=1.0',
     'mock>=1.0.1',
@@ -30,9 +46,11 @@ setup(
         'testing', 'android', 'uiautomator', 'uiautomatorpy'
     ],
     install_requires=requires,
+    extras_require=extras_require,
     tests_require=test_requires,
     test_suite="nose.collector",
     packages=['uiautomator'],
+    cmdclass={'build_py': BuildPy},
     package_data={
         'uiautomator': [
             'uiautomator/libs/bundle.jar',
@@ -4,14 +4,23 @@
 import unittest
 from mock import MagicMock, patch
 import os
+import socket
+import struct
+import tempfile
+import threading
 import subprocess
-from uiautomator import Adb
+from uiautomator import Adb, AdbClient, AdbDeviceTracker, adb_metadata
+try:
+    from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+except ImportError:
+    from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
 
 
 class TestAdb(unittest.TestCase):
 
     def setUp(self):
         self.os_name = os.name
+        adb_metadata.clear()
 
     def tearDown(self):
         os.name = self.os_name
@@ -25,6 +34,24 @@ class TestAdb(unittest.TestCase):
         adb.devices.return_value = [serial, "123456"]
         self.assertEqual(adb.device_serial(), serial)
 
+    def test_exec_out(self):
+        import io
+        adb = Adb("abcdef1234567890")
+        adb.cmd = MagicMock()
+        adb.cmd.return_value.stdout = io.BytesIO(b"PNG" * 50000)
+        adb.cmd.return_value.stderr = io.BytesIO(b"")
+        adb.cmd.return_value.wait.return_value = 0
+        out = io.BytesIO()
+        self.assertEqual(adb.exec_out(out, "screencap", "-p"), 150000)
+        self.assertEqual(out.getvalue(), b"PNG" * 50000)
+        adb.cmd.assert_called_once_with("exec-out", "screencap", "-p")
+
+        adb.cmd.return_value.stdout = io.BytesIO(b"")
+        adb.cmd.return_value.stderr = io.BytesIO(b"error: closed\n")
+        adb.cmd.return_value.wait.return_value = 1
+        with self.assertRaises(EnvironmentError):
+            adb.exec_out(out, "screencap", "-p")
+
     def test_adb_from_env(self):
         home_dir = '/android/home'
         with patch.dict('os.environ', {'ANDROID_HOME': home_dir}):
@@ -197,3 +224,414 @@ class TestAdb(unittest.TestCase):
         adb.version.return_value = ['1.0.29', '1', '0', '29']
         with self.assertRaises(EnvironmentError):
             adb.forward_list()
+
+
+class TestAdbMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        adb_metadata.clear()
+
+    def tearDown(self):
+        adb_metadata.clear()
+
+    def test_version_shared(self):
+        with patch.object(Adb, "raw_cmd") as raw_cmd:
+            raw_cmd.return_value.communicate.return_value = (b"Android Debug Bridge version 1.0.41\n", b"")
+            self.assertEqual(Adb().version(), ["1.0.41", "1", "0", "41"])
+            self.assertEqual(Adb("abcd").version(), ["1.0.41", "1", "0", "41"])
+            self.assertEqual(raw_cmd.call_count, 1)
+            Adb(adb_server_host="10.0.0.2").version()  # other adb server
+            self.assertEqual(raw_cmd.call_count, 2)
+            Adb().invalidate()
+            Adb().version()
+            self.assertEqual(raw_cmd.call_count, 3)
+
+    def test_ttl(self):
+        with patch.object(Adb, "raw_cmd") as raw_cmd, patch("uiautomator.monotonic") as now:
+            raw_cmd.return_value.communicate.return_value = (b"Android Debug Bridge version 1.0.41\n", b"")
+            now.return_value = 1000
+            Adb().version()
+            now.return_value = 1000 + adb_metadata.ttl["version"] - 1
+            Adb().version()
+            self.assertEqual(raw_cmd.call_count, 1)
+            now.return_value = 1000 + adb_metadata.ttl["version"] + 1
+            Adb().version()
+            self.assertEqual(raw_cmd.call_count, 2)
+
+    def test_forward_list(self):
+        adb = Adb("abcd")
+        adb.version = MagicMock(return_value=['1.0.31', '1', '0', '31'])
+        adb.cmd = MagicMock()
+        adb.raw_cmd = MagicMock()
+        adb.raw_cmd.return_value.communicate.return_value = (b"abcd    tcp:9008    tcp:9008\r\n", b"")
+        self.assertEqual(adb.forward_list(), [["abcd", "tcp:9008", "tcp:9008"]])
+        adb.forward_list()[0].append("changed")
+        self.assertEqual(adb.forward_list(), [["abcd", "tcp:9008", "tcp:9008"]])
+        self.assertEqual(adb.raw_cmd.call_count, 1)
+        adb.forward(9009, 9008)  # forward table changed
+        adb.forward_list()
+        self.assertEqual(adb.raw_cmd.call_count, 2)
+
+    def test_getprop(self):
+        adb = Adb("abcd")
+        adb.cmd = MagicMock()
+        adb.cmd.return_value.communicate.return_value = (
+            b"[ro.build.version.sdk]: [28]\r\n[ro.product.model]: [Pixel 3]\n[sys.boot_completed]: [1]\n", b"")
+        self.assertEqual(adb.getprop("ro.build.version.sdk"), "28")
+        self.assertEqual(Adb("abcd").getprop("ro.product.model"), "Pixel 3")
+        self.assertEqual(Adb("abcd").getprop("ro.not.there"), "")
+        adb.cmd.assert_called_once_with("shell", "getprop")
+        self.assertEqual(adb.getprop()["sys.boot_completed"], "1")
+        adb.cmd.return_value.communicate.return_value = (b"0\n", b"")
+        self.assertEqual(adb.getprop("sys.boot_completed"), "0")
+        self.assertEqual(adb.cmd.call_args[0], ("shell", "getprop", "sys.boot_completed"))
+
+    def test_adb_path(self):
+        with patch.dict('os.environ', {'ANDROID_HOME': '/android/home'}):
+            with patch('os.path.exists') as exists:
+                exists.return_value = True
+                self.assertEqual(Adb().adb(), "/android/home/platform-tools/adb")
+                with patch('os.path.join') as join:
+                    self.assertEqual(Adb().adb(), "/android/home/platform-tools/adb")
+                    self.assertFalse(join.called)
+
+    def test_sdk_version(self):
+        from uiautomator import AutomatorServer
+        with patch.object(Adb, "cmd") as cmd:
+            cmd.return_value.communicate.return_value = (b"19\r\n", b"")
+            self.assertEqual(AutomatorServer("abcd", 9008).sdk_version(), 19)
+            self.assertEqual(AutomatorServer("abcd", 9009).sdk_version(), 19)
+            self.assertEqual(cmd.call_count, 1)
+            self.assertEqual(AutomatorServer("efgh", 9010).sdk_version(), 19)
+            self.assertEqual(cmd.call_count, 2)
+
+
+class _FakeAdbHandler(StreamRequestHandler):
+
+    def okay(self, message=None):
+        self.wfile.write(b"OKAY")
+        if message is not None:
+            self.wfile.write(("%04x" % len(message)).encode("ascii") + message.encode("utf-8"))
+
+    def fail(self, message):
+        self.wfile.write(b"FAIL" + ("%04x" % len(message)).encode("ascii") + message.encode("utf-8"))
+
+    def handle(self):
+        serial = None
+        while True:
+            length = self.rfile.read(4)
+            if len(length) < 4:
+                return
+            request = self.rfile.read(int(length, 16)).decode("utf-8")
+            self.server.requests.append(request)
+            if request == "host:track-devices":
+                self.okay()
+                with self.server.lock:
+                    self.server.trackers.append((self.wfile, self.request))
+                    self.wfile.write(self.server.devices_message())
+                self.rfile.read(1)
+                return
+            elif request == "host:devices":
+                return self.okay("".join("%s\tdevice\n" % d for d in self.server.devices))
+            elif request == "host:version":
+                return self.okay("0029")
+            elif request == "host:list-forward":
+                return self.okay("".join("%s %s %s\n" % f for f in self.server.forwards))
+            elif request.startswith("host-serial:") and ":forward:" in request:
+                local, remote = request.split(":forward:")[1].split(";")
+                self.server.forwards.append((request.split(":")[1], local, remote))
+                self.okay()
+                return self.okay()
+            elif request.startswith("host:transport:"):
+                serial = request[len("host:transport:"):]
+                if serial not in self.server.devices:
+                    return self.fail("device '%s' not found" % serial)
+                self.okay()
+            elif request.startswith("shell:") or request.startswith("exec:"):
+                self.okay()
+                command = request.split(":", 1)[1]
+                status = command.endswith("; echo :$?")
+                if status:
+                    command = command[:-len("; echo :$?")]
+                output = self.server.shell.get(command, b"")
+                if output is None:  # long running command, wait for the client to close.
+                    self.rfile.read(1)
+                    return
+                self.wfile.write(output)
+                if status:
+                    self.wfile.write((":%d\r\n" % self.server.status.get(command, 0)).encode("ascii"))
+                return
+            elif request == "sync:":
+                self.okay()
+                return self.sync()
+            else:
+                return self.fail("unknown request %s" % request)
+
+    def sync(self):
+        while True:
+            cmd, length = struct.unpack("<4sI", self.rfile.read(8))
+            if cmd == b"SEND":
+                path, mode = self.rfile.read(length).decode("utf-8").rsplit(",", 1)
+                data = []
+                while True:
+                    cmd, length = struct.unpack("<4sI", self.rfile.read(8))
+                    if cmd == b"DONE":
+                        break
+                    data.append(self.rfile.read(length))
+                self.server.files[path] = b"".join(data)
+                self.wfile.write(struct.pack("<4sI", b"OKAY", 0))
+            elif cmd == b"RECV":
+                path = self.rfile.read(length).decode("utf-8")
+                if path in self.server.files:
+                    data = self.server.files[path]
+                    self.wfile.write(struct.pack("<4sI", b"DATA", len(data)) + data)
+                    self.wfile.write(struct.pack("<4sI", b"DONE", 0))
+                else:
+                    message = b"No such file or directory"
+                    self.wfile.write(struct.pack("<4sI", b"FAIL", len(message)) + message)
+            else:
+                return
+
+
+class _FakeAdbServer(ThreadingMixIn, TCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        TCPServer.__init__(self, ("127.0.0.1", 0), _FakeAdbHandler)
+        self.requests, self.forwards, self.files = [], [], {}
+        self.devices = ["014E05DE0F02000E"]
+        self.shell, self.status = {}, {}
+        self.trackers, self.lock = [], threading.Lock()
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def devices_message(self):
+        message = "".join("%s\tdevice\n" % d for d in self.devices)
+        return ("%04x" % len(message)).encode("ascii") + message.encode("utf-8")
+
+    def set_devices(self, devices):
+        with self.lock:
+            self.devices = devices
+            for wfile, _ in self.trackers:
+                wfile.write(self.devices_message())
+
+    def drop_trackers(self, devices):
+        '''close the track-devices connections, devices is the table after they reconnect.'''
+        with self.lock:
+            self.devices = devices
+            for _, sock in self.trackers:
+                sock.shutdown(socket.SHUT_RDWR)
+            self.trackers = []
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TestAdbSocketBackend(unittest.TestCase):
+
+    def setUp(self):
+        adb_metadata.clear()
+        self.server = _FakeAdbServer()
+        self.port = self.server.server_address[1]
+        self.adb = Adb("014E05DE0F02000E", adb_server_host="127.0.0.1", adb_server_port=self.port, backend="socket")
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_devices(self):
+        self.server.devices.append("emulator-5554")
+        self.assertEqual(Adb(adb_server_port=self.port, backend="socket").devices(),
+                         {"014E05DE0F02000E": "device", "emulator-5554": "device"})
+        self.assertEqual(self.server.requests, ["host:devices"])
+
+    def test_version_and_forward(self):
+        self.assertEqual(self.adb.version(), ["1.0.41", "1", "0", "41"])
+        self.assertEqual(self.adb.forward(9010, 9008), 0)
+        self.assertEqual(self.adb.forward_list(), [["014E05DE0F02000E", "tcp:9010", "tcp:9008"]])
+        self.assertIn("host-serial:014E05DE0F02000E:forward:tcp:9010;tcp:9008", self.server.requests)
+
+    def test_shell(self):
+        self.server.shell["getprop ro.build.version.sdk"] = b"19\r\n"
+        out, err = self.adb.cmd("shell", "getprop", "ro.build.version.sdk").communicate()
+        self.assertEqual(out, b"19\r\n")
+        self.assertEqual(self.server.requests[-2:],
+                         ["host:transport:014E05DE0F02000E", "shell:getprop ro.build.version.sdk; echo :$?"])
+
+    def test_shell_status(self):
+        self.server.shell["ls /none"] = b"ls: /none: No such file or directory"
+        self.server.status["ls /none"] = 1
+        process = self.adb.cmd("shell", "ls", "/none")
+        self.assertEqual(process.wait(), 1)
+        self.assertEqual(process.communicate()[0], b"ls: /none: No such file or directory")
+        self.server.shell["echo"] = b"\r\n"
+        process = self.adb.cmd("shell", "echo")
+        self.assertEqual(process.communicate()[0], b"\r\n")
+        self.assertEqual(process.wait(), 0)
+
+    def test_exec_out(self):
+        import io
+        self.server.shell["screencap -p"] = b"\x89PNG\r\n" * 30000
+        out = io.BytesIO()
+        self.assertEqual(self.adb.exec_out(out, "screencap", "-p"), 6 * 30000)
+        self.assertEqual(out.getvalue(), b"\x89PNG\r\n" * 30000)
+        self.assertEqual(self.server.requests[-2:], ["host:transport:014E05DE0F02000E", "exec:screencap -p"])
+        self.assertRaises(EnvironmentError, Adb("unknown", adb_server_port=self.port, backend="socket").exec_out,
+                          out, "screencap", "-p")
+
+    def test_shell_kill(self):
+        self.server.shell["am instrument -w runner"] = None
+        process = self.adb.cmd("shell", "am", "instrument", "-w", "runner")
+        self.assertIsNone(process.poll())
+        process.kill()
+        self.assertEqual(process.wait(), -9)
+
+    def test_unknown_device(self):
+        process = Adb("unknown", adb_server_port=self.port, backend="socket").cmd("shell", "ls")
+        self.assertEqual(process.wait(), 1)
+        self.assertIn(b"not found", process.communicate()[1])
+
+    def test_push_pull_install(self):
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, b"apk content" * 10000)
+        os.close(fd)
+        try:
+            self.assertEqual(self.adb.cmd("push", filename, "/data/local/tmp/").wait(), 0)
+            remote = "/data/local/tmp/%s" % os.path.basename(filename)
+            self.assertEqual(self.server.files[remote], b"apk content" * 10000)
+            self.server.files[remote] = b"pulled"
+            self.assertEqual(self.adb.cmd("pull", remote, filename).wait(), 0)
+            with open(filename, "rb") as f:
+                self.assertEqual(f.read(), b"pulled")
+            self.assertEqual(self.adb.cmd("pull", "/sdcard/none.png", filename).wait(), 1)
+
+            self.server.shell["pm install -r -t %s" % remote] = b"Success\n"
+            self.assertEqual(self.adb.cmd("install", "-r -t", filename).communicate()[0], b"Success\n")
+            self.assertIn("shell:rm %s" % remote, self.server.requests)
+
+            self.server.shell["pm install -r -t %s" % remote] = b"Failure [INSTALL_FAILED_OLDER_SDK]\n"
+            process = self.adb.cmd("install", "-r -t", filename)
+            self.assertEqual(process.wait(), 1)
+            self.assertEqual(process.communicate(), (b"Failure [INSTALL_FAILED_OLDER_SDK]\n",
+                                                     b"Failure [INSTALL_FAILED_OLDER_SDK]"))
+        finally:
+            os.remove(filename)
+
+    def test_fallback(self):
+        with patch("subprocess.Popen") as Popen:
+            self.adb.adb = MagicMock(return_value="adb")
+            self.adb.raw_cmd("logcat", "-d")
+            self.assertTrue(Popen.called)  # not supported by the socket backend
+        self.server.close()
+        with patch("subprocess.Popen") as Popen:
+            self.adb.raw_cmd("devices")
+            self.assertTrue(Popen.called)  # adb server not running
+        self.server = _FakeAdbServer()
+
+    def test_no_probe_connection(self):
+        with patch("socket.create_connection", wraps=socket.create_connection) as create_connection:
+            out, err = self.adb.raw_cmd("devices").communicate()
+        self.assertIn(b"014E05DE0F02000E\tdevice", out)
+        self.assertEqual(create_connection.call_count, 1)  # the request itself, no probe before it
+        with patch("socket.create_connection") as create_connection:
+            with patch("subprocess.Popen"):
+                self.adb.adb = MagicMock(return_value="adb")
+                self.adb.raw_cmd("logcat", "-d")
+        self.assertFalse(create_connection.called)  # unsupported, straight to the adb binary
+
+    def test_backend_from_env(self):
+        with patch.dict('os.environ', {'UIAUTOMATOR_ADB_BACKEND': "socket"}):
+            self.assertEqual(Adb().backend, "socket")
+        self.assertEqual(Adb(backend="subprocess").backend, "subprocess")
+        self.assertTrue(isinstance(Adb().client, AdbClient))
+
+
+class TestAdbDeviceTracker(unittest.TestCase):
+
+    def setUp(self):
+        adb_metadata.clear()
+        self.server = _FakeAdbServer()
+        self.port = self.server.server_address[1]
+        self.events = []
+        self.changed = threading.Event()
+
+    def tearDown(self):
+        tracker = AdbDeviceTracker.running("localhost", self.port)
+        if tracker is not None:
+            tracker.stop()
+        self.server.close()
+
+    def event(self, kind):
+        def callback(serial, state):
+            self.events.append((kind, serial, state))
+            self.changed.set()
+        return callback
+
+    def wait_events(self, count):
+        while len(self.events) < count:
+            self.assertTrue(self.changed.wait(5))
+            self.changed.clear()
+
+    def test_track(self):
+        adb = Adb(adb_server_port=self.port)
+        adb.raw_cmd = MagicMock()
+        tracker = adb.track_devices()
+        self.assertIs(tracker, AdbDeviceTracker.get("localhost", self.port))
+        self.assertIs(tracker, AdbDeviceTracker.running("localhost", self.port))
+        self.assertEqual(adb.devices(), {"014E05DE0F02000E": "device"})
+        self.assertEqual(adb.device_serial(), "014E05DE0F02000E")
+        self.assertFalse(adb.raw_cmd.called)
+
+        tracker.on_attach(self.event("attach"))
+        tracker.on_detach(self.event("detach"))
+        self.server.set_devices(["emulator-5554"])
+        self.wait_events(2)
+        self.assertEqual(sorted(self.events), [("attach", "emulator-5554", "device"), ("detach", "014E05DE0F02000E", "device")])
+        self.assertEqual(Adb(adb_server_port=self.port).devices(), {"emulator-5554": "device"})
+
+        tracker.stop()
+        self.assertIsNone(AdbDeviceTracker.running("localhost", self.port))
+        self.assertEqual(len(self.events), 2)  # stopping detaches nothing
+
+    def test_reconnect(self):
+        tracker = AdbDeviceTracker("localhost", self.port, reconnect_interval=0.01).start()
+        try:
+            self.assertEqual(tracker.devices(), {"014E05DE0F02000E": "device"})
+            tracker.on_attach(self.event("attach"))
+            tracker.on_detach(self.event("detach"))
+            self.server.drop_trackers(["014E05DE0F02000E", "emulator-5554"])
+            self.wait_events(1)
+            self.assertEqual(tracker.devices(), {"014E05DE0F02000E": "device", "emulator-5554": "device"})
+            self.assertEqual(self.events, [("attach", "emulator-5554", "device")])
+        finally:
+            tracker.stop()
+        self.assertEqual(len(self.events), 1)
+
+    def test_callback_error(self):
+        tracker = AdbDeviceTracker("localhost", self.port, reconnect_interval=0.01).start()
+        try:
+            self.assertEqual(tracker.devices(), {"014E05DE0F02000E": "device"})
+            tracker.on_attach(MagicMock(side_effect=KeyError("serial")))
+            tracker.on_attach(self.event("attach"))
+            tracker.on_detach(self.event("detach"))
+            with patch("uiautomator.logger") as logger:
+                self.server.set_devices(["014E05DE0F02000E", "emulator-5554"])
+                self.wait_events(1)
+                self.assertTrue(logger.exception.called)
+            self.server.set_devices(["emulator-5554"])  # the tracker thread survived the error
+            self.wait_events(2)
+            self.assertEqual(self.events, [("attach", "emulator-5554", "device"),
+                                           ("detach", "014E05DE0F02000E", "device")])
+            self.assertEqual(tracker.devices(), {"emulator-5554": "device"})
+        finally:
+            tracker.stop()
+
+    def test_not_ready(self):
+        tracker = AdbDeviceTracker("localhost", 1, reconnect_interval=0.01).start()
+        try:
+            self.assertIsNone(tracker.devices(timeout=0.1))
+        finally:
+            tracker.stop()
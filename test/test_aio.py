@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import socket
+import threading
+import unittest
+from mock import MagicMock, patch
+from uiautomator import JsonRPCError, Selector
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+if sys.version_info >= (3, 6):
+    import asyncio
+    from mock import AsyncMock
+    from uiautomator.aio import (AsyncAdb, AsyncHTTPConnectionPool, AsyncJsonRPCClient, AsyncAutomatorDevice,
+                                 AsyncAutomatorServer)
+
+
+class _LoopTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_until_complete(self, coro):
+        return self.loop.run_until_complete(coro)
+
+
+class _RPCHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
+        self.server.requests.append((self.client_address, request))
+        if request["method"] == "slow":
+            time.sleep(0.3)
+        if request["method"] == "fail":
+            response = {"id": request["id"], "error": {"code": -32002, "message": "not found",
+                                                       "data": {"exceptionTypeName": "UiObjectNotFoundException"}}}
+        else:
+            response = {"id": request["id"], "result": self.server.results.get(request["method"], True)}
+        data = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        data = b"PNG"
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.wfile.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(data), data))
+
+    def log_message(self, *args):
+        pass
+
+
+class _RPCServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    block_on_close = False
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), _RPCHandler)
+        self.requests, self.connections = [], []
+        self.results = {"ping": "pong", "deviceInfo": {"displayRotation": 1}}
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def process_request(self, request, client_address):
+        self.connections.append(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            conn.close()
+
+
+@unittest.skipIf(sys.version_info < (3, 6), "asyncio client requires python 3.6+")
+class TestAsyncHTTPConnectionPool(_LoopTestCase):
+
+    def setUp(self):
+        _LoopTestCase.setUp(self)
+        self.server = _RPCServer()
+        self.port = self.server.server_address[1]
+        self.url = "http://127.0.0.1:%d/jsonrpc/0" % self.port
+
+    def tearDown(self):
+        self.server.close()
+        _LoopTestCase.tearDown(self)
+
+    def test_keep_alive(self):
+        client = AsyncJsonRPCClient(self.url, pool=AsyncHTTPConnectionPool("127.0.0.1", self.port))
+        self.assertEqual(self.run_until_complete(client.ping()), "pong")
+        self.assertEqual(self.run_until_complete(client.click(1, 2)), True)
+        self.assertEqual(len(set(c for c, r in self.server.requests)), 1)
+        self.assertEqual(self.server.requests[1][1]["params"], [1, 2])
+
+    def test_chunked(self):
+        pool = AsyncHTTPConnectionPool("127.0.0.1", self.port)
+        self.assertEqual(self.run_until_complete(pool.urlopen("GET", "http://127.0.0.1/screenshot/0?scale=1")), (200, b"PNG"))
+
+    def test_error(self):
+        client = AsyncJsonRPCClient(self.url, pool=AsyncHTTPConnectionPool("127.0.0.1", self.port))
+        with self.assertRaises(JsonRPCError) as e:
+            self.run_until_complete(client.fail())
+        self.assertEqual(e.exception.code, -32002)
+
+    def test_reconnect(self):
+        client = AsyncJsonRPCClient(self.url, pool=AsyncHTTPConnectionPool("127.0.0.1", self.port))
+        self.assertEqual(self.run_until_complete(client.ping()), "pong")
+        self.server.close()
+        self.server = _RPCServer(self.port)
+        self.assertEqual(self.run_until_complete(client.ping()), "pong")
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_timeout_not_retried(self):
+        client = AsyncJsonRPCClient(self.url, timeout=0.1, pool=AsyncHTTPConnectionPool("127.0.0.1", self.port))
+        self.assertEqual(self.run_until_complete(client.ping()), "pong")
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_until_complete(client.slow())
+        time.sleep(0.4)
+        self.assertEqual([r["method"] for _, r in self.server.requests], ["ping", "slow"])
+
+    def test_restart(self):
+        restart = AsyncMock()
+        client = AsyncJsonRPCClient("http://127.0.0.1:1/jsonrpc/0", timeout=1,
+                                    pool=AsyncHTTPConnectionPool("127.0.0.1", 1), restart=restart)
+        with self.assertRaises(OSError):
+            self.run_until_complete(client.ping())
+        restart.assert_called_once_with()
+
+
+@unittest.skipIf(sys.version_info < (3, 6), "asyncio client requires python 3.6+")
+class TestAsyncAutomatorDevice(_LoopTestCase):
+
+    def setUp(self):
+        _LoopTestCase.setUp(self)
+        self.server = _RPCServer()
+        self.device = AsyncAutomatorDevice("abcd", local_port=self.server.server_address[1],
+                                           adb_server_host="127.0.0.1")
+        self.device.server.start = AsyncMock()
+
+    def tearDown(self):
+        self.server.close()
+        _LoopTestCase.tearDown(self)
+
+    def request(self, index=-1):
+        return self.server.requests[index][1]
+
+    def test_device(self):
+        self.assertEqual(self.run_until_complete(self.device.info), {"displayRotation": 1})
+        self.assertEqual(self.run_until_complete(self.device.orientation), "left")
+        self.assertTrue(self.run_until_complete(self.device.click(10, 20)))
+        self.assertEqual(self.request()["params"], [10, 20])
+        self.run_until_complete(self.device.press.back())
+        self.assertEqual((self.request()["method"], self.request()["params"]), ("pressKey", ["back"]))
+        self.run_until_complete(self.device.wait.idle(timeout=100))
+        self.assertEqual((self.request()["method"], self.request()["params"]), ("waitForIdle", [100]))
+
+    def test_object(self):
+        obj = self.device(text="OK").child(className="android.widget.Button")
+        self.run_until_complete(obj.click())
+        self.assertEqual(self.request()["method"], "click")
+        self.assertEqual(self.request()["params"], [obj.selector])
+        self.run_until_complete(obj.click.topleft())
+        self.assertEqual(self.request()["params"], [obj.selector, "topleft"])
+        self.run_until_complete(self.device(text="Name").set_text("John"))
+        self.assertEqual(self.request()["params"], [Selector(text="Name"), "John"])
+        self.run_until_complete(self.device(text="OK").wait.gone(timeout=500))
+        self.assertEqual((self.request()["method"], self.request()["params"]),
+                         ("waitUntilGone", [Selector(text="OK"), 500]))
+        self.assertEqual(self.run_until_complete(self.device(text="OK").instance(2).exists), True)
+        self.assertEqual(self.request()["params"][0]["instance"], 2)
+
+    def test_snapshot(self):
+        import os
+        with open(os.path.join(os.path.dirname(__file__), "res", "layout.xml"), "rb") as f:
+            self.server.results["dumpWindowHierarchy"] = f.read().decode("utf-8")
+        snapshot = self.run_until_complete(self.device.snapshot())
+        self.assertEqual(self.request()["params"], [False, None])
+        self.assertEqual(snapshot(className="android.widget.TextView").count, 5)
+        self.assertEqual(snapshot(text="Browser").info["bounds"]["left"], 384)
+        infos = self.run_until_complete(self.device(className="android.widget.TextView").infos())
+        self.assertEqual([info["text"] for info in infos], ["Phone", "People", "", "Messaging", "Browser"])
+
+    def test_wait_any(self):
+        import os
+        with open(os.path.join(os.path.dirname(__file__), "res", "layout.xml"), "rb") as f:
+            self.server.results["dumpWindowHierarchy"] = f.read().decode("utf-8")
+        browser = self.device(text="Browser")
+        self.assertIs(self.run_until_complete(self.device.wait.any({"text": "OK"}, browser, timeout=100)), browser)
+        self.assertTrue(self.run_until_complete(self.device.wait.gone_all(self.device(text="OK"), timeout=100)))
+        self.assertFalse(self.run_until_complete(self.device.wait.all(browser, {"text": "OK"}, timeout=100)))
+
+    def test_screenshot(self):
+        self.device.server.sdk_version = AsyncMock(return_value=21)
+        self.assertEqual(self.run_until_complete(self.device.server.screenshot()), b"PNG")
+
+
+@unittest.skipIf(sys.version_info < (3, 6), "asyncio client requires python 3.6+")
+class TestAsyncAdb(_LoopTestCase):
+
+    def process(self, out=b"", returncode=0):
+        process = MagicMock()
+        process.communicate = AsyncMock(return_value=(out, b""))
+        process.wait = AsyncMock(return_value=returncode)
+        return process
+
+    def test_cmd(self):
+        adb = AsyncAdb("abcd")
+        adb.adb = MagicMock(return_value="adb")
+        with patch("asyncio.create_subprocess_exec", new=AsyncMock()) as exec_:
+            exec_.return_value = self.process(b"[19]\n")
+            self.assertEqual(self.run_until_complete(adb.run("shell", "getprop", "ro.build.version.sdk")), "[19]\n")
+            self.assertEqual(exec_.call_args[0], ("adb", "-s", "abcd", "shell", "getprop", "ro.build.version.sdk"))
+
+    def test_devices(self):
+        adb = AsyncAdb(adb_server_host="10.0.0.2")
+        adb.adb = MagicMock(return_value="adb")
+        with patch("asyncio.create_subprocess_exec", new=AsyncMock()) as exec_:
+            exec_.return_value = self.process(b"List of devices attached \r\n abcd\tdevice\n")
+            self.assertEqual(self.run_until_complete(adb.device_serial()), "abcd")
+            self.assertEqual(exec_.call_args[0], ("adb", "-H", "10.0.0.2", "devices"))
+            exec_.return_value = self.process(b"adb server version (31) doesn't match")
+            with self.assertRaises(EnvironmentError):
+                self.run_until_complete(adb.devices())
+
+    def test_exec_out(self):
+        import io
+        adb = AsyncAdb("abcd")
+        adb.adb = MagicMock(return_value="adb")
+        process = self.process()
+        process.stdout.read = AsyncMock(side_effect=[b"PNG", b"DATA", b""])
+        process.stderr.read = AsyncMock(return_value=b"")
+        with patch("asyncio.create_subprocess_exec", new=AsyncMock(return_value=process)) as exec_:
+            out = io.BytesIO()
+            self.assertEqual(self.run_until_complete(adb.exec_out(out, "screencap", "-p")), 7)
+            self.assertEqual(out.getvalue(), b"PNGDATA")
+            self.assertEqual(exec_.call_args[0], ("adb", "-s", "abcd", "exec-out", "screencap", "-p"))
+            process.stdout.read = AsyncMock(return_value=b"")
+            process.stderr.read = AsyncMock(return_value=b"error: closed")
+            process.wait = AsyncMock(return_value=1)
+            with self.assertRaises(EnvironmentError):
+                self.run_until_complete(adb.exec_out(out, "screencap", "-p"))
+
+    def test_getprop(self):
+        adb = AsyncAdb("abcd")
+        adb.adb = MagicMock(return_value="adb")
+        with patch("asyncio.create_subprocess_exec", new=AsyncMock()) as exec_:
+            exec_.return_value = self.process(b"[ro.build.version.sdk]: [19]\n[sys.boot_completed]: [1]\n")
+            self.assertEqual(self.run_until_complete(adb.getprop("ro.build.version.sdk")), "19")
+            self.assertEqual(self.run_until_complete(adb.getprop("ro.build.version.sdk")), "19")
+            self.assertEqual(exec_.call_count, 1)  # ro.* properties are cached
+            self.assertEqual(self.run_until_complete(adb.getprop())["sys.boot_completed"], "1")
+            exec_.return_value = self.process(b"1\n")
+            self.assertEqual(self.run_until_complete(adb.getprop("sys.boot_completed")), "1")
+            self.assertEqual(exec_.call_args[0][-3:], ("shell", "getprop", "sys.boot_completed"))
+
+
+@unittest.skipIf(sys.version_info < (3, 6), "asyncio client requires python 3.6+")
+class TestAsyncAutomatorServer(_LoopTestCase):
+
+    def test_start_redeploy(self):
+        from uiautomator import AutomatorServer
+        server = AsyncAutomatorServer("abcd", local_port=9008)
+        server.adb = MagicMock()
+        deploy, cmd = AutomatorServer.deployment(21)
+        checksums = AutomatorServer.format_checksums(AutomatorServer.file_checksums(deploy)).decode("utf-8")
+        server.adb.run = AsyncMock(side_effect=[checksums, "", ""])
+        processes = []
+
+        def adb_cmd(*args):
+            process = MagicMock(returncode=None)
+            process.wait = AsyncMock(return_value=0)
+            process.communicate = AsyncMock(side_effect=lambda: setattr(process, "returncode", 0) or (b"", b""))
+            processes.append((args, process))
+            return process
+        server.adb.cmd = AsyncMock(side_effect=adb_cmd)
+        server.adb.forward = AsyncMock(return_value=0)
+        server.sdk_version = AsyncMock(return_value=21)
+        server.wait_ready = AsyncMock(side_effect=[False, True])
+        self.run_until_complete(server.start())
+        commands = [args for args, _ in processes]
+        self.assertEqual(commands[0], tuple(cmd))  # checksums match, nothing deployed
+        processes[0][1].kill.assert_called_once_with()
+        self.assertEqual(commands[1][:3], ("shell", "rm", "-f"))
+        self.assertEqual([args[0] for args in commands[2:]], ["install", "install", "push", "shell"])
+        self.assertEqual(server.uiautomator_process, processes[-1][1])
+
+    def test_start_failed(self):
+        server = AsyncAutomatorServer("abcd", local_port=9008)
+        server.adb = MagicMock()
+        server.adb.run = AsyncMock(return_value="")
+        process = MagicMock(returncode=None)
+        process.wait = AsyncMock(return_value=1)
+        process.communicate = AsyncMock(return_value=(b"", b""))
+        server.adb.cmd = AsyncMock(return_value=process)
+        server.adb.forward = AsyncMock(return_value=0)
+        server.sdk_version = AsyncMock(return_value=21)
+        server.wait_ready = AsyncMock(return_value=False)
+        with self.assertRaises(IOError):
+            self.run_until_complete(server.start())
+        process.kill.assert_called_once_with()
+        self.assertIsNone(server.uiautomator_process)
@@ -3,26 +3,41 @@
 
 import unittest
 import re
+import os
 import os.path
 import codecs
-from mock import MagicMock, call, patch
+import io
+import shutil
+import tempfile
+from mock import MagicMock, call, patch, ANY
+import uiautomator
 from uiautomator import AutomatorDevice, Selector
 
 
 class TestDevice(unittest.TestCase):
 
     def setUp(self):
+        self.runtime_dir = tempfile.mkdtemp()  # keep the port registry of live sessions out of the tests
+        self.runtime_patch = patch.dict(os.environ, {"UIAUTOMATOR_RUNTIME_DIR": self.runtime_dir})
+        self.runtime_patch.start()
         self.device = AutomatorDevice()
         self.device.server = MagicMock()
         self.device.server.jsonrpc = MagicMock()
         self.device.server.jsonrpc_wrap = MagicMock()
 
+    def tearDown(self):
+        self.runtime_patch.stop()
+        shutil.rmtree(self.runtime_dir)
+
     def test_info(self):
         self.device.server.jsonrpc.deviceInfo = MagicMock()
         self.device.server.jsonrpc.deviceInfo.return_value = {}
         self.assertEqual(self.device.info, {})
         self.device.server.jsonrpc.deviceInfo.assert_called_once_with()
 
+    def test_batch(self):
+        self.assertEqual(self.device.batch(), self.device.server.jsonrpc.batch.return_value)
+
     def test_click(self):
         self.device.server.jsonrpc.click = MagicMock()
         self.device.server.jsonrpc.click.return_value = True
@@ -67,13 +82,135 @@ class TestDevice(unittest.TestCase):
         self.device.server.adb.cmd = cmd = MagicMock()
         self.device.server.screenshot = MagicMock()
         self.device.server.screenshot.return_value = None
+        self.device.server.adb.exec_out.side_effect = EnvironmentError("error: closed")
         cmd.return_value.returncode = 0
-        self.assertEqual(self.device.screenshot("a.png", 1.0, 99), "a.png")
+        filename = os.path.join(tempfile.mkdtemp(), "a.png")
+        self.assertEqual(self.device.screenshot(filename, 1.0, 99), filename)
         self.device.server.jsonrpc.takeScreenshot.assert_called_once_with("screenshot.png", 1.0, 99)
-        self.assertEqual(cmd.call_args_list, [call("pull", "1.png", "a.png"), call("shell", "rm", "1.png")])
+        self.assertEqual(cmd.call_args_list, [call("pull", "1.png", filename), call("shell", "rm", "1.png")])
 
         self.device.server.jsonrpc.takeScreenshot.return_value = None
-        self.assertEqual(self.device.screenshot("a.png", 1.0, 100), None)
+        self.assertEqual(self.device.screenshot(filename, 1.0, 100), None)
+        self.assertFalse(os.path.exists(filename))
+
+    def test_screenshot_no_directory(self):
+        self.device.server.screenshot.return_value = None
+        self.device.server.jsonrpc.takeScreenshot.return_value = "1.png"
+        self.device.server.adb.cmd.return_value.returncode = 1
+        filename = os.path.join(tempfile.mkdtemp(), "none", "a.png")
+        self.assertIsNone(self.device.screenshot(filename))
+        self.device.server.adb.exec_out.assert_not_called()
+        self.assertFalse(os.path.exists(filename))
+
+    def test_screenshot_exec_out(self):
+        self.device.server.screenshot.return_value = None
+        png = uiautomator.PNG_SIGNATURE + b"IHDR"
+        self.device.server.adb.exec_out.side_effect = lambda out, *args: out.write(png) or len(png)
+        filename = os.path.join(tempfile.mkdtemp(), "a.png")
+        self.assertEqual(self.device.screenshot(filename), filename)
+        self.device.server.adb.exec_out.assert_called_once_with(ANY, "screencap", "-p")
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), png)
+        self.device.server.jsonrpc.takeScreenshot.assert_not_called()
+
+        self.device.server.jsonrpc.takeScreenshot.return_value = None
+        self.assertIsNone(self.device.screenshot(filename, 0.5))  # screencap can not scale
+        self.assertEqual(self.device.server.adb.exec_out.call_count, 1)
+
+    def test_screenshot_exec_out_error(self):
+        self.device.server.screenshot.return_value = None
+        error = b"/system/bin/sh: screencap: not found\r\n"
+        self.device.server.adb.exec_out.side_effect = lambda out, *args: out.write(error) or len(error)
+        self.device.server.jsonrpc.takeScreenshot.return_value = "1.png"
+        self.device.server.adb.cmd.return_value.returncode = 1
+        filename = os.path.join(tempfile.mkdtemp(), "a.png")
+        self.assertIsNone(self.device.screenshot(filename))
+        self.device.server.jsonrpc.takeScreenshot.assert_called_once_with("screenshot.png", 1.0, 100)
+        self.assertFalse(os.path.exists(filename))
+
+    def test_screenshot_file_object(self):
+        png = uiautomator.PNG_SIGNATURE + b"IHDR"
+        self.device.server.screenshot.side_effect = lambda out, *args: out.write(b"broken") and None
+        self.device.server.adb.exec_out.side_effect = lambda out, *args: out.write(png) or len(png)
+        out = io.BytesIO(b"head")
+        out.seek(4)
+        self.assertIs(self.device.screenshot(out), out)
+        self.assertEqual(out.getvalue(), b"head" + png)
+
+        self.device.server.adb.exec_out.side_effect = EnvironmentError("error: closed")
+        self.device.server.jsonrpc.takeScreenshot.return_value = "1.png"
+
+        def pull(*args):
+            if args[0] == "pull":
+                with open(args[2], "wb") as f:
+                    f.write(png)
+            return MagicMock(returncode=0)
+        self.device.server.adb.cmd.side_effect = pull
+        out = io.BytesIO()
+        self.assertIs(self.device.screenshot(out, 0.5), out)
+        self.assertEqual(out.getvalue(), png)
+        local = self.device.server.adb.cmd.call_args_list[0][0][2]
+        self.assertFalse(os.path.exists(local))
+
+        self.device.server.adb.cmd.side_effect = None
+        self.device.server.adb.cmd.return_value.returncode = 1
+        self.assertIsNone(self.device.screenshot(io.BytesIO()))
+
+    def screencap(self, width, height, header=16):
+        import struct
+        pixels = bytearray(range(256)) * (width * height * 4 // 256 + 1)
+        raw = struct.pack("<4I", width, height, 1, 1)[:header] + bytes(pixels[:width * height * 4])
+        self.device.server.adb.exec_out.side_effect = lambda out, *args: out.write(raw) or len(raw)
+        return pixels[:width * height * 4]
+
+    def test_screenshot_array_requires_numpy(self):
+        with patch("uiautomator.numpy", None):
+            self.assertRaises(ImportError, self.device.screenshot_array)
+
+    def test_screenshot_array_scale(self):
+        for scale in (0.75, 0.3, 0, 2, -0.5):
+            self.assertRaises(ValueError, self.device.screenshot_array, scale)
+        self.device.server.adb.exec_out.assert_not_called()
+
+    @unittest.skipIf(uiautomator.numpy is None, "numpy is not installed")
+    def test_screenshot_array(self):
+        for header in (12, 16):
+            pixels = self.screencap(8, 6, header)
+            frame = self.device.screenshot_array()
+            self.device.server.adb.exec_out.assert_called_with(ANY, "screencap")
+            self.assertEqual(frame.shape, (6, 8, 4))
+            self.assertEqual(frame.tobytes(), bytes(pixels))
+        half = self.device.screenshot_array(scale=0.5)
+        self.assertEqual(half.shape, (3, 4, 4))
+        self.assertIsNotNone(half.base)  # a view of the frame, not a copy
+        self.assertEqual(list(half[1, 2]), list(frame[2, 4]))
+        self.device.server.screenshot.assert_not_called()
+
+    @unittest.skipIf(uiautomator.numpy is None, "numpy is not installed")
+    def test_object_screenshot_array(self):
+        self.screencap(8, 6)
+        self.device.server.jsonrpc.deviceInfo.return_value = {"displayWidth": 8, "displayHeight": 6}
+        self.device.server.jsonrpc.objInfo.return_value = {
+            "visibleBounds": {"top": 2, "left": 4, "bottom": 6, "right": 7}}
+        frame = self.device.screenshot_array()
+        crop = self.device(text="OK").screenshot_array()
+        self.assertEqual(crop.shape, (4, 3, 4))
+        self.assertEqual(crop.tobytes(), frame[2:6, 4:7].tobytes())
+        self.assertEqual(self.device(text="OK").screenshot_array(scale=0.5).shape, (2, 2, 4))
+        self.assertEqual(self.device.screenshot_array(scale=1.0 / 3).shape, (2, 2, 4))  # rounded down
+
+    @unittest.skipIf(uiautomator.numpy is None, "numpy is not installed")
+    def test_object_screenshot_array_rotated(self):
+        import numpy
+        self.screencap(8, 6)  # frame in the natural orientation of the display
+        self.device.server.jsonrpc.deviceInfo.return_value = {"displayWidth": 6, "displayHeight": 8,
+                                                              "displayRotation": 1}
+        self.device.server.jsonrpc.objInfo.return_value = {
+            "visibleBounds": {"top": 1, "left": 2, "bottom": 5, "right": 6}}
+        frame = numpy.rot90(self.device.screenshot_array(), 1)
+        crop = self.device(text="OK").screenshot_array()
+        self.assertEqual(crop.shape, (4, 4, 4))
+        self.assertEqual(crop.tobytes(), frame[1:5, 2:6].tobytes())
 
     def test_freeze_rotation(self):
         self.device.server.jsonrpc.freezeRotation = MagicMock()
@@ -82,6 +219,7 @@ class TestDevice(unittest.TestCase):
         self.assertEqual(self.device.server.jsonrpc.freezeRotation.call_args_list, [call(True), call(False)])
 
     def test_orientation(self):
+        self.device.info_ttl = 0  # fetched on every access
         self.device.server.jsonrpc.deviceInfo = MagicMock()
         orientation = {
             0: "natural",
@@ -213,6 +351,7 @@ class TestDevice(unittest.TestCase):
         self.device.server.jsonrpc.wakeUp.assert_called_once_with()
 
     def test_screen_status(self):
+        self.device.info_ttl = 0  # fetched on every access
         self.device.server.jsonrpc.deviceInfo = MagicMock()
         self.device.server.jsonrpc.deviceInfo.return_value = {"screenOn": True}
         self.assertTrue(self.device.screen == "on")
@@ -257,6 +396,57 @@ class TestDevice(unittest.TestCase):
         self.assertFalse(self.device.wait("update", timeout=100, package_name="android"))
         self.device.server.jsonrpc_wrap.return_value.waitForWindowUpdate.assert_called_once_with("android", 100)
 
+    def snapshots(self, *texts):
+        from uiautomator import Hierarchy
+        xml = '<hierarchy rotation="0">%s</hierarchy>'
+        node = '<node index="0" text="%s" class="android.widget.TextView" bounds="[0,0][10,10]" />'
+        self.device.snapshot = MagicMock(side_effect=[Hierarchy(xml % "".join(node % t for t in ts)) for ts in texts])
+
+    def test_wait_any(self):
+        self.snapshots([], ["Cancel"], ["OK", "Cancel"])
+        ok, cancel = self.device(text="OK"), {"text": "Cancel"}
+        with patch("time.sleep") as sleep:
+            self.assertIs(self.device.wait.any(ok, cancel, timeout=10000), cancel)
+            self.assertEqual(sleep.call_args_list, [call(0.05)])
+            self.assertIs(self.device.wait("any", Selector(text="OK"), ok, timeout=10000).__class__, Selector)
+        self.assertRaises(TypeError, self.device.wait.any, "OK")
+
+    def test_wait_all(self):
+        self.snapshots(["OK"], ["Cancel"], ["OK", "Cancel"], ["OK"], ["Loading"], [])
+        with patch("time.sleep") as sleep:
+            self.assertTrue(self.device.wait.all(self.device(text="OK"), self.device(text="Cancel")))
+            self.assertEqual(sleep.call_args_list, [call(0.05), call(0.1)])
+            self.assertTrue(self.device.wait.gone_all(self.device(text="Loading"), self.device(text="Cancel")))
+
+    def test_wait_deadline(self):
+        self.snapshots(*[[]] * 20)
+        with patch("time.sleep") as sleep, patch("uiautomator.monotonic") as now:
+            now.side_effect = [100, 100, 100, 100, 100, 103.75, 104]
+            self.assertIsNone(self.device.wait.any(self.device(text="OK"), timeout=4000))
+            self.assertEqual(sleep.call_args_list, [call(0.05), call(0.1), call(0.2), call(0.4), call(0.25)])
+            self.assertEqual(self.device.snapshot.call_count, 6)
+
+    def test_wait_stable(self):
+        self.snapshots(["A"], ["B"], ["B"], ["B"], ["B"], ["B"])
+        with patch("time.sleep") as sleep, patch("uiautomator.monotonic") as now:
+            now.side_effect = [100, 100, 100.25, 100.5, 100.75, 101, 101.25]
+            self.assertEqual(self.device.wait.stable(window_ms=1000), 250)
+            self.assertEqual(sleep.call_args_list, [call(0.0), call(0.05), call(0.05), call(0.1), call(0.2), call(0.25)])
+        self.device.server.screenshot.assert_not_called()
+
+        self.snapshots(["A"], ["A"], ["A"])
+        self.device.server.screenshot.side_effect = [b"1", b"2", b"2"]
+        with patch("time.sleep"), patch("uiautomator.monotonic") as now:
+            now.side_effect = [100, 100, 100.25, 100.5]
+            self.assertEqual(self.device.wait("stable", 250, screenshot=True), 250)
+        self.device.server.screenshot.assert_called_with(None, 0.1, 10)
+
+    def test_wait_stable_timeout(self):
+        self.snapshots(["A"], ["B"], ["C"])
+        with patch("time.sleep"), patch("uiautomator.monotonic") as now:
+            now.side_effect = [100, 100.25, 100.5]
+            self.assertIsNone(self.device.wait.stable(window_ms=200, timeout=500))
+
     def test_get_info_attr(self):
         info = {"test_a": 1, "test_b": "string", "displayWidth": 720, "displayHeight": 1024}
         self.device.server.jsonrpc.deviceInfo = MagicMock()
@@ -268,6 +458,54 @@ class TestDevice(unittest.TestCase):
         with self.assertRaises(AttributeError):
             self.device.not_exists
 
+    def test_static_info(self):
+        deviceInfo = self.device.server.jsonrpc.deviceInfo = MagicMock()
+        deviceInfo.return_value = {"displayWidth": 720, "displayHeight": 1280, "sdkInt": 28,
+                                   "displayRotation": 0, "screenOn": True}
+        self.device.server.actions = 0
+        clock = [100.0]
+        with patch("uiautomator.monotonic", lambda: clock[0]):
+            self.assertEqual((self.device.width, self.device.height, self.device.displayRotation), (720, 1280, 0))
+            self.assertEqual(deviceInfo.call_count, 1)  # cached for info_ttl, 1 second by default
+            # auto-rotated, the display size follows once the info expires, without any call through d
+            deviceInfo.return_value = {"displayWidth": 1280, "displayHeight": 720, "sdkInt": 28, "displayRotation": 1}
+            clock[0] += 1
+            self.assertEqual((self.device.width, self.device.height), (1280, 720))
+            self.assertEqual(deviceInfo.call_count, 2)
+            self.device.info_ttl = 0
+            self.assertEqual(self.device.sdkInt, 28)
+            self.assertEqual(deviceInfo.call_count, 2)  # static, kept for the session
+            self.device.refresh()
+            self.assertEqual(self.device.sdkInt, 28)
+            self.assertEqual(deviceInfo.call_count, 3)
+
+    def test_info_ttl(self):
+        deviceInfo = self.device.server.jsonrpc.deviceInfo = MagicMock()
+        deviceInfo.return_value = {"displayRotation": 0, "screenOn": True}
+        self.device.server.actions = 0
+        self.device.info_ttl = 60
+        self.assertEqual(self.device.orientation, "natural")
+        self.assertTrue(self.device.screen == "on")
+        self.assertEqual(deviceInfo.call_count, 1)
+        self.device.info["screenOn"] = False  # a copy
+        self.assertTrue(self.device.screenOn)
+        self.device.server.actions += 1  # e.g. press through the device
+        deviceInfo.return_value = {"displayRotation": 0, "screenOn": False}
+        self.assertTrue(self.device.screen == "off")
+        self.assertEqual(deviceInfo.call_count, 2)
+        with patch("uiautomator.monotonic", return_value=1e10):
+            self.device.info
+        self.assertEqual(deviceInfo.call_count, 3)
+
+    def test_device_obj_frozen(self):
+        import uiautomator
+        selector = uiautomator.FrozenSelector(text="OK")
+        self.assertIs(self.device(selector).selector, selector)
+        self.assertEqual(self.device(selector).child(text="a").selector["childOrSiblingSelector"], [{"text": "a", "mask": 1, "childOrSibling": [], "childOrSiblingSelector": []}])
+        self.assertRaises(TypeError, self.device, "OK")  # only a Selector is accepted positionally
+        self.assertRaises(TypeError, self.device, {"text": "OK"})
+        self.assertRaises(TypeError, self.device, selector, text="OK")
+
     def test_device_obj(self):
         with patch("uiautomator.AutomatorDeviceObject") as AutomatorDeviceObject:
             kwargs = {"text": "abc", "description": "description...", "clickable": True}
@@ -287,3 +525,65 @@ class TestDeviceWithSerial(unittest.TestCase):
         with patch('uiautomator.AutomatorServer') as AutomatorServer:
             AutomatorDevice("abcdefhijklmn")
             AutomatorServer.assert_called_once_with(serial="abcdefhijklmn", local_port=None, adb_server_host=None, adb_server_port=None)
+
+
+class _ScreenshotServer(object):
+
+    def __init__(self, delay=0, sizes=()):
+        self.delay, self.sizes, self.count = delay, list(sizes), 0
+
+    def screenshot(self, filename=None, scale=1.0, quality=100, buffer=None):
+        import time
+        time.sleep(self.delay)
+        self.count += 1
+        image = (b"%08d" % self.count) * (self.sizes.pop(0) if self.sizes else 1)
+        if len(image) > len(buffer):
+            raise ValueError("Screenshot is larger than the buffer.")
+        buffer[:len(image)] = image
+        return len(image)
+
+
+class TestScreenCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.runtime_dir = tempfile.mkdtemp()  # keep the port registry of live sessions out of the tests
+        self.runtime_patch = patch.dict(os.environ, {"UIAUTOMATOR_RUNTIME_DIR": self.runtime_dir})
+        self.runtime_patch.start()
+
+    def tearDown(self):
+        self.runtime_patch.stop()
+        shutil.rmtree(self.runtime_dir)
+
+    def wait_captured(self, capture, count):
+        import time
+        deadline = time.time() + 5
+        while capture.captured < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_ring(self):
+        device = AutomatorDevice()
+        device.server = _ScreenshotServer()
+        capture = device.capture(fps=200, size=4)
+        self.wait_captured(capture, 10)
+        frames = capture.stop().frames()
+        self.assertEqual(len(frames), 4)
+        self.assertEqual([image for _, image in frames],
+                         [b"%08d" % i for i in range(capture.captured - 3, capture.captured + 1)])
+        self.assertEqual([t for t, _ in frames], capture.timestamps)
+        self.assertEqual(sorted(capture.timestamps), capture.timestamps)
+        self.assertTrue(0 < capture.rate < 1000)
+
+    def test_drop(self):
+        with uiautomator.ScreenCapture(_ScreenshotServer(delay=0.03), fps=100, size=8).start() as capture:
+            self.wait_captured(capture, 5)
+        self.assertGreaterEqual(capture.dropped, 2 * 4)
+        self.assertTrue(capture.rate < 50)
+
+    def test_grow(self):
+        server = _ScreenshotServer(sizes=[1, 200, 200, 1])
+        with uiautomator.ScreenCapture(server, fps=200, size=16, frame_bytes=1024).start() as capture:
+            self.wait_captured(capture, 3)
+        self.assertEqual(capture.frame_bytes, 2048)
+        images = [image for _, image in capture.frames()]
+        self.assertEqual(images[:3], [b"00000001", b"00000003" * 200, b"00000004"])
+        self.assertGreaterEqual(capture.dropped, 1)
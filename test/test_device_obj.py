@@ -2,8 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import unittest
-from mock import MagicMock, call
-from uiautomator import AutomatorDeviceObject, Selector, AutomatorDeviceNamedUiObject
+from mock import MagicMock, call, patch
+from uiautomator import AutomatorDeviceObject, Selector, AutomatorDeviceNamedUiObject, Hierarchy
 
 
 class TestDeviceObjInit(unittest.TestCase):
@@ -394,57 +394,139 @@ class TestDeviceObj(unittest.TestCase):
         for index, inst in enumerate(self.obj):
             self.assertEqual(inst.selector["instance"], index)
 
+    def snapshot(self, *bounds):
+        '''hierarchy of candidate nodes with bounds[1:], then the node of self.obj with bounds[0].'''
+        node = '<node index="0" text="%s" class="%s" bounds="[%d,%d][%d,%d]" />'
+        nodes = [node % ("", "android.view.View", b["left"], b["top"], b["right"], b["bottom"]) for b in bounds[1:]]
+        nodes.append(node % ("text", "android", bounds[0]["left"], bounds[0]["top"],
+                             bounds[0]["right"], bounds[0]["bottom"]))
+        self.device.snapshot.return_value = Hierarchy(
+            '<?xml version="1.0" ?><hierarchy rotation="0">%s</hierarchy>' % "".join(nodes))
+
     def test_left(self):
-        self.jsonrpc.objInfo.side_effect = [
-            {"bounds": {'top': 200, 'bottom': 250, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 250, 'bottom': 300, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 200, 'bottom': 300, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 200, 'bottom': 300, 'left': 50, 'right': 100}}
-        ]
-        self.jsonrpc.count.return_value = 3
-        self.assertEqual(self.obj.left().selector["instance"], 2)
+        self.snapshot(
+            {'top': 200, 'bottom': 250, 'left': 100, 'right': 150},
+            {'top': 250, 'bottom': 300, 'left': 150, 'right': 200},
+            {'top': 200, 'bottom': 300, 'left': 150, 'right': 200},
+            {'top': 200, 'bottom': 300, 'left': 50, 'right': 100}
+        )
+        self.assertEqual(self.obj.left(className="android.view.View").selector["instance"], 2)
+        self.assertEqual(self.jsonrpc.objInfo.call_count, 0)
 
     def test_right(self):
-        self.jsonrpc.objInfo.side_effect = [
-            {"bounds": {'top': 200, 'bottom': 250, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 250, 'bottom': 300, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 200, 'bottom': 300, 'left': 50, 'right': 100}},
-            {"bounds": {'top': 200, 'bottom': 300, 'left': 150, 'right': 200}}
-        ]
-        self.jsonrpc.count.return_value = 3
-        self.assertEqual(self.obj.right().selector["instance"], 2)
+        self.snapshot(
+            {'top': 200, 'bottom': 250, 'left': 100, 'right': 150},
+            {'top': 250, 'bottom': 300, 'left': 150, 'right': 200},
+            {'top': 200, 'bottom': 300, 'left': 50, 'right': 100},
+            {'top': 200, 'bottom': 300, 'left': 150, 'right': 200}
+        )
+        self.assertEqual(self.obj.right(className="android.view.View").selector["instance"], 2)
 
     def test_up(self):
-        self.jsonrpc.objInfo.side_effect = [
-            {"bounds": {'top': 200, 'bottom': 250, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 250, 'bottom': 300, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 150, 'bottom': 200, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 150, 'bottom': 200, 'left': 100, 'right': 200}}
-        ]
-        self.jsonrpc.count.return_value = 3
-        self.assertEqual(self.obj.up().selector["instance"], 2)
+        self.snapshot(
+            {'top': 200, 'bottom': 250, 'left': 100, 'right': 150},
+            {'top': 250, 'bottom': 300, 'left': 100, 'right': 150},
+            {'top': 150, 'bottom': 200, 'left': 150, 'right': 200},
+            {'top': 150, 'bottom': 200, 'left': 100, 'right': 200}
+        )
+        self.assertEqual(self.obj.up(className="android.view.View").selector["instance"], 2)
 
     def test_down(self):
-        self.jsonrpc.objInfo.side_effect = [
-            {"bounds": {'top': 200, 'bottom': 250, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 250, 'bottom': 300, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 150, 'bottom': 200, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 250, 'bottom': 300, 'left': 100, 'right': 150}}
-        ]
-        self.jsonrpc.count.return_value = 3
-        self.assertEqual(self.obj.down().selector["instance"], 2)
+        self.snapshot(
+            {'top': 200, 'bottom': 250, 'left': 100, 'right': 150},
+            {'top': 250, 'bottom': 300, 'left': 150, 'right': 200},
+            {'top': 150, 'bottom': 200, 'left': 150, 'right': 200},
+            {'top': 250, 'bottom': 300, 'left': 100, 'right': 150}
+        )
+        self.assertEqual(self.obj.down(className="android.view.View").selector["instance"], 2)
 
     def test_multiple_matched_down(self):
-        self.jsonrpc.objInfo.side_effect = [
-            {"bounds": {'top': 200, 'bottom': 250, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 250, 'bottom': 300, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 150, 'bottom': 200, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 275, 'bottom': 300, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 300, 'bottom': 350, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 250, 'bottom': 275, 'left': 100, 'right': 150}}
-        ]
-        self.jsonrpc.count.return_value = 5
-        self.assertEqual(self.obj.down().selector["instance"], 4)
+        self.snapshot(
+            {'top': 200, 'bottom': 250, 'left': 100, 'right': 150},
+            {'top': 250, 'bottom': 300, 'left': 150, 'right': 200},
+            {'top': 150, 'bottom': 200, 'left': 150, 'right': 200},
+            {'top': 275, 'bottom': 300, 'left': 100, 'right': 150},
+            {'top': 300, 'bottom': 350, 'left': 100, 'right': 150},
+            {'top': 250, 'bottom': 275, 'left': 100, 'right': 150}
+        )
+        self.assertEqual(self.obj.down(className="android.view.View").selector["instance"], 4)
+
+    def test_not_beside(self):
+        self.snapshot(
+            {'top': 200, 'bottom': 250, 'left': 100, 'right': 150},
+            {'top': 225, 'bottom': 300, 'left': 150, 'right': 200}
+        )
+        self.assertIsNone(self.obj.left())
+        self.assertEqual(self.obj.right().selector, Selector(instance=0))
+
+    def test_infos(self):
+        self.snapshot(
+            {'top': 200, 'bottom': 250, 'left': 100, 'right': 150},
+            {'top': 250, 'bottom': 300, 'left': 150, 'right': 200},
+            {'top': 150, 'bottom': 200, 'left': 150, 'right': 200}
+        )
+        infos = AutomatorDeviceObject(self.device, Selector(className="android.view.View")).infos()
+        self.assertEqual([info["bounds"]["top"] for info in infos], [250, 150])
+        self.assertEqual(self.obj.infos()[0]["text"], "text")
+        self.assertEqual(self.device.snapshot.call_count, 2)
+        self.assertEqual(self.jsonrpc.objInfo.call_count, 0)
+
+    def test_all(self):
+        self.snapshot(
+            {'top': 200, 'bottom': 250, 'left': 100, 'right': 150},
+            {'top': 250, 'bottom': 300, 'left': 150, 'right': 200},
+            {'top': 150, 'bottom': 200, 'left': 150, 'right': 200}
+        )
+        views = AutomatorDeviceObject(self.device, Selector(className="android.view.View")).all()
+        self.assertEqual([ui.selector["instance"] for ui in views], [0, 1])
+        self.assertEqual([ui.bounds["top"] for ui in views], [250, 150])
+        self.assertEqual([ui.text for ui in views], ["", ""])
+        self.assertEqual(self.jsonrpc.objInfo.call_count, 0)
+        self.assertEqual(self.device.snapshot.call_count, 1)
+        objs = self.obj.all()
+        self.assertEqual([obj.selector for obj in objs], [self.obj.selector])
+        self.assertEqual(objs[0].info["bounds"]["left"], 100)
+        views[0].click()
+        self.jsonrpc.click.assert_called_once_with(views[0].selector)
+
+    def test_cached(self):
+        self.device.server.actions = 0
+        self.jsonrpc.objInfo.return_value = {"text": "a", "enabled": True}
+        self.assertEqual(self.obj.text, "a")
+        self.assertEqual(self.obj.enabled, True)
+        self.assertEqual(self.jsonrpc.objInfo.call_count, 2)  # not cached by default
+        obj = self.obj.cached(ttl=60)
+        self.assertIs(obj, self.obj)
+        self.jsonrpc.objInfo.reset_mock()
+        self.assertEqual((obj.text, obj.enabled), ("a", True))
+        self.assertEqual(self.jsonrpc.objInfo.call_count, 1)
+        self.device.server.actions += 1  # e.g. a click through the device
+        self.assertEqual(obj.text, "a")
+        self.assertEqual(self.jsonrpc.objInfo.call_count, 2)
+        obj.refresh()
+        self.assertEqual(obj.text, "a")
+        self.assertEqual(self.jsonrpc.objInfo.call_count, 3)
+
+    def test_cached_ttl(self):
+        self.device.server.actions = 0
+        self.jsonrpc.objInfo.return_value = {"text": "a"}
+        with patch("uiautomator.monotonic") as time:
+            time.return_value = 100
+            obj = self.obj.cached(ttl=2)
+            obj.text, obj.text
+            self.assertEqual(self.jsonrpc.objInfo.call_count, 1)
+            time.return_value = 102.5
+            obj.text
+            self.assertEqual(self.jsonrpc.objInfo.call_count, 2)
+
+    def test_all_invalidated(self):
+        self.device.server.actions = 0
+        self.snapshot({'top': 200, 'bottom': 250, 'left': 100, 'right': 150})
+        obj = self.obj.all()[0]
+        self.jsonrpc.objInfo.return_value = {"text": "new"}
+        self.assertEqual(obj.text, "text")
+        self.device.server.actions += 1
+        self.assertEqual(obj.text, "new")
 
 class TestAutomatorDeviceNamedUiObject(unittest.TestCase):
 
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import codecs
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock, patch
+from uiautomator import AutomatorDevice, Selector, JsonRPCError, intersect
+from uiautomator.hierarchy import Node, Hierarchy, PrefixTrie, SpatialIndex, iter_events, iter_nodes, write_pretty
+
+
+def layout():
+    with codecs.open(os.path.join(os.path.dirname(__file__), "res", "layout.xml"), "r", encoding="utf8") as f:
+        return f.read()
+
+
+class TestHierarchy(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = Hierarchy(layout())
+
+    def texts(self, **kwargs):
+        return [node.text or node.description for node in self.snapshot(**kwargs).nodes]
+
+    def test_parse(self):
+        self.assertEqual(len(self.snapshot.nodes), 12)
+        self.assertEqual(len(self.snapshot.roots), 1)
+        root = self.snapshot.roots[0]
+        self.assertEqual((root.order, root.end), (0, 12))
+        self.assertEqual([n.index for n in root.children], [0, 3, 4])
+        hotseat = root.children[2]
+        self.assertEqual(hotseat.resource_id, "com.android.launcher:id/hotseat")
+        self.assertEqual((hotseat.order, hotseat.end), (6, 12))
+        self.assertIs(hotseat.children[0].parent, hotseat)
+        self.assertEqual(hotseat.children[0].bounds, (0, 706, 96, 800))
+
+    def test_digest(self):
+        raw = "".join(line.strip() for line in layout().splitlines()[1:])
+        self.assertEqual(Hierarchy(raw).digest, self.snapshot.digest)
+        self.assertNotEqual(Hierarchy(layout().replace('text="Phone"', 'text="Phones"')).digest, self.snapshot.digest)
+        self.assertNotEqual(Hierarchy(layout().replace("[0,706][96,800]", "[0,705][96,800]")).digest, self.snapshot.digest)
+        self.assertNotEqual(Hierarchy(layout().replace('checked="false"', 'checked="true"', 1)).digest, self.snapshot.digest)
+
+    def test_text(self):
+        self.assertEqual(self.texts(text="Phone"), ["Phone"])
+        self.assertEqual(self.texts(textContains="ess"), ["Messaging"])
+        self.assertEqual(self.texts(textContains="PHO"), ["Phone"])
+        self.assertEqual(self.texts(textStartsWith="p"), ["Phone", "People"])
+        self.assertEqual(self.texts(textMatches="P.*e"), ["Phone", "People"])
+        self.assertEqual(self.texts(textMatches="P"), [])
+
+    def test_description(self):
+        self.assertEqual(self.texts(description="Apps"), ["Apps"])
+        self.assertEqual(self.texts(descriptionContains="clock"), ["Analog clock"])
+        self.assertEqual(self.texts(descriptionStartsWith="home"), ["Home screen 3"])
+        self.assertEqual(self.texts(descriptionMatches=r"\d+:\d+"), ["11:33"])
+
+    def test_class_package_resource(self):
+        self.assertEqual(len(self.texts(className="android.widget.TextView")), 5)
+        self.assertEqual(len(self.texts(classNameMatches=r".*\.FrameLayout")), 2)
+        self.assertEqual(self.texts(packageName="com.android.deskclock"), ["11:33"])
+        self.assertEqual(len(self.texts(packageNameMatches="com.android.*")), 12)
+        self.assertEqual(self.texts(resourceId="com.android.launcher:id/search_button_container"), ["Search"])
+        self.assertEqual(self.texts(resourceIdMatches=".*:id/cell[0-9]"), ["Home screen 3"])
+
+    def test_flags_and_index(self):
+        self.assertEqual(self.texts(scrollable=True), [""])
+        self.assertEqual(len(self.texts(clickable=True)), 8)
+        self.assertEqual(len(self.texts(clickable=True, longClickable=True)), 5)
+        self.assertEqual(self.texts(className="android.widget.TextView", index=3), ["Messaging"])
+        self.assertEqual(self.texts(className="android.widget.TextView", instance=1), ["People"])
+
+    def test_child_sibling(self):
+        hotseat = self.snapshot(resourceId="com.android.launcher:id/hotseat")
+        self.assertEqual([n.text for n in hotseat.child(className="android.widget.TextView").nodes],
+                         ["Phone", "People", "", "Messaging", "Browser"])
+        self.assertEqual(hotseat.child(text="Browser").info["bounds"],
+                         {"left": 384, "top": 706, "right": 480, "bottom": 800})
+        # descendants, not only direct children
+        self.assertEqual([n.description for n in self.snapshot(resourceId="com.android.launcher:id/workspace")
+                          .child(packageName="com.android.deskclock").nodes], ["11:33"])
+        self.assertEqual([n.text for n in self.snapshot(text="Phone").sibling(text="Browser").nodes], ["Browser"])
+        self.assertEqual(self.snapshot(text="Phone").sibling(description="Search").exists, False)
+        self.assertEqual(self.snapshot(className="android.widget.FrameLayout")
+                         .child(className="android.widget.TextView", instance=2).description, "Apps")
+        self.assertEqual(self.snapshot(className="android.widget.FrameLayout")
+                         .child(className="android.view.View", instance=1).child(index=0).description, "Analog clock")
+        # outermost instance indexes the final matches
+        self.assertEqual(hotseat.child(className="android.widget.TextView")[3].text, "Messaging")
+
+    def test_object(self):
+        obj = self.snapshot(className="android.widget.TextView")
+        self.assertTrue(obj.exists)
+        self.assertEqual(obj.count, 5)
+        self.assertEqual(len(obj), 5)
+        self.assertEqual([o.info["text"] for o in obj], ["Phone", "People", "", "Messaging", "Browser"])
+        self.assertEqual(obj[1].text, "People")
+        self.assertEqual(obj[1].count, 5)
+        with self.assertRaises(IndexError):
+            obj[5]
+        self.assertEqual(obj.info["className"], "android.widget.TextView")
+        self.assertEqual(obj.info["childCount"], 0)
+        self.assertEqual(self.snapshot(description="Apps").description, "Apps")
+        self.assertFalse(self.snapshot.exists(text="Settings"))
+        with self.assertRaises(JsonRPCError):
+            self.snapshot(text="Settings").info
+        with self.assertRaises(AttributeError):
+            obj.not_a_field
+
+
+def synthetic(items):
+    '''a list of items like a RecyclerView, 3 nodes per item.'''
+    node = ('<node index="%d" text="%s" resource-id="%s" class="%s" package="com.example" content-desc="%s" '
+            'checkable="false" checked="false" clickable="%s" enabled="true" focusable="false" focused="false" '
+            'scrollable="false" long-clickable="false" password="false" selected="false" bounds="[0,%d][480,%d]"')
+    lines = ["<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>", '<hierarchy rotation="0">',
+             node % (0, "", "com.example:id/list", "androidx.recyclerview.widget.RecyclerView", "", "false", 0, 800) + ">"]
+    for i in range(items):
+        lines.append(node % (i, "", "com.example:id/row", "android.widget.LinearLayout", "", "true", i * 10, i * 10 + 10) + ">")
+        lines.append(node % (0, "Item %d" % i, "com.example:id/title", "android.widget.TextView", "", "false", i * 10, i * 10 + 10) + " />")
+        lines.append(node % (1, "", "com.example:id/icon", "android.widget.ImageView", "Icon %d" % i, "false", i * 10, i * 10 + 10) + " />")
+        lines.append("</node>")
+    lines.extend(["</node>", "</hierarchy>"])
+    return "\n".join(lines)
+
+
+class TestHierarchyIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.snapshot = Hierarchy(synthetic(4000))
+
+    def scan(self, selector):
+        '''reference result of a linear scan.'''
+        return [node for node in self.snapshot.nodes if Hierarchy.match(node, selector)]
+
+    def test_trie(self):
+        trie = PrefixTrie()
+        nodes = Hierarchy(layout()).nodes
+        for node in nodes:
+            trie.add(node.text, node)
+        self.assertEqual([n.text for n in trie.find("p")], ["Phone", "People"])
+        self.assertEqual([n.text for n in trie.find("PEO")], ["People"])
+        self.assertEqual(trie.find("x"), [])
+        self.assertEqual(len(trie.find("")), len(nodes))
+
+    def test_candidates(self):
+        self.assertEqual(len(self.snapshot.nodes), 12001)
+        self.assertIsNone(self.snapshot.candidates(Selector(clickable=True)))
+        selector = Selector(text="Item 7", className="android.widget.TextView")
+        self.assertEqual([n.text for n in self.snapshot.candidates(selector)], ["Item 7"])
+        selector = Selector(textStartsWith="item 399")
+        self.assertEqual(len(self.snapshot.candidates(selector)), 11)
+        selector = Selector(textStartsWith="item 1", resourceId="com.example:id/list")
+        self.assertEqual(len(self.snapshot.candidates(selector)), 1)
+
+    def test_same_as_scan(self):
+        for kwargs in [dict(text="Item 42"), dict(resourceId="com.example:id/icon", clickable=False),
+                       dict(textStartsWith="ITEM 12"), dict(descriptionStartsWith="icon 39", index=1),
+                       dict(className="android.widget.LinearLayout", clickable=True),
+                       dict(packageName="com.example", textContains="99"), dict(description="Icon 3999")]:
+            selector = Selector(**kwargs)
+            self.assertEqual(self.snapshot.select(selector), self.scan(selector), kwargs)
+
+    def test_chain(self):
+        rows = self.snapshot(resourceId="com.example:id/row")
+        self.assertEqual(rows.count, 4000)
+        self.assertEqual(rows[10].child(className="android.widget.ImageView").description, "Icon 10")
+        self.assertEqual(self.snapshot(text="Item 3").sibling(resourceId="com.example:id/icon").description, "Icon 3")
+        self.assertEqual(self.snapshot(text="Item 3").child(text="Item 3").exists, False)
+
+    def test_benchmark(self):
+        selectors = [Selector(text="Item %d" % i) for i in range(0, 4000, 200)] + \
+                    [Selector(descriptionStartsWith="Icon %d" % i) for i in range(3990, 4000)]
+        examined, original = [], Hierarchy.match
+
+        def match(node, selector):
+            examined.append(node)
+            return original(node, selector)
+        with patch.object(Hierarchy, "match", staticmethod(match)):
+            indexed = [self.snapshot.select(selector) for selector in selectors]
+        self.assertEqual(indexed, [self.scan(selector) for selector in selectors])
+        # only the index entries of each selector are matched, instead of all 12001 nodes.
+        self.assertEqual(len(examined), len(selectors))
+
+
+class TestSpatialIndex(unittest.TestCase):
+
+    # same distances as the former per candidate implementation of AutomatorDeviceObject.right/left/up/down
+    onsideof = {
+        "right": lambda r1, r2: r2["left"] - r1["right"] if intersect(r1, r2)[1] < intersect(r1, r2)[3] else -1,
+        "left": lambda r1, r2: r1["left"] - r2["right"] if intersect(r1, r2)[1] < intersect(r1, r2)[3] else -1,
+        "up": lambda r1, r2: r1["top"] - r2["bottom"] if intersect(r1, r2)[0] < intersect(r1, r2)[2] else -1,
+        "down": lambda r1, r2: r2["top"] - r1["bottom"] if intersect(r1, r2)[0] < intersect(r1, r2)[2] else -1
+    }
+
+    @staticmethod
+    def rect(bounds):
+        return dict(zip(["left", "top", "right", "bottom"], bounds))
+
+    def scan(self, bounds, direction, nodes):
+        min_dist, found = -1, None
+        for node in nodes:
+            dist = self.onsideof[direction](self.rect(bounds), self.rect(node.bounds))
+            if dist >= 0 and (min_dist < 0 or dist < min_dist):
+                min_dist, found = dist, node
+        return found
+
+    def test_layout(self):
+        snapshot = Hierarchy(layout())
+        people = snapshot(text="People")
+        self.assertEqual(people.right(className="android.widget.TextView").description, "Apps")
+        self.assertEqual(people.left(className="android.widget.TextView").text, "Phone")
+        self.assertEqual(people.left(className="android.widget.TextView").selector["instance"], 0)
+        self.assertIsNone(people.up(className="android.widget.TextView"))
+        self.assertEqual(people.up().description, "Home screen 3")
+        self.assertEqual(snapshot(description="Search").down().description, "Analog clock")
+        self.assertEqual(snapshot(text="Browser").right(), None)
+        with self.assertRaises(JsonRPCError):
+            snapshot(text="Nothing").right()
+
+    def test_same_as_scan(self):
+        import random
+        rand = random.Random(7)
+
+        def bounds():
+            left, top = rand.randint(-50, 1000), rand.randint(-50, 1800)
+            return "[%d,%d][%d,%d]" % (left, top, left + rand.randint(0, 300), top + rand.randint(0, 200))
+        nodes = [Node({"bounds": bounds()}, None, i) for i in range(600)]
+        accept = set(rand.sample(range(600), 100))
+        for direction in SpatialIndex.directions:
+            grid = SpatialIndex(nodes, direction)
+            for query in nodes[:150]:
+                self.assertIs(grid.nearest(query.bounds), self.scan(query.bounds, direction, nodes))
+                self.assertIs(grid.nearest(query.bounds, accept),
+                              self.scan(query.bounds, direction, [n for n in nodes if n.order in accept]))
+
+    def test_nearest(self):
+        snapshot = Hierarchy(synthetic(1000))
+        icons = snapshot(resourceId="com.example:id/icon").nodes
+        texts = snapshot(className="android.widget.TextView").nodes
+        for node in icons[::50]:
+            for direction in SpatialIndex.directions:
+                self.assertIs(snapshot.nearest(node.bounds, direction, texts),
+                              self.scan(node.bounds, direction, texts))
+                self.assertIs(snapshot.nearest(node.bounds, direction, texts[:10]),
+                              self.scan(node.bounds, direction, texts[:10]))
+
+
+class TestNode(unittest.TestCase):
+
+    def test_compact(self):
+        snapshot = Hierarchy(synthetic(3))
+        rows = snapshot(resourceId="com.example:id/row").nodes
+        self.assertFalse(hasattr(rows[0], "__dict__"))
+        self.assertIs(rows[0].class_name, rows[1].class_name)
+        self.assertIs(rows[0].resource_id, rows[2].resource_id)
+        self.assertEqual((rows[0].clickable, rows[0].enabled, rows[0].checked), (True, True, False))
+        self.assertEqual(rows[0].flags, 1 << 2 | 1 << 3)
+        node = Node({"long-clickable": "true", "selected": "true", "bounds": "[1,2][3,4]"})
+        self.assertEqual((node.long_clickable, node.selected, node.password), (True, True, False))
+        self.assertEqual(node.bounds, (1, 2, 3, 4))
+
+    @unittest.skipIf(sys.version_info < (3, 4), "tracemalloc requires python 3.4+")
+    def test_memory(self):
+        import gc
+        import tracemalloc
+        raw = synthetic(1500)
+
+        def dict_tree():
+            roots, path = [], []
+            for depth, attrs in iter_nodes(raw):
+                del path[depth:]
+                node = {"attrib": attrs, "children": []}
+                (path[-1]["children"] if path else roots).append(node)
+                path.append(node)
+            return roots
+
+        sizes = []
+        for build in (dict_tree, lambda: Hierarchy(raw)):
+            gc.collect()
+            tracemalloc.start()
+            try:
+                tree = build()
+                sizes.append(tracemalloc.get_traced_memory()[0])
+                del tree
+            finally:
+                tracemalloc.stop()
+        dict_size, compact_size = sizes
+        self.assertLess(compact_size * 2, dict_size)
+
+
+class TestStreaming(unittest.TestCase):
+
+    def test_iter_nodes(self):
+        nodes = list(iter_nodes(layout()))
+        self.assertEqual(len(nodes), 12)
+        self.assertEqual([depth for depth, _ in nodes], [0, 1, 2, 3, 4, 1, 1, 2, 2, 2, 2, 2])
+        self.assertEqual(nodes[7][1]["text"], "Phone")
+        self.assertEqual(nodes[7][1]["bounds"], "[0,706][96,800]")
+
+    def test_chunks(self):
+        import io
+
+        def elements(events):  # text data may be split at chunk boundaries
+            return [e for e in events if e[0] != "text"]
+        content = layout()
+        events = elements(iter_events(content))
+        self.assertEqual(elements(iter_events(content, chunk_size=7)), events)
+        self.assertEqual(elements(iter_events(content.encode("utf-8"), chunk_size=100)), events)
+        self.assertEqual(elements(iter_events(io.BytesIO(content.encode("utf-8")), chunk_size=5)), events)
+        self.assertEqual(elements(iter_events(io.StringIO(content), chunk_size=3)), events)
+        self.assertEqual(events[0], ("start", "hierarchy", [("rotation", "0")]))
+        self.assertEqual(len(events), 26)
+
+    def test_write_pretty(self):
+        import io
+        raw = "".join(line.strip() for line in layout().splitlines()[1:])
+        out = io.StringIO()
+        write_pretty(raw, out)
+        pretty = out.getvalue()
+        lines = pretty.splitlines()
+        self.assertEqual(lines[0], '<?xml version="1.0" ?>')
+        self.assertEqual(lines[1], '<hierarchy rotation="0">')
+        self.assertTrue(lines[2].startswith('  <node index="0" text="" resource-id=""'))
+        self.assertTrue(lines[6].startswith('          <node') and lines[6].endswith('/>'))
+        self.assertEqual(lines[-1], '</hierarchy>')
+        self.assertEqual(list(iter_nodes(pretty)), list(iter_nodes(raw)))
+
+    def test_escape(self):
+        import io
+        raw = u'<hierarchy><node text="a &amp; &lt;b&gt; &quot;c&quot;&#10;d \u4e2d"><node /></node></hierarchy>'
+        out = io.StringIO()
+        write_pretty(raw, out)
+        self.assertEqual(list(iter_nodes(out.getvalue())), list(iter_nodes(raw)))
+        self.assertEqual(list(iter_nodes(raw))[0][1]["text"], u'a & <b> "c"\nd \u4e2d')
+
+    @unittest.skipIf(sys.version_info < (3, 4), "tracemalloc requires python 3.4+")
+    def test_memory(self):
+        import io
+        import tracemalloc
+        import xml.dom.minidom
+        raw = synthetic(500)
+        tracemalloc.start()
+        try:
+            write_pretty(raw, io.StringIO())
+            streaming = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        tracemalloc.start()
+        try:
+            xml.dom.minidom.parseString(raw.encode("utf-8")).toprettyxml(indent="  ")
+            dom = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(streaming * 3, dom)
+
+
+class TestDeviceSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.runtime_dir = tempfile.mkdtemp()  # keep the port registry of live sessions out of the tests
+        self.runtime_patch = patch.dict(os.environ, {"UIAUTOMATOR_RUNTIME_DIR": self.runtime_dir})
+        self.runtime_patch.start()
+
+    def tearDown(self):
+        self.runtime_patch.stop()
+        shutil.rmtree(self.runtime_dir)
+
+    def test_snapshot(self):
+        device = AutomatorDevice()
+        device.server = MagicMock()
+        device.server.jsonrpc.dumpWindowHierarchy.return_value = layout()
+        snapshot = device.snapshot()
+        device.server.jsonrpc.dumpWindowHierarchy.assert_called_once_with(False, None)
+        self.assertEqual(snapshot(text="Browser").info["bounds"]["left"], 384)
+        self.assertEqual(snapshot.select(Selector(text="People"))[0].index, 1)
+        self.assertEqual(device.server.jsonrpc.dumpWindowHierarchy.call_count, 1)
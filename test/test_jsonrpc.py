@@ -3,8 +3,18 @@
 
 import unittest
 from mock import MagicMock, patch
-from uiautomator import JsonRPCMethod, JsonRPCClient
+from uiautomator import JsonRPCMethod, JsonRPCClient, HTTPConnectionPool, JsonRPCError, urllib2
 import os
+import json
+import time
+import socket
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
 
 
 class TestJsonRPCMethod_id(unittest.TestCase):
@@ -124,3 +134,242 @@ class TestJsonRPCMethod_call_on_windows(unittest.TestCase):
 
         with self.assertRaises(Exception):
             self.method()
+
+
+class TestJsonRPCMethod_call_with_pool(unittest.TestCase):
+
+    def setUp(self):
+        self.url = "http://localhost/jsonrpc"
+        self.pool = MagicMock()
+        self.method = JsonRPCMethod(self.url, "ping", 20, pool=self.pool)
+
+    def test_normal_call(self):
+        self.pool.urlopen.return_value.read.return_value = b'{"result": "pong", "error": null, "id": "DKNCJDLDJJ"}'
+        self.assertEqual("pong", self.method())
+        args, kwargs = self.pool.urlopen.call_args
+        self.assertEqual(args, ("POST", self.url))
+        self.assertEqual(kwargs["timeout"], 20)
+        self.assertEqual(json.loads(kwargs["body"].decode("utf-8"))["method"], "ping")
+
+    def test_error_call(self):
+        self.pool.urlopen.return_value.read.return_value = b'{"error": {"code": -32002, "message": "msg", "data": {"exceptionTypeName": "E"}}}'
+        with self.assertRaises(Exception):
+            self.method()
+
+    def test_frozen_selector(self):
+        import uiautomator
+        selector = uiautomator.FrozenSelector(text="OK").child(className="android.widget.Button")
+        self.pool.urlopen.return_value.read.return_value = b'{"result": true, "error": null, "id": "1"}'
+        JsonRPCMethod(self.url, "click", 20, pool=self.pool)(selector, "topleft")
+        body = self.pool.urlopen.call_args[1]["body"].decode("utf-8")
+        self.assertIn(selector.json, body)  # memoized json reused as is
+        self.assertEqual(json.loads(body)["params"], [json.loads(json.dumps(selector)), "topleft"])
+
+    def test_client_pass_pool(self):
+        client = JsonRPCClient(self.url, 20, pool=self.pool)
+        self.assertIs(client.ping.http, self.pool)
+
+
+class TestJsonRPCBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.url = "http://localhost/jsonrpc"
+        self.pool = MagicMock()
+        self.client = JsonRPCClient(self.url, 20, pool=self.pool)
+
+    def body(self):
+        return json.loads(self.pool.urlopen.call_args[1]["body"].decode("utf-8"))
+
+    def test_batch(self):
+        self.pool.urlopen.return_value.read.return_value = json.dumps([
+            {"jsonrpc": "2.0", "id": 1, "result": 3},
+            {"jsonrpc": "2.0", "id": 0, "result": True},
+            {"jsonrpc": "2.0", "id": 2, "error": {"code": -32002, "message": "not found", "data": {"exceptionTypeName": "UiObjectNotFoundException"}}}
+        ]).encode("utf-8")
+        with self.client.batch() as b:
+            exist = b.exist({"text": "OK"})
+            count = b.count({"className": "android.widget.TextView"})
+            info = b.objInfo({"text": "Cancel"})
+            self.assertFalse(exist.done())
+            with self.assertRaises(RuntimeError):
+                exist.result()
+        self.assertEqual(self.pool.urlopen.call_count, 1)
+        self.assertEqual([(r["id"], r["method"], r["params"]) for r in self.body()],
+                         [(0, "exist", [{"text": "OK"}]),
+                          (1, "count", [{"className": "android.widget.TextView"}]),
+                          (2, "objInfo", [{"text": "Cancel"}])])
+        self.assertEqual(exist.result(), True)
+        self.assertEqual(count.result(), 3)
+        with self.assertRaises(JsonRPCError) as e:
+            info.result()
+        self.assertEqual(e.exception.code, -32002)
+
+    def test_missing_response(self):
+        self.pool.urlopen.return_value.read.return_value = b'[{"jsonrpc": "2.0", "id": 0, "result": "pong"}]'
+        with self.client.batch() as b:
+            ping1, ping2 = b.ping(), b.ping()
+        self.assertEqual(ping1.result(), "pong")
+        with self.assertRaises(JsonRPCError):
+            ping2.result()
+
+    def test_not_sent_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.client.batch() as b:
+                b.ping()
+                raise ValueError()
+        self.assertFalse(self.pool.urlopen.called)
+
+    def test_fallback_on_http_error(self):
+        pong = b'{"jsonrpc": "2.0", "id": "a", "result": "pong"}'
+        for rejected in [urllib2.HTTPError(self.url, 404, "Not Found", {}, None), b"<html>not json</html>"]:
+            responses = [MagicMock(), MagicMock()]
+            for res in responses:
+                res.read.return_value = pong
+            if isinstance(rejected, bytes):
+                rejected = MagicMock(**{"read.return_value": rejected})
+            self.pool.urlopen.reset_mock()
+            self.pool.urlopen.side_effect = [rejected] + responses
+            with self.client.batch() as b:
+                pings = [b.ping(), b.ping()]
+            self.assertEqual([ping.result() for ping in pings], ["pong", "pong"])
+            self.assertEqual(self.pool.urlopen.call_count, 3)
+
+    def test_fallback_error_sets_left_futures(self):
+        self.pool.urlopen.return_value.read.side_effect = [
+            b'{"jsonrpc": "2.0", "id": null, "error": {"code": -32600, "message": "Invalid Request"}}',
+            b'{"jsonrpc": "2.0", "id": "a", "result": "pong"}',
+            socket.error("connection refused")
+        ]
+        with self.assertRaises(socket.error):
+            with self.client.batch() as b:
+                futures = [b.ping(), b.click(1, 2), b.ping()]
+        self.assertEqual(futures[0].result(), "pong")
+        for future in futures[1:]:
+            self.assertRaises(socket.error, future.result)
+
+    def test_fallback(self):
+        self.pool.urlopen.return_value.read.side_effect = [
+            b'{"jsonrpc": "2.0", "id": null, "error": {"code": -32600, "message": "Invalid Request"}}',
+            b'{"jsonrpc": "2.0", "id": "a", "result": "pong"}',
+            b'{"jsonrpc": "2.0", "id": "b", "error": {"code": -32001, "message": "error"}}'
+        ]
+        with self.client.batch() as b:
+            ping = b.ping()
+            click = b.click(1, 2)
+        self.assertEqual(self.pool.urlopen.call_count, 3)
+        self.assertEqual(self.body()["method"], "click")
+        self.assertEqual(self.body()["params"], [1, 2])
+        self.assertEqual(ping.result(), "pong")
+        with self.assertRaises(JsonRPCError):
+            click.result()
+
+
+class _KeepAliveServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    block_on_close = False
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), _KeepAliveHandler)
+        self.clients, self.connections = [], []
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def process_request(self, request, client_address):
+        self.connections.append(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            conn.close()
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.clients.append(self.client_address)
+        method = json.loads(body.decode("utf-8"))["method"]
+        if method == "slow":
+            time.sleep(0.3)
+        elif method == "error":
+            self.send_response(500)
+            self.send_header("Content-Length", "5")
+            self.end_headers()
+            self.wfile.write(b"error")
+            return
+        data = json.dumps({"result": method}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _KeepAliveServer()
+        self.port = self.server.server_address[1]
+        self.url = "http://127.0.0.1:%d/jsonrpc/0" % self.port
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_keep_alive(self):
+        pool = HTTPConnectionPool("127.0.0.1", self.port)
+        for method in ["ping", "click", "exist"]:
+            self.assertEqual(JsonRPCMethod(self.url, method, pool=pool)(), method)
+        self.assertEqual(len(set(self.server.clients)), 1)
+
+    def test_maxsize(self):
+        pool = HTTPConnectionPool("127.0.0.1", self.port, maxsize=1)
+        responses = [pool.urlopen("POST", self.url, b'{"method": "ping"}') for i in range(3)]
+        for res in responses:
+            self.assertEqual(res.read(), b'{"result": "ping"}')
+        self.assertEqual(len(set(self.server.clients)), 3)
+        pool.urlopen("POST", self.url, b'{"method": "ping"}').read()
+        self.assertEqual(len(set(self.server.clients)), 3)
+
+    def test_idle_timeout(self):
+        pool = HTTPConnectionPool("127.0.0.1", self.port, idle_timeout=0)
+        pool.urlopen("POST", self.url, b'{"method": "ping"}').read()
+        pool.urlopen("POST", self.url, b'{"method": "ping"}').read()
+        self.assertEqual(len(set(self.server.clients)), 2)
+
+    def test_reconnect(self):
+        pool = HTTPConnectionPool("127.0.0.1", self.port)
+        self.assertEqual(JsonRPCMethod(self.url, "ping", pool=pool)(), "ping")
+        # restart the server on the same port, the pooled connection is broken.
+        self.server.close()
+        self.server = _KeepAliveServer(self.port)
+        self.assertEqual(JsonRPCMethod(self.url, "ping", pool=pool)(), "ping")
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_timeout_not_retried(self):
+        pool = HTTPConnectionPool("127.0.0.1", self.port)
+        self.assertEqual(JsonRPCMethod(self.url, "ping", pool=pool)(), "ping")
+        self.assertRaises(socket.timeout, JsonRPCMethod(self.url, "slow", timeout=0.1, pool=pool))
+        time.sleep(0.5)
+        self.assertEqual(len(self.server.clients), 2)  # the slow call was sent once
+
+    def test_http_error(self):
+        pool = HTTPConnectionPool("127.0.0.1", self.port)
+        with self.assertRaises(urllib2.HTTPError) as context:
+            JsonRPCMethod(self.url, "error", pool=pool)()
+        self.assertEqual(context.exception.code, 500)
+        self.assertEqual(JsonRPCMethod(self.url, "ping", pool=pool)(), "ping")
+        self.assertEqual(len(set(self.server.clients)), 1)  # the error page was read, the connection kept
@@ -4,7 +4,7 @@
 import unittest
 import uiautomator
 import os
-from mock import patch
+from mock import MagicMock, patch
 
 
 class TestMisc(unittest.TestCase):
@@ -46,3 +46,148 @@ class TestMisc(unittest.TestCase):
             socket.return_value.connect_ex.return_value = 1
             uiautomator._init_local_port = 32764
             self.assertEqual(uiautomator.next_local_port(), 9008)
+
+    def test_lazy_device_isinstance(self):
+        d = uiautomator.LazyAutomatorDevice(serial="abcd")
+        with patch('uiautomator.AutomatorDevice.__init__') as init:
+            self.assertIsInstance(d, uiautomator.AutomatorDevice)
+            self.assertIsInstance(uiautomator.device, uiautomator.AutomatorDevice)
+            self.assertTrue(issubclass(uiautomator.LazyAutomatorDevice, uiautomator.AutomatorDevice))
+            self.assertIs(d.__class__, type(d))
+            self.assertFalse(init.called)
+        self.assertEqual(repr(d), "<LazyAutomatorDevice (not created)>")
+
+    def test_lazy_device(self):
+        with patch('uiautomator.AutomatorDevice') as AutomatorDevice:
+            d = uiautomator.LazyAutomatorDevice(serial="abcd")
+            self.assertFalse(AutomatorDevice.called)
+            d(text="OK").click()
+            d.info
+            d.wakeup()
+            AutomatorDevice.assert_called_once_with(serial="abcd")
+            AutomatorDevice.return_value.assert_called_once_with(text="OK")
+            AutomatorDevice.return_value.wakeup.assert_called_once_with()
+            d.server = "server"
+            self.assertEqual(AutomatorDevice.return_value.server, "server")
+
+    def test_import_time(self):
+        import sys
+        import subprocess
+        # fresh interpreter where any process spawn or socket connect fails loudly
+        script = "\n".join([
+            "import socket, subprocess, sys, time",
+            "def fail(*args, **kwargs): raise AssertionError('adb or network touched at import')",
+            "subprocess.Popen.__init__ = fail",
+            "socket.socket.connect = socket.socket.connect_ex = socket.create_connection = fail",
+            "start = time.time()",
+            "import uiautomator",
+            "sys.stdout.write('%f' % (time.time() - start))",
+        ])
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        proc = subprocess.Popen([sys.executable, "-c", script], cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        self.assertEqual(proc.returncode, 0, err)
+        self.assertLess(float(out), 2.0)
+
+
+class TestLocalPortAllocator(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.allocator = uiautomator.LocalPortAllocator(self.directory)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def write_registry(self, ports):
+        import json
+        with open(self.allocator.registry, "w") as f:
+            json.dump(ports, f)
+
+    def test_reserve(self):
+        with patch('uiautomator.next_local_port') as next_local_port:
+            next_local_port.side_effect = [9100, 9100, 9101]
+            self.assertEqual(self.allocator.reserve("abcd"), 9100)
+            self.assertEqual(self.allocator.reserve("1234"), 9101)
+        self.assertEqual(self.allocator.reserve("efgh", port=9200), 9200)
+        reserved = self.allocator.reserved()
+        self.assertEqual(sorted(reserved.keys()), ["localhost:9100", "localhost:9101", "localhost:9200"])
+        self.assertEqual(reserved["localhost:9101"], {"serial": "1234", "host": "localhost", "pid": os.getpid()})
+
+        self.allocator.release(9100)
+        self.assertEqual(sorted(self.allocator.reserved().keys()), ["localhost:9101", "localhost:9200"])
+        self.allocator.release_all()
+        self.assertEqual(self.allocator.reserved(), {})
+
+    def test_other_process(self):
+        import sys
+        import subprocess
+        dead = subprocess.Popen([sys.executable, "-c", "pass"])
+        dead.wait()
+        self.write_registry({
+            "localhost:9100": {"serial": "abcd", "host": "localhost", "pid": os.getppid()},
+            "localhost:9101": {"serial": "1234", "host": "localhost", "pid": dead.pid}
+        })
+        with patch('uiautomator.next_local_port') as next_local_port:
+            next_local_port.side_effect = [9100, 9101]
+            self.assertEqual(self.allocator.reserve("efgh"), 9101)  # 9101 owner is gone
+        self.allocator.release(9100)  # not owned by this process
+        self.assertEqual(sorted(self.allocator.reserved().keys()), ["localhost:9100", "localhost:9101"])
+
+    def test_reserve_forwarded(self):
+        self.write_registry({"localhost:9100": {"serial": "abcd", "host": "localhost", "pid": os.getppid()}})
+        self.assertEqual(self.allocator.reserve("abcd", port=9100), 9100)  # shared forward of the same device
+        self.assertEqual(self.allocator.reserved()["localhost:9100"]["pid"], os.getppid())
+        self.assertRaises(EnvironmentError, self.allocator.reserve, "efgh", port=9100)
+        self.assertEqual(self.allocator.reserved()["localhost:9100"]["serial"], "abcd")
+
+    def test_pid_alive_windows(self):
+        import ctypes
+        kernel32 = MagicMock()
+        kernel32.OpenProcess.return_value = 42
+
+        def exit_code(handle, code):
+            code._obj.value = exit_code.value
+            return 1
+        kernel32.GetExitCodeProcess.side_effect = exit_code
+        with patch("os.name", "nt"), patch.object(ctypes, "windll", MagicMock(kernel32=kernel32), create=True):
+            exit_code.value = 259
+            self.assertTrue(uiautomator._pid_alive(1234))
+            exit_code.value = 0
+            self.assertFalse(uiautomator._pid_alive(1234))
+            kernel32.CloseHandle.assert_called_with(42)
+            kernel32.OpenProcess.return_value = 0
+            kernel32.GetLastError.return_value = 87  # ERROR_INVALID_PARAMETER, no such process
+            self.assertFalse(uiautomator._pid_alive(1234))
+            kernel32.GetLastError.return_value = 5
+            self.assertTrue(uiautomator._pid_alive(1234))
+
+    def test_concurrent(self):
+        import sys
+        import threading
+        import subprocess
+        script = "\n".join([
+            "import sys, uiautomator",
+            "allocator = uiautomator.LocalPortAllocator(sys.argv[1])",
+            "print(' '.join(str(allocator.reserve('p%d' % i)) for i in range(5)))",
+            "sys.stdout.flush()",
+            "sys.stdin.read()",  # keep the reservations alive until all processes are done
+        ])
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        procs = [subprocess.Popen([sys.executable, "-c", script, self.directory], cwd=root,
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE) for _ in range(4)]
+        ports = []
+        threads = [threading.Thread(target=lambda: ports.extend(self.allocator.reserve("t") for _ in range(5)))
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for p in procs:
+            ports.extend(int(port) for port in p.stdout.readline().split())
+        for p in procs:
+            p.communicate()
+        self.assertEqual(len(ports), 40)
+        self.assertEqual(len(set(ports)), 40)
@@ -104,3 +104,79 @@ class TestSelector(unittest.TestCase):
             self.assertEqual(sel[k], clone[k])
         self.assertEqual(sel["childOrSibling"], clone["childOrSibling"])
         self.assertEqual(sel["childOrSiblingSelector"], clone["childOrSiblingSelector"])
+
+
+class TestFrozenSelector(unittest.TestCase):
+
+    def setUp(self):
+        # test_misc reloads the package, always use its current classes
+        import uiautomator
+        self.uiautomator = uiautomator
+        self.Selector, self.FrozenSelector = uiautomator.Selector, uiautomator.FrozenSelector
+
+    def test_freeze(self):
+        sel = self.Selector(text="OK", clickable=True).child(className="android.widget.Button")
+        frozen = sel.freeze()
+        self.assertIsInstance(frozen, self.Selector)
+        self.assertEqual(frozen, sel)
+        self.assertIsInstance(frozen["childOrSiblingSelector"][0], self.FrozenSelector)
+        self.assertIs(frozen.freeze(), frozen)
+        self.assertEqual(self.FrozenSelector(text="OK", clickable=True).child(className="android.widget.Button"), frozen)
+
+    def test_immutable(self):
+        frozen = self.FrozenSelector(text="OK").child(text="1")
+        with self.assertRaises(TypeError):
+            frozen["text"] = "Cancel"
+        with self.assertRaises(TypeError):
+            del frozen["text"]
+        with self.assertRaises(TypeError):
+            frozen.update(text="Cancel")
+        with self.assertRaises(TypeError):
+            frozen["childOrSibling"].append("child")
+        with self.assertRaises(TypeError):
+            frozen["childOrSiblingSelector"][0]["text"] = "2"
+        self.assertEqual(frozen["text"], "OK")
+
+    def test_hash(self):
+        a = self.FrozenSelector(text="OK", index=1).sibling(text="1")
+        b = self.Selector(index=1, text="OK").sibling(text="1").freeze()
+        self.assertEqual(hash(a), hash(b))
+        self.assertEqual(len(set([a, b, self.FrozenSelector(text="OK")])), 2)
+        self.assertEqual({a: 1}[b], 1)
+
+    def test_sharing(self):
+        base = self.FrozenSelector(resourceId="android:id/list").child(text="row")
+        first, second = base.child(text="a"), base.sibling(text="b")
+        self.assertEqual(base["childOrSibling"], ["child"])
+        self.assertEqual(first["childOrSibling"], ["child", "child"])
+        self.assertEqual(second["childOrSibling"], ["child", "sibling"])
+        self.assertIs(first["childOrSiblingSelector"][0], base["childOrSiblingSelector"][0])
+        clone = first.clone()
+        self.assertNotIsInstance(clone, self.FrozenSelector)
+        self.assertIs(clone["childOrSiblingSelector"][1], first["childOrSiblingSelector"][1])
+        clone["instance"] = 2
+        clone.child(text="c")
+        self.assertNotIn("instance", first)
+        self.assertEqual(len(first["childOrSibling"]), 2)
+
+    def test_json(self):
+        import json
+        frozen = self.FrozenSelector(text=u"中文", clickable=True).child(text="1").sibling(index=2)
+        self.assertEqual(json.loads(frozen.json), json.loads(json.dumps(frozen)))
+        mixed = frozen.clone().child(text="2")
+        self.assertEqual(json.loads(self.uiautomator.dumps(mixed)), json.loads(json.dumps(mixed)))
+        data = {"jsonrpc": "2.0", "method": "click", "id": "1", "params": [frozen, "topleft", 3, None]}
+        self.assertEqual(json.loads(self.uiautomator.dumps(data)), json.loads(json.dumps(data)))
+        self.assertEqual(json.loads(self.uiautomator.dumps([data])), [json.loads(json.dumps(data))])
+        keys = {1: "a", 1.5: "b", False: "c", None: "d", u"中文": "e"}
+        self.assertEqual(json.loads(self.uiautomator.dumps(keys)), json.loads(json.dumps(keys)))
+        self.assertRaises(TypeError, self.uiautomator.dumps, {(1, 2): "a"})
+
+    def test_pickle(self):
+        import copy
+        import pickle
+        frozen = self.FrozenSelector(text="OK").child(text="1")
+        for other in (pickle.loads(pickle.dumps(frozen)), copy.deepcopy(frozen)):
+            self.assertIsInstance(other, self.FrozenSelector)
+            self.assertEqual(other, frozen)
+            self.assertEqual(hash(other), hash(frozen))
@@ -2,18 +2,28 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+import io
+import os
+import shutil
+import tempfile
 from mock import MagicMock, patch, call
-from uiautomator import AutomatorServer, JsonRPCError
+import uiautomator
+from uiautomator import AutomatorServer, JsonRPCError, file_checksum
 
 
 class TestAutomatorServer(unittest.TestCase):
 
     def setUp(self):
+        self.runtime_dir = tempfile.mkdtemp()  # keep the port registry of live sessions out of the tests
+        self.runtime_patch = patch.dict(os.environ, {"UIAUTOMATOR_RUNTIME_DIR": self.runtime_dir})
+        self.runtime_patch.start()
         self.Adb_patch = patch('uiautomator.Adb')
         self.Adb = self.Adb_patch.start()
 
     def tearDown(self):
         self.Adb.stop()
+        self.runtime_patch.stop()
+        shutil.rmtree(self.runtime_dir)
 
     def test_local_port(self):
         self.assertEqual(AutomatorServer("1234", 9010).local_port, 9010)
@@ -39,6 +49,26 @@ class TestAutomatorServer(unittest.TestCase):
             self.assertEqual(AutomatorServer("abcd", None).local_port,
                              next_local_port.return_value)
 
+    def test_local_port_reserved(self):
+        with patch('uiautomator.port_allocator') as port_allocator:
+            port_allocator.reserve.return_value = 9020
+            self.Adb.return_value.device_serial.return_value = "abcd"
+            self.Adb.return_value.forward_list.return_value = [("abcd", "tcp:9010", "tcp:9008")]
+            server = AutomatorServer("abcd", adb_server_host="10.0.0.2")
+            self.assertEqual(server.local_port, 9020)
+            port_allocator.reserve.assert_called_once_with("abcd", "10.0.0.2", 9010)
+
+            server.stop()
+            port_allocator.release.assert_called_once_with(9020, "10.0.0.2")
+            server.sdk_version = MagicMock(return_value=21)
+            server.install = MagicMock()
+            server.wait_ready = MagicMock(return_value=True)
+            server.start()
+            port_allocator.reserve.assert_called_with("abcd", "10.0.0.2", 9020)
+
+            AutomatorServer("abcd", 9030).stop()
+            self.assertEqual(port_allocator.release.call_count, 1)
+
     def test_device_port(self):
         self.assertEqual(AutomatorServer().device_port, 9008)
 
@@ -63,6 +93,71 @@ class TestAutomatorServer(unittest.TestCase):
             with self.assertRaises(IOError):
                 server.start()
 
+    def test_start_fail_fast(self):
+        server = AutomatorServer()
+        server.push = MagicMock(return_value=["bundle.jar", "uiautomator-stub.jar"])
+        server.ping = MagicMock(return_value=None)
+        server.adb = MagicMock()
+        server.adb.cmd.return_value.poll.return_value = 1
+        server.adb.cmd.return_value.communicate.return_value = (b"INSTRUMENTATION_FAILED: com.github.uiautomator.test", b"")
+        with patch("time.sleep") as sleep:
+            with self.assertRaises(IOError) as e:
+                server.start(timeout=30)
+        self.assertFalse(sleep.called)
+        self.assertIn("INSTRUMENTATION_FAILED", str(e.exception))
+
+    def test_wait_ready_pings_first(self):
+        server = AutomatorServer()
+        server.ping = MagicMock(return_value="pong")
+        server.uiautomator_process = MagicMock(**{"poll.return_value": 0})  # e.g. a mocked or reaped process
+        self.assertTrue(server.wait_ready())
+        server.uiautomator_process.poll.assert_not_called()
+
+    def test_start_backoff(self):
+        server = AutomatorServer()
+        server.sdk_version = MagicMock(return_value=21)
+        server.install = MagicMock()
+        server.adb = MagicMock()
+        server.adb.cmd.return_value.poll.return_value = None
+        server.ping = MagicMock(side_effect=[None] * 4 + ["pong"])
+        with patch("time.sleep") as sleep, patch("socket.create_connection") as create_connection:
+            server.start(timeout=5)
+        self.assertEqual([args[0][0] for args in sleep.call_args_list], [0.01, 0.02, 0.04, 0.08])
+        self.assertEqual(server.ping.call_count, 5)
+        self.assertFalse(create_connection.called)
+        self.assertEqual(list(server.start_timings.keys()), ["deploy", "launch", "forward", "ready"])
+
+    def test_wait_ready_timeout(self):
+        server = AutomatorServer()
+        server.adb = MagicMock()
+        server.uiautomator_process = MagicMock()
+        server.uiautomator_process.poll.return_value = None
+        clock = [100.0]
+
+        def advance(seconds):
+            clock[0] += seconds
+        server.ping = MagicMock(side_effect=lambda: advance(0.05))  # a slow ping counts against the timeout
+        with patch("time.sleep", side_effect=advance) as sleep, patch("uiautomator.monotonic", lambda: clock[0]):
+            self.assertFalse(server.wait_ready(timeout=2))
+        self.assertAlmostEqual(clock[0], 102.05)  # one last ping at the deadline
+        self.assertAlmostEqual(sum(args[0][0] for args in sleep.call_args_list) + 0.05 * server.ping.call_count, 2.05)
+        self.assertEqual(max(args[0][0] for args in sleep.call_args_list), 0.5)
+
+    def test_deployment(self):
+        deploy, cmd = AutomatorServer.deployment(17)
+        self.assertEqual([(args[0], os.path.basename(args[1]), args[2]) for args in deploy],
+                         [("push", "bundle.jar", "/data/local/tmp/"), ("push", "uiautomator-stub.jar", "/data/local/tmp/")])
+        self.assertEqual(cmd, ["shell", "uiautomator", "runtest", "bundle.jar", "uiautomator-stub.jar",
+                               "-c", "com.github.uiautomatorstub.Stub"])
+        deploy, cmd = AutomatorServer.deployment(21)
+        self.assertEqual([os.path.basename(args[-1]) for args in deploy], ["app-uiautomator.apk", "app-uiautomator-test.apk"])
+        self.assertEqual(cmd[-1], "com.github.uiautomator.test/android.support.test.runner.AndroidJUnitRunner")
+        deploy, cmd = AutomatorServer.deployment(28)
+        self.assertEqual([args[:3] for args in deploy], [["install", "-r", "-t"]] * 2)
+        self.assertEqual([os.path.basename(args[-1]) for args in deploy],
+                         ["app-uiautomator-androidx.apk", "app-uiautomator-test-androidx.apk"])
+        self.assertEqual(cmd[-1], "com.github.uiautomator.test/androidx.test.runner.AndroidJUnitRunner")
+
     def test_auto_start(self):
         try:
             import urllib2
@@ -102,6 +197,27 @@ class TestAutomatorServer(unittest.TestCase):
             with self.assertRaises(JsonRPCError):
                 server.jsonrpc.any_method()
 
+    def test_actions(self):
+        with patch("uiautomator.JsonRPCMethod") as JsonRPCMethod:
+            JsonRPCMethod.return_value.return_value = True
+            server = AutomatorServer()
+            server.jsonrpc.objInfo({})
+            server.jsonrpc.exist({})
+            self.assertEqual(server.actions, 0)
+            server.jsonrpc.click({})
+            server.jsonrpc.pressKey("back")
+            self.assertEqual(server.actions, 2)
+
+    def test_batch_actions(self):
+        with patch.object(uiautomator.JsonRPCMethod, "post", return_value=[]) as post:
+            server = AutomatorServer()
+            with server.jsonrpc.batch() as b:
+                b.exist({})
+                b.click(1, 2)
+                b.swipe(1, 2, 3, 4, 10)
+            self.assertEqual(post.call_count, 1)
+            self.assertEqual(server.actions, 2)
+
     def test_start_ping(self):
         with patch("uiautomator.JsonRPCClient") as JsonRPCClient:
             JsonRPCClient.return_value.ping.return_value = "pong"
@@ -120,16 +236,17 @@ class TestAutomatorServer(unittest.TestCase):
 class TestAutomatorServer_Stop(unittest.TestCase):
 
     def setUp(self):
-        try:
-            import urllib2
-            self.urlopen_patch = patch('urllib2.urlopen')
-        except:
-            self.urlopen_patch = patch('urllib.request.urlopen')
-        finally:
-            self.urlopen = self.urlopen_patch.start()
+        self.runtime_dir = tempfile.mkdtemp()  # keep the port registry of live sessions out of the tests
+        self.runtime_patch = patch.dict(os.environ, {"UIAUTOMATOR_RUNTIME_DIR": self.runtime_dir})
+        self.runtime_patch.start()
+        self.pool_patch = patch('uiautomator.HTTPConnectionPool')
+        self.pool = self.pool_patch.start()
+        self.urlopen = self.pool.return_value.urlopen
 
     def tearDown(self):
-        self.urlopen_patch.stop()
+        self.pool_patch.stop()
+        self.runtime_patch.stop()
+        shutil.rmtree(self.runtime_dir)
 
     def test_screenshot(self):
         server = AutomatorServer()
@@ -138,20 +255,145 @@ class TestAutomatorServer_Stop(unittest.TestCase):
         self.assertEqual(server.screenshot(), None)
 
         server.sdk_version.return_value = 18
-        self.urlopen.return_value.read = MagicMock()
-        self.urlopen.return_value.read.return_value = b"123456"
+        self.urlopen.side_effect = lambda *args, **kwargs: io.BytesIO(b"123456")
         self.assertEqual(server.screenshot(), b"123456")
         self.assertEqual(server.screenshot("/tmp/test.txt"), "/tmp/test.txt")
+        with open("/tmp/test.txt", "rb") as f:
+            self.assertEqual(f.read(), b"123456")
+        self.assertTrue(self.urlopen.call_args[0][1].startswith(server.screenshot_uri))
+
+    def test_screenshot_stream(self):
+        server = AutomatorServer()
+        server.sdk_version = MagicMock(return_value=18)
+        content = b"PNG" * 50000  # several chunks
+        self.urlopen.side_effect = lambda *args, **kwargs: io.BytesIO(content)
+        out = io.BytesIO()
+        self.assertIs(server.screenshot(out), out)
+        self.assertEqual(out.getvalue(), content)
+
+        buf = bytearray(200000)
+        self.assertEqual(server.screenshot(buffer=buf), len(content))
+        self.assertEqual(bytes(buf[:len(content)]), content)
+        view = memoryview(buf)[1000:]
+        self.assertEqual(server.screenshot(buffer=view), len(content))
+        self.assertEqual(bytes(buf[1000:1000 + len(content)]), content)
+        self.assertRaises(ValueError, server.screenshot, buffer=bytearray(uiautomator.hierarchy.CHUNK_SIZE))
+
+    def test_screenshot_broken_stream(self):
+        server = AutomatorServer()
+        server.sdk_version = MagicMock(return_value=18)
+        response = MagicMock()
+        response.read.side_effect = [b"PNG" * 1000, IOError("connection reset")]
+        self.urlopen.side_effect = None
+        self.urlopen.return_value = response
+        filename = os.path.join(self.runtime_dir, "a.png")
+        self.assertIsNone(server.screenshot(filename))
+        self.assertFalse(os.path.exists(filename))
+        response.close.assert_called_once_with()
+
+        response.read.side_effect = [b"PNG" * 1000, uiautomator.HTTPException("incomplete read")]
+        self.assertIsNone(server.screenshot(buffer=bytearray(10000)))
+        self.assertEqual(response.close.call_count, 2)
+
+        response.read.side_effect = [b"PNG" * 1000]
+        self.assertRaises(ValueError, server.screenshot, buffer=bytearray(10))
+        self.assertEqual(response.close.call_count, 3)
 
     def test_push(self):
         jars = ["bundle.jar", "uiautomator-stub.jar"]
         server = AutomatorServer()
         server.adb = MagicMock()
+        server.adb.cmd.return_value.wait.return_value = 0
         self.assertEqual(set(server.push()), set(jars))
-        for args in server.adb.cmd.call_args_list:
+        jar_pushes = [args for args in server.adb.cmd.call_args_list if args[0][-1] == "/data/local/tmp/"]
+        self.assertEqual(len(jar_pushes), 2)
+        for args in jar_pushes:
             self.assertEqual(args[0][0], "push")
             self.assertEqual(args[0][2], "/data/local/tmp/")
 
+    def test_deploy_unchanged(self):
+        server = AutomatorServer()
+        server.adb = MagicMock()
+        pushed = {}
+
+        def cmd(*args):
+            process = MagicMock(returncode=0)
+            process.communicate.return_value = (b"", b"")
+            if args[0] == "push" and args[2] == "/data/local/tmp/uiautomator.md5":
+                with open(args[1], "rb") as f:
+                    pushed["checksums"] = f.read()
+            elif args[:2] == ("shell", "cat"):
+                process.communicate.return_value = (pushed.get("checksums", b"cat: No such file or directory"), b"")
+            return process
+        server.adb.cmd.side_effect = cmd
+
+        server.install()
+        installs = [args[0] for args in server.adb.cmd.call_args_list if args[0][0] == "install"]
+        self.assertEqual([os.path.basename(args[-1]) for args in installs], ["app-uiautomator.apk", "app-uiautomator-test.apk"])
+        self.assertEqual(set(server.deployed_checksums().keys()), set(["app-uiautomator.apk", "app-uiautomator-test.apk"]))
+
+        server.adb.cmd.reset_mock()
+        server.install()  # unchanged, no install at all
+        self.assertEqual([args[0][0] for args in server.adb.cmd.call_args_list], ["shell"])
+
+        server.adb.cmd.reset_mock()
+        server.install_androidx()  # other apks
+        self.assertEqual(len([args for args in server.adb.cmd.call_args_list if args[0][0] == "install"]), 2)
+        self.assertEqual(len(server.deployed_checksums()), 4)
+
+    def test_deploy_failed(self):
+        server = AutomatorServer()
+        server.adb = MagicMock()
+        server.adb.cmd.return_value.communicate.return_value = (b"", b"")
+        server.adb.cmd.return_value.returncode = 1
+        server.install()
+        self.assertFalse([args for args in server.adb.cmd.call_args_list if args[0][0] == "push"])
+
+    def test_deploy_waits_all(self):
+        server = AutomatorServer()
+        server.adb = MagicMock()
+        server.deployed_checksums = MagicMock(return_value={})
+        server.save_checksums = MagicMock()
+        processes = [MagicMock(returncode=1), MagicMock(returncode=0)]
+        server.adb.cmd.side_effect = processes
+        server.install()
+        for process in processes:
+            process.communicate.assert_called_once_with()
+            process.wait.assert_not_called()
+        self.assertFalse(server.save_checksums.called)
+
+    def test_start_uses_deployment(self):
+        server = AutomatorServer()
+        server.adb = MagicMock()
+        server.sdk_version = MagicMock(return_value=28)
+        server.deployed_checksums = MagicMock(return_value={})
+        server.save_checksums = MagicMock()
+        server.wait_ready = MagicMock(return_value=True)
+        server.adb.cmd.return_value.returncode = 0
+        server.start()
+        deploy, cmd = AutomatorServer.deployment(28)
+        self.assertEqual([list(args[0]) for args in server.adb.cmd.call_args_list], deploy + [cmd])
+
+    def test_start_redeploy(self):
+        server = AutomatorServer()
+        server.adb = MagicMock()
+        server.sdk_version = MagicMock(return_value=19)
+        libs = os.path.join(os.path.dirname(uiautomator.__file__), "libs")
+        checksums = {
+            "app-uiautomator.apk": file_checksum(os.path.join(libs, "app-uiautomator.apk")),
+            "app-uiautomator-test.apk": file_checksum(os.path.join(libs, "app-uiautomator-test.apk"))
+        }
+        server.save_checksums = MagicMock()
+        server.deployed_checksums = MagicMock(side_effect=lambda: {} if server.save_checksums.called else checksums)
+        server.adb.cmd.return_value.returncode = 0
+        # server only comes up once the cleared checksums forced a redeploy
+        server.ping = MagicMock(side_effect=lambda: "pong" if server.save_checksums.called else None)
+        server.adb.cmd.return_value.poll.return_value = None
+        with patch("time.sleep"), patch("socket.create_connection"):
+            server.start(timeout=0.1)
+        self.assertEqual(server.save_checksums.call_args_list[0][0], (None,))
+        self.assertEqual(len([args for args in server.adb.cmd.call_args_list if args[0][0] == "install"]), 2)
+
     def test_stop_started_server(self):
         server = AutomatorServer()
         server.adb = MagicMock()
@@ -159,6 +401,8 @@ class TestAutomatorServer_Stop(unittest.TestCase):
         process.poll.return_value = None
         server.stop()
         process.wait.assert_called_once_with()
+        self.urlopen.assert_called_once_with("GET", server.stop_uri)
+        self.pool.return_value.clear.assert_called_with()
 
         server.uiautomator_process = process = MagicMock()
         process.poll.return_value = None
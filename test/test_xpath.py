@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from mock import patch
+from test_hierarchy import layout, synthetic
+from uiautomator.hierarchy import Hierarchy
+from uiautomator.xpath import XPath, compile_xpath, _Step
+
+
+class TestXPath(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = Hierarchy(layout())
+
+    def names(self, expression):
+        return [n.text or n.description or n.resource_id for n in self.snapshot.xpath(expression)]
+
+    def test_path(self):
+        self.assertEqual(self.names("//node[@text='Phone']"), ["Phone"])
+        self.assertEqual(self.names("/hierarchy/node/node[3]"), ["com.android.launcher:id/hotseat"])
+        self.assertEqual(self.names("//android.widget.TextView"), ["Phone", "People", "Apps", "Messaging", "Browser"])
+        self.assertEqual(self.names("//node[@resource-id='com.android.launcher:id/hotseat']//*[@clickable='true']"),
+                         ["Phone", "People", "Apps", "Messaging", "Browser"])
+        self.assertEqual(self.names("hierarchy/node/node/node[@content-desc='Home screen 3']/node/node"), ["11:33"])
+        self.assertEqual(self.names("//node[@text='Nothing']//node"), [])
+
+    def test_root(self):
+        top = self.snapshot.roots
+        self.assertEqual(self.snapshot.xpath("/hierarchy/node"), top)
+        self.assertEqual(self.snapshot.xpath("/*/*"), top)
+        self.assertEqual(self.snapshot.xpath("/node"), [])  # top nodes are children of the root element
+        self.assertEqual(self.snapshot.xpath("/hierarchy"), [])  # no ui node
+        self.assertEqual(self.snapshot.xpath("//node[1]")[0], top[0])
+        self.assertEqual(self.snapshot.xpath("//node[@text='Phone']/ancestor::node()[last()]/node"), top)
+        self.assertEqual(self.snapshot.xpath("/hierarchy[@rotation='0']/node"), top)
+        self.assertEqual(self.snapshot.xpath("/hierarchy[@rotation='1']/node"), [])
+        self.assertEqual(self.snapshot.xpath("//node[not(..//node[@text='Phone'])]/parent::hierarchy"), [])
+        self.assertEqual(self.snapshot.xpath("//*").count(top[0]), 1)
+        self.assertEqual(len(self.snapshot.xpath("//node")), len(self.snapshot.nodes))
+
+    def test_filter(self):
+        self.assertEqual(self.names("(//android.widget.TextView)[2]"), ["People"])
+        self.assertEqual(self.names("(//node[@clickable='true'])[last()]"), ["Browser"])
+        self.assertEqual(self.names("(//node[@text='Phone'] | //node[@text='Browser'])[2]"), ["Browser"])
+        self.assertEqual(self.names("(//node[@text='People'])[1]/../node[1]"), ["Phone"])
+        self.assertEqual(self.names("(//node[@text='People'])[2]"), [])
+        self.assertEqual(self.names("//node[count((node)[@clickable='true']) = 5]"), ["com.android.launcher:id/hotseat"])
+        self.assertEqual(self.names("//android.widget.TextView[(1 + 1) = position()]"), ["People"])
+        with self.assertRaises(ValueError):
+            XPath("('a')[1]").evaluate(self.snapshot)
+
+    def test_axes(self):
+        self.assertEqual(self.names("//node[@text='People']/.."), ["com.android.launcher:id/hotseat"])
+        self.assertEqual(self.names("//node[@text='People']/following-sibling::node"), ["Apps", "Messaging", "Browser"])
+        self.assertEqual(self.names("//node[@text='People']/following-sibling::node[1]"), ["Apps"])
+        self.assertEqual(self.names("//node[@text='Messaging']/preceding-sibling::node[1]"), ["Apps"])
+        self.assertEqual(self.names("//node[@content-desc='11:33']/ancestor::node[@content-desc]"),
+                         ["Home screen 3", "Analog clock"])
+        self.assertEqual(self.names("//node[@content-desc='11:33']/ancestor::node[2]"), ["Home screen 3"])
+        self.assertEqual(self.names("//node[@content-desc='Analog clock']/descendant-or-self::node"),
+                         ["Analog clock", "11:33"])
+        self.assertEqual(self.names("//node[@content-desc='Search']/following::node[@text][1]"), ["Phone"])
+        self.assertEqual(self.names("//node[@text='Browser']/self::android.widget.TextView"), ["Browser"])
+
+    def test_predicates(self):
+        self.assertEqual(self.names("//node[node[@text='People']]"), ["com.android.launcher:id/hotseat"])
+        self.assertEqual(self.names("//android.widget.TextView[2]"), ["People"])
+        self.assertEqual(self.names("//android.widget.TextView[last()]"), ["Browser"])
+        self.assertEqual(self.names("//android.widget.TextView[position() > last() - 2]"), ["Messaging", "Browser"])
+        self.assertEqual(self.names("//*[contains(@content-desc, 'clock') or starts-with(@text, 'Mess')]"),
+                         ["Analog clock", "Messaging"])
+        self.assertEqual(self.names("//node[not(node)][@text='' and @clickable='true']"), ["11:33", "Search", "Apps"])
+        self.assertEqual(self.names("//node[matches(@text, 'P.*e')]"), ["Phone", "People"])
+        self.assertEqual(self.names("//node[count(node) = 5]"), ["com.android.launcher:id/hotseat"])
+        self.assertEqual(self.names("//node[string-length(@text) > 7]"), ["Messaging"])
+        self.assertEqual(self.names("//node[@index != 0][@text != '']"), ["People", "Messaging", "Browser"])
+        self.assertEqual(self.names("//node[@bounds='[0,706][96,800]']"), ["Phone"])
+        self.assertEqual(self.names("//node[@text='Phone'] | //node[@text=\"Browser\"]"), ["Phone", "Browser"])
+
+    def test_compiled(self):
+        expression = "//node[@text='Phone']/.."
+        self.assertIs(compile_xpath(expression), compile_xpath(expression))
+        plan = compile_xpath(expression)
+        other = Hierarchy(synthetic(3))
+        self.assertEqual(plan.evaluate(other), [])
+        self.assertEqual([n.resource_id for n in plan.evaluate(self.snapshot)], ["com.android.launcher:id/hotseat"])
+
+    def test_node_set_comparison(self):
+        hotseat = "//node[@resource-id='com.android.launcher:id/hotseat']"
+        self.assertEqual(self.names(hotseat + "[node = '']"), ["com.android.launcher:id/hotseat"])
+        self.assertEqual(self.names(hotseat + "[node != 'Phone']"), ["com.android.launcher:id/hotseat"])
+        self.assertEqual(self.names(hotseat + "[node = 'Phone']"), [])  # string value of a node is not its text
+        self.assertEqual(self.names(hotseat + "['' = node]"), ["com.android.launcher:id/hotseat"])
+        self.assertEqual(self.names(hotseat + "[node = 0]"), [])
+        self.assertEqual(self.names("//node[@text='Phone'][node = '']"), [])  # empty node set
+        self.assertEqual(self.names("//node[@text='Phone'][node = false()]"), ["Phone"])
+
+    def test_compiled_lru(self):
+        from uiautomator import xpath
+        with patch.object(xpath, "COMPILED_SIZE", 2), patch.object(xpath, "_compiled", xpath._compiled.__class__()):
+            first = compile_xpath("//node[@text='1']")
+            compile_xpath("//node[@text='2']")
+            self.assertIs(compile_xpath("//node[@text='1']"), first)
+            compile_xpath("//node[@text='3']")  # evicts the least recently used '2'
+            self.assertEqual(list(xpath._compiled.keys()), ["//node[@text='1']", "//node[@text='3']"])
+            self.assertIs(compile_xpath("//node[@text='1']"), first)
+
+    def test_errors(self):
+        for expression in ["//node[", "//node[@text='a'", "//node[@unknown='a']", "//node[foo()]",
+                           "//bad::node", "//node]", "count(//node)", "//node[@text='a]"]:
+            with self.assertRaises(ValueError):
+                XPath(expression).evaluate(self.snapshot)
+
+
+class TestXPathBenchmark(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.snapshot = Hierarchy(synthetic(4000))
+
+    def test_same_as_selector(self):
+        xpath = self.snapshot.xpath("//node[@resource-id='com.example:id/row'][node[@text='Item 3999']]/node[2]")
+        selector = self.snapshot(text="Item 3999").sibling(resourceId="com.example:id/icon")
+        self.assertEqual(xpath, selector.nodes)
+        self.assertEqual(self.snapshot.xpath("//node[@text='Item 7']"), self.snapshot(text="Item 7").nodes)
+        self.assertEqual(self.snapshot.xpath("//node[starts-with(@text, 'Item 39')]"),
+                         self.snapshot(textStartsWith="Item 39").nodes)
+
+    def examined(self, queries):
+        '''results of the queries and the number of nodes tested by their steps.'''
+        nodes, original = [], _Step.test
+
+        def test(step, node):
+            nodes.append(node)
+            return original(step, node)
+        with patch.object(_Step, "test", test):
+            return [self.snapshot.xpath(query) for query in queries], len(nodes)
+
+    def test_benchmark(self):
+        queries = ["//node[@text='Item %d']/../node[@resource-id='com.example:id/icon']" % i for i in range(0, 4000, 400)]
+        indexed, indexed_count = self.examined(queries)
+        scanned, scan_count = self.examined([query.replace("[@text=", "[string(@text)=") for query in queries])
+        self.assertEqual([[n.description for n in nodes] for nodes in indexed],
+                         [["Icon %d" % i] for i in range(0, 4000, 400)])
+        self.assertEqual(indexed, scanned)
+        # "@attr='value'" predicates are looked up in the index, a scan tests every node.
+        self.assertGreaterEqual(scan_count, len(self.snapshot.nodes) * len(queries))
+        self.assertLessEqual(indexed_count, 5 * len(queries))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,16 +7,24 @@ import sys
 import os
 import subprocess
 import time
-import itertools
 import json
 import hashlib
 import socket
+import errno
 import re
 import collections
-import xml.dom.minidom
+import threading
+import contextlib
+import struct
+import tempfile
+import io
+import abc
+import atexit
+import logging
 
 DEVICE_PORT = int(os.environ.get('UIAUTOMATOR_DEVICE_PORT', '9008'))
 LOCAL_PORT = int(os.environ.get('UIAUTOMATOR_LOCAL_PORT', '9008'))
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
 
 if 'localhost' not in os.environ.get('no_proxy', ''):
     os.environ['no_proxy'] = "localhost,%s" % os.environ.get('no_proxy', '')
@@ -26,16 +34,36 @@ try:
 except ImportError:
     import urllib.request as urllib2
 try:
-    from httplib import HTTPException
+    from httplib import HTTPException, HTTPConnection, BadStatusLine
 except:
-    from http.client import HTTPException
+    from http.client import HTTPException, HTTPConnection, BadStatusLine
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
 try:
     if os.name == 'nt':
         import urllib3
 except:  # to fix python setup error on Windows.
     pass
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+try:
+    import numpy  # optional, for screenshot_array
+except ImportError:
+    numpy = None
+
+from . import hierarchy
+from .hierarchy import Hierarchy, HierarchyObject
 
 __author__ = "Xiaocong He"
+logger = logging.getLogger(__name__)
 __all__ = ["device", "Device", "rect", "point", "Selector", "JsonRPCError"]
 
 
@@ -46,6 +74,11 @@ def U(x):
         return x
 
 
+def monotonic():
+    '''seconds of a clock not affected by system time changes, time.time() on python 2.'''
+    return time.monotonic() if hasattr(time, "monotonic") else time.time()
+
+
 def param_to_property(*props, **kwprops):
     if props and kwprops:
         raise SyntaxError("Can not set both props and kwprops at the same time.")
@@ -88,6 +121,139 @@ class JsonRPCError(Exception):
         return "JsonRPC Error code: %d, Message: %s" % (self.code, self.message)
 
 
+class NoDelayHTTPConnection(HTTPConnection):
+
+    '''http connection with Nagle's algorithm disabled for small rpc requests.'''
+
+    def connect(self):
+        HTTPConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def stale_connection(error, sent):
+    '''
+    True if error shows a kept-alive connection closed by the server before it read the request:
+    a broken pipe or reset while sending it, or the connection closed with no response byte after.
+    '''
+    if isinstance(error, socket.timeout):
+        return False
+    elif isinstance(error, BadStatusLine):  # RemoteDisconnected on py3
+        return error.line in ("", "''")
+    elif not sent:
+        return getattr(error, "errno", None) in (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED, errno.ESHUTDOWN)
+    return False
+
+
+class HTTPPooledResponse(object):
+
+    '''http response of HTTPConnectionPool.
+    The connection goes back to the pool once the body is read to the end.
+    '''
+
+    def __init__(self, pool, conn, response):
+        self.__pool, self.__conn, self.__response = pool, conn, response
+        self.status = response.status
+
+    def read(self, amt=None):
+        data = self.__response.read() if amt is None else self.__response.read(amt)
+        if amt is None or not data:
+            self.close()
+        return data
+
+    def close(self):
+        if self.__conn is None:
+            return
+        if self.__response.isclosed() and not self.__response.will_close:
+            self.__pool.release(self.__conn)
+        else:
+            self.__response.close()
+            self.__conn.close()
+        self.__conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HTTPConnectionPool(object):
+
+    '''keep-alive http connections to one host:port.
+    At most maxsize idle connections are kept, connections idle for more than
+    idle_timeout seconds are dropped, and a request failing on a reused
+    connection (e.g. broken pipe after server restart) is retried once on a
+    new connection.
+    '''
+
+    def __init__(self, host, port, maxsize=4, idle_timeout=30):
+        self.host, self.port = host, port
+        self.maxsize, self.idle_timeout = maxsize, idle_timeout
+        self.__lock = threading.Lock()
+        self.__idle = collections.deque()
+
+    def __get(self, timeout):
+        now = monotonic()
+        with self.__lock:
+            while self.__idle:
+                conn, last_used = self.__idle.pop()
+                if now - last_used < self.idle_timeout:
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        return NoDelayHTTPConnection(self.host, self.port, timeout=timeout), False
+
+    def release(self, conn):
+        '''put the connection back to the pool.'''
+        with self.__lock:
+            if len(self.__idle) < self.maxsize:
+                self.__idle.append((conn, monotonic()))
+                return
+        conn.close()
+
+    def clear(self):
+        '''close all idle connections.'''
+        with self.__lock:
+            while self.__idle:
+                self.__idle.pop()[0].close()
+
+    def urlopen(self, method, url, body=None, headers=None, timeout=30):
+        '''
+        send the request and return a HTTPPooledResponse, raise urllib2.HTTPError if the status is not 2xx.
+        Only a request which found its reused connection closed by the server before anything was
+        answered is retried, a timed out or half answered request may have run and is never sent again.
+        '''
+        parts = urlsplit(url)
+        path = "%s?%s" % (parts.path or "/", parts.query) if parts.query else (parts.path or "/")
+        while True:
+            conn, reused = self.__get(timeout)
+            try:
+                try:
+                    conn.request(method, path, body, headers or {})
+                except socket.error as e:
+                    if reused and stale_connection(e, sent=False):
+                        conn.close()
+                        continue
+                    raise
+                try:
+                    response = conn.getresponse()
+                except (socket.error, HTTPException) as e:
+                    if reused and stale_connection(e, sent=True):
+                        conn.close()
+                        continue
+                    raise
+            except:
+                conn.close()
+                raise
+            res = HTTPPooledResponse(self, conn, response)
+            if not 200 <= res.status < 300:
+                fp = io.BytesIO(res.read())
+                raise urllib2.HTTPError(url, res.status, response.reason, response.msg, fp)
+            return res
+
+
 class JsonRPCMethod(object):
 
     if os.name == 'nt':
@@ -96,10 +262,18 @@ class JsonRPCMethod(object):
         except:
             pass
 
-    def __init__(self, url, method, timeout=30):
+    def __init__(self, url, method, timeout=30, pool=None):
         self.url, self.method, self.timeout = url, method, timeout
+        self.http = pool
 
     def __call__(self, *args, **kwargs):
+        jsonresult = self.post(self.request(*args, **kwargs))
+        if "error" in jsonresult and jsonresult["error"]:
+            raise self.error(jsonresult["error"])
+        return jsonresult["result"]
+
+    def request(self, *args, **kwargs):
+        '''build the json-rpc request object of this method.'''
         if args and kwargs:
             raise SyntaxError("Could not accept both *args and **kwargs as JSONRPC parameters.")
         data = {"jsonrpc": "2.0", "method": self.method, "id": self.id()}
@@ -107,31 +281,46 @@ class JsonRPCMethod(object):
             data["params"] = args
         elif kwargs:
             data["params"] = kwargs
+        return data
+
+    def post(self, data):
+        '''post the json-rpc request (or batch of requests) and return the decoded response.'''
         jsonresult = {"result": ""}
-        if os.name == "nt":
+        if self.http is not None:
+            res = self.http.urlopen("POST",
+                                    self.url,
+                                    headers={"Content-Type": "application/json"},
+                                    body=dumps(data).encode("utf-8"),
+                                    timeout=self.timeout)
+            jsonresult = json.loads(res.read().decode("utf-8"))
+        elif os.name == "nt":
             res = self.pool.urlopen("POST",
                                     self.url,
                                     headers={"Content-Type": "application/json"},
-                                    body=json.dumps(data).encode("utf-8"),
+                                    body=dumps(data).encode("utf-8"),
                                     timeout=self.timeout)
+            if not 200 <= res.status < 300:
+                raise urllib2.HTTPError(self.url, res.status, res.reason, res.headers, io.BytesIO(res.data))
             jsonresult = json.loads(res.data.decode("utf-8"))
         else:
             result = None
             try:
                 req = urllib2.Request(self.url,
-                                      json.dumps(data).encode("utf-8"),
+                                      dumps(data).encode("utf-8"),
                                       {"Content-type": "application/json"})
                 result = urllib2.urlopen(req, timeout=self.timeout)
                 jsonresult = json.loads(result.read().decode("utf-8"))
             finally:
                 if result is not None:
                     result.close()
-        if "error" in jsonresult and jsonresult["error"]:
-            raise JsonRPCError(
-                jsonresult["error"]["code"],
-                "%s: %s" % (jsonresult["error"]["data"]["exceptionTypeName"], jsonresult["error"]["message"])
-            )
-        return jsonresult["result"]
+        return jsonresult
+
+    @staticmethod
+    def error(error):
+        '''JsonRPCError from the error member of a json-rpc response.'''
+        if "data" in error and error["data"] and "exceptionTypeName" in error["data"]:
+            return JsonRPCError(error["code"], "%s: %s" % (error["data"]["exceptionTypeName"], error["message"]))
+        return JsonRPCError(error["code"], error.get("message", ""))
 
     def id(self):
         m = hashlib.md5()
@@ -139,15 +328,118 @@ class JsonRPCMethod(object):
         return m.hexdigest()
 
 
+class JsonRPCFuture(object):
+
+    '''placeholder of the result of a call queued in a JsonRPCBatch.'''
+
+    def __init__(self, method, args, kwargs):
+        self.method, self.args, self.kwargs = method, args, kwargs
+        self.__done, self.__result, self.__error = False, None, None
+
+    def set_result(self, result):
+        self.__done, self.__result = True, result
+
+    def set_error(self, error):
+        self.__done, self.__error = True, error
+
+    def done(self):
+        return self.__done
+
+    def result(self):
+        '''return the call result, or raise the JsonRPCError of the call.'''
+        if not self.__done:
+            raise RuntimeError("Batch of %s has not been sent yet." % self.method)
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
+
+
+class JsonRPCBatch(object):
+
+    '''
+    Queue json-rpc calls and send them in one json-rpc 2.0 batch request.
+    Usage:
+    with client.batch() as b:
+        exists = b.exist(Selector(text="OK"))
+        count = b.count(Selector(className="android.widget.TextView"))
+    exists.result(), count.result()
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.futures = []
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            if args and kwargs:
+                raise SyntaxError("Could not accept both *args and **kwargs as JSONRPC parameters.")
+            future = JsonRPCFuture(method, args, kwargs)
+            self.futures.append(future)
+            return future
+        return call
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+    def send(self):
+        '''send all queued calls, fall back to sequential calls if the server rejects batch.'''
+        futures, self.futures = self.futures, []
+        if not futures:
+            return futures
+        transport = self.client.method_class(self.client.url, "batch", self.client.timeout, pool=self.client.pool)
+        requests = []
+        for index, future in enumerate(futures):
+            data = JsonRPCMethod(self.client.url, future.method).request(*future.args, **future.kwargs)
+            data["id"] = index
+            requests.append(data)
+        try:
+            jsonresults = transport.post(requests)
+        except (urllib2.HTTPError, ValueError):  # error page or a body which is not json
+            jsonresults = None
+        if not isinstance(jsonresults, list):  # batch not supported by server
+            for index, future in enumerate(futures):
+                try:
+                    method = getattr(self.client, future.method)
+                    future.set_result(method(*future.args) if future.args else method(**future.kwargs))
+                except JsonRPCError as e:
+                    future.set_error(e)
+                except Exception as e:  # the server is gone, so are the results of the left calls
+                    for left in futures[index:]:
+                        left.set_error(e)
+                    raise
+            return futures
+        responses = dict((r.get("id"), r) for r in jsonresults if isinstance(r, dict))
+        for index, future in enumerate(futures):
+            response = responses.get(index)
+            if response is None:
+                future.set_error(JsonRPCError(-32603, "No response for %s in batch." % future.method))
+            elif "error" in response and response["error"]:
+                future.set_error(JsonRPCMethod.error(response["error"]))
+            else:
+                future.set_result(response.get("result"))
+        return futures
+
+
 class JsonRPCClient(object):
 
-    def __init__(self, url, timeout=30, method_class=JsonRPCMethod):
+    def __init__(self, url, timeout=30, method_class=JsonRPCMethod, pool=None):
         self.url = url
         self.timeout = timeout
         self.method_class = method_class
+        self.pool = pool
 
     def __getattr__(self, method):
-        return self.method_class(self.url, method, timeout=self.timeout)
+        if self.pool is None:
+            return self.method_class(self.url, method, timeout=self.timeout)
+        return self.method_class(self.url, method, timeout=self.timeout, pool=self.pool)
+
+    def batch(self):
+        '''queue calls and send them in one round-trip, see JsonRPCBatch.'''
+        return JsonRPCBatch(self)
 
 
 class Selector(dict):
@@ -203,9 +495,7 @@ class Selector(dict):
             super(Selector, self).__setitem__(self.__mask, self[self.__mask] & ~self.__fields[k][0])
 
     def clone(self):
-        kwargs = dict((k, self[k]) for k in self
-                      if k not in [self.__mask, self.__childOrSibling, self.__childOrSiblingSelector])
-        selector = Selector(**kwargs)
+        selector = Selector(**self.fields())
         for v in self[self.__childOrSibling]:
             selector[self.__childOrSibling].append(v)
         for s in self[self.__childOrSiblingSelector]:
@@ -224,6 +514,218 @@ class Selector(dict):
 
     child_selector, from_parent = child, sibling
 
+    def fields(self):
+        '''the selector fields, without mask and child selectors.'''
+        return dict((k, v) for k, v in self.items()
+                    if k not in [self.__mask, self.__childOrSibling, self.__childOrSiblingSelector])
+
+    def freeze(self):
+        '''immutable and hashable copy of the selector, see FrozenSelector.'''
+        return FrozenSelector.of(self)
+
+
+class _FrozenList(list):
+
+    '''list which can not be changed, still equal to and serialized as a list.'''
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError("FrozenSelector can not be changed.")
+
+    append = extend = insert = remove = pop = sort = reverse = __setitem__ = __delitem__ = __iadd__ = __readonly
+    __setslice__ = __delslice__ = __readonly  # python 2
+
+
+class FrozenSelector(Selector):
+
+    '''
+    Immutable and hashable Selector. child() and sibling() return new selectors sharing the
+    child selectors of this one, and the json of the selector is built once and reused by
+    every rpc call, so a selector reused in a loop costs neither clone nor serialization.
+    Usage:
+    ok = Selector(text="OK").freeze()  # or FrozenSelector(text="OK")
+    while d(ok).exists:
+        d(ok).click()
+    '''
+
+    def __init__(self, _relations=(), _selectors=(), **kwargs):
+        '''kwargs are the selector fields, _relations/_selectors its (frozen) child selectors.'''
+        self.__frozen = False
+        super(FrozenSelector, self).__init__(**kwargs)
+        self.__freeze(_relations, _selectors)
+
+    @classmethod
+    def of(cls, selector):
+        '''frozen copy of a Selector, its child selectors are frozen too.'''
+        if isinstance(selector, FrozenSelector):
+            return selector
+        return cls(selector["childOrSibling"], [cls.of(s) for s in selector["childOrSiblingSelector"]],
+                   **selector.fields())
+
+    def __freeze(self, relations, selectors):
+        dict.__setitem__(self, "childOrSibling", _FrozenList(relations))
+        dict.__setitem__(self, "childOrSiblingSelector", _FrozenList(selectors))
+        head = json.dumps(dict((k, v) for k, v in self.items() if k != "childOrSiblingSelector"), sort_keys=True)
+        self.json = '%s, "childOrSiblingSelector": [%s]}' % (head[:-1], ", ".join(s.json for s in selectors))
+        self.__hash = hash(self.json)
+        self.__frozen = True
+
+    def __setitem__(self, k, v):
+        if self.__frozen:
+            raise TypeError("FrozenSelector can not be changed.")
+        super(FrozenSelector, self).__setitem__(k, v)
+
+    def __delitem__(self, k):
+        raise TypeError("FrozenSelector can not be changed.")
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError("FrozenSelector can not be changed.")
+
+    clear = pop = popitem = setdefault = update = __readonly
+
+    def __hash__(self):
+        return self.__hash
+
+    def __extend(self, relation, kwargs):
+        return FrozenSelector(self["childOrSibling"] + [relation],
+                              self["childOrSiblingSelector"] + [FrozenSelector(**kwargs)], **self.fields())
+
+    def child(self, **kwargs):
+        '''new frozen selector with one more child selector.'''
+        return self.__extend("child", kwargs)
+
+    def sibling(self, **kwargs):
+        '''new frozen selector with one more sibling selector.'''
+        return self.__extend("sibling", kwargs)
+
+    child_selector, from_parent = child, sibling
+
+    def clone(self):
+        '''mutable Selector sharing the (frozen) child selectors, no deep copy.'''
+        selector = Selector(**self.fields())
+        selector["childOrSibling"].extend(self["childOrSibling"])
+        selector["childOrSiblingSelector"].extend(self["childOrSiblingSelector"])
+        return selector
+
+    def freeze(self):
+        return self
+
+    def __reduce__(self):
+        return _frozen_selector, (self.fields(), list(self["childOrSibling"]), list(self["childOrSiblingSelector"]))
+
+
+def _frozen_selector(fields, relations, selectors):
+    '''unpickle a FrozenSelector.'''
+    return FrozenSelector(relations, selectors, **fields)
+
+
+def dumps(obj):
+    '''json.dumps, reusing the json built once by FrozenSelector.'''
+    if isinstance(obj, FrozenSelector):
+        return obj.json
+    elif isinstance(obj, Selector):
+        if not any(isinstance(s, FrozenSelector) for s in obj["childOrSiblingSelector"]):
+            return json.dumps(obj)
+        head = json.dumps(dict((k, v) for k, v in obj.items() if k != "childOrSiblingSelector"))
+        return '%s, "childOrSiblingSelector": [%s]}' % (
+            head[:-1], ", ".join(dumps(s) for s in obj["childOrSiblingSelector"]))
+    elif isinstance(obj, (list, tuple)):
+        return "[%s]" % ", ".join(dumps(v) for v in obj)
+    elif isinstance(obj, dict):
+        return "{%s}" % ", ".join("%s: %s" % (json_key(k), dumps(v)) for k, v in obj.items())
+    return json.dumps(obj)
+
+
+def json_key(key):
+    '''json of a dict key, coerced to a string like json.dumps does, e.g. 1 -> "1", None -> "null".'''
+    if key is None or isinstance(key, (bool, int, float)) or type(key).__name__ == "long":
+        key = json.dumps(key)
+    elif not isinstance(key, (str, type(u""))):
+        raise TypeError("keys must be str, int, float, bool or None, not %s" % type(key).__name__)
+    return json.dumps(key)
+
+
+def copy_chunks(read, write, chunk_size=hierarchy.CHUNK_SIZE):
+    '''write(chunk) every chunk of read(chunk_size) until it returns nothing, return the number of bytes.'''
+    size = 0
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            return size
+        write(chunk)
+        size += len(chunk)
+
+
+def call_selector(selector, kwargs):
+    '''selector of d(selector) or d(**kwargs), the only positional argument must be a Selector.'''
+    if selector is None:
+        return Selector(**kwargs)
+    elif not isinstance(selector, Selector):
+        raise TypeError("Selector or selector keyword arguments expected, got %r." % (selector,))
+    elif kwargs:
+        raise TypeError("Selector and selector keyword arguments can not be mixed.")
+    return selector
+
+
+def wait_selector(arg):
+    '''Selector of an argument of d.wait.any/all/gone_all.'''
+    if isinstance(arg, Selector):
+        return arg
+    elif isinstance(arg, dict):
+        return Selector(**arg)
+    elif isinstance(getattr(arg, "selector", None), Selector):  # ui object
+        return arg.selector
+    raise TypeError("Not a selector: %r" % (arg,))
+
+
+def wait_condition(action, snapshot, selectors):
+    '''
+    (done, result) of d.wait.any/all/gone_all on one snapshot, selectors are [(argument, Selector)].
+    any returns the first argument found, or None; all and gone_all return True or False.
+    '''
+    if action == "any":
+        for arg, selector in selectors:
+            if snapshot(selector).exists:
+                return True, arg
+        return False, None
+    elif action == "all":
+        done = all(snapshot(selector).exists for _, selector in selectors)
+    else:
+        done = not any(snapshot(selector).exists for _, selector in selectors)
+    return done, done
+
+
+def stable_digest(snapshot, image=None):
+    '''digest of a hierarchy snapshot and the bytes of a down-scaled screenshot if any.'''
+    return (snapshot.digest, hashlib.md5(image).hexdigest() if image else None)
+
+
+def stable_poll(window_ms, timeout):
+    '''
+    generator of d.wait.stable, yields the seconds to sleep before sending the next digest,
+    polling fast right after a change and backing off while the screen stays still.
+    It ends with the ms from the first digest to the last change once a digest is unchanged
+    for window_ms, or None if none was by timeout ms.
+    '''
+    window, deadline = window_ms / 1000.0, monotonic() + timeout / 1000.0
+    first, last, changed, delay = None, None, None, 0.0
+    while True:
+        digest = yield delay
+        now = monotonic()
+        if first is None:
+            first, last, changed, delay = now, digest, now, 0.05
+        elif digest != last:
+            last, changed, delay = digest, now, 0.05
+        elif now - changed >= window:
+            yield int(round((changed - first) * 1000))
+            return
+        else:
+            delay = min(delay * 2, 1.0)
+        if now >= deadline:
+            yield None
+            return
+        # wake up when the window would be complete, never after the deadline
+        delay = max(min(delay, changed + window - now, deadline - now), 0.0)
+
 
 def rect(top=0, left=0, bottom=100, right=100):
     return {"top": top, "left": left, "bottom": bottom, "right": right}
@@ -241,9 +743,496 @@ def point(x=0, y=0):
     return {"x": x, "y": y}
 
 
+class AdbSocketProcess(object):
+
+    '''Popen-like handle of a request to the adb server running in a background thread.'''
+
+    def __init__(self, target, *args):
+        self.returncode = None
+        self.__out, self.__err, self.__sock, self.__killed = [], b"", None, False
+        self.__lock = threading.Lock()
+        self.__thread = threading.Thread(target=self.__run, args=(target,) + args)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __run(self, target, *args):
+        returncode = 0
+        try:
+            returncode = target(self, *args) or 0
+        except Exception as e:
+            self.__err = str(e).encode("utf-8")
+            returncode = 1
+        finally:
+            if self.__sock is not None:
+                self.__sock.close()
+        self.returncode = -9 if self.__killed else returncode
+
+    def attach(self, sock):
+        '''socket to close on kill().'''
+        with self.__lock:
+            self.__sock = sock
+            if self.__killed:
+                self.__shutdown(sock)
+
+    def write(self, data):
+        self.__out.append(data)
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.__thread.join()
+        return self.returncode
+
+    def communicate(self):
+        self.wait()
+        return b"".join(self.__out), self.__err
+
+    def kill(self):
+        with self.__lock:
+            self.__killed = True
+            if self.__sock is not None:
+                self.__shutdown(self.__sock)
+
+    @staticmethod
+    def __shutdown(sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+class AdbClient(object):
+
+    '''client of the adb server protocol, talking to adb_server_host:adb_server_port
+    directly instead of spawning the adb binary.
+    '''
+
+    def __init__(self, host="localhost", port=5037, timeout=10):
+        self.host, self.port, self.timeout = host, int(port), timeout
+        self.__first = threading.local()  # connection popen() made for the first request of its thread
+
+    def connect(self):
+        sock = getattr(self.__first, "sock", None)
+        if sock is not None:
+            self.__first.sock = None
+            return sock
+        return socket.create_connection((self.host, self.port), self.timeout)
+
+    @staticmethod
+    def recv(sock, size):
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise EnvironmentError("adb server closed the connection.")
+            data += chunk
+        return data
+
+    def request(self, sock, request):
+        '''send a service request and check the OKAY/FAIL status.'''
+        request = request.encode("utf-8")
+        sock.sendall(("%04x" % len(request)).encode("ascii") + request)
+        status = self.recv(sock, 4)
+        if status == b"FAIL":
+            raise EnvironmentError("adb: %s" % self.message(sock))
+        elif status != b"OKAY":
+            raise EnvironmentError("adb: unexpected status %r." % status)
+
+    def message(self, sock):
+        '''read a hex length-prefixed message.'''
+        return self.recv(sock, int(self.recv(sock, 4), 16)).decode("utf-8")
+
+    def query(self, request):
+        '''host service returning a length-prefixed message, e.g. host:devices.'''
+        sock = self.connect()
+        try:
+            self.request(sock, request)
+            return self.message(sock)
+        finally:
+            sock.close()
+
+    def devices(self):
+        return self.query("host:devices")
+
+    def version(self):
+        return int(self.query("host:version"), 16)
+
+    def forward_list(self):
+        return self.query("host:list-forward")
+
+    def forward(self, serial, local, remote):
+        sock = self.connect()
+        try:
+            prefix = "host-serial:%s" % serial if serial else "host"
+            self.request(sock, "%s:forward:%s;%s" % (prefix, local, remote))
+            if self.recv(sock, 4) == b"FAIL":  # second status once the forward is set up
+                raise EnvironmentError("adb: %s" % self.message(sock))
+        finally:
+            sock.close()
+
+    def transport(self, serial):
+        '''socket connected to the device transport.'''
+        sock = self.connect()
+        try:
+            self.request(sock, "host:transport:%s" % serial if serial else "host:transport-any")
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def shell(self, serial, command):
+        '''socket streaming the output of the shell command.'''
+        sock = self.transport(serial)
+        try:
+            self.request(sock, "shell:%s" % command)
+        except:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock
+
+    def exec_out(self, serial, command):
+        '''socket streaming the raw output of the command, no pty mangling of binary data.'''
+        sock = self.transport(serial)
+        try:
+            self.request(sock, "exec:%s" % command)
+        except:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock
+
+    def sync(self, serial):
+        sock = self.transport(serial)
+        try:
+            self.request(sock, "sync:")
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def sync_status(self, sock):
+        status, length = struct.unpack("<4sI", self.recv(sock, 8))
+        if status == b"FAIL":
+            raise EnvironmentError("adb: %s" % self.recv(sock, length).decode("utf-8"))
+        elif status != b"OKAY":
+            raise EnvironmentError("adb: unexpected sync status %r." % status)
+
+    def push(self, serial, filename, remote, mode=0o644):
+        sock = self.sync(serial)
+        try:
+            path = ("%s,%d" % (remote, mode)).encode("utf-8")
+            sock.sendall(struct.pack("<4sI", b"SEND", len(path)) + path)
+            with open(filename, "rb") as f:
+                while True:
+                    chunk = f.read(64 * 1024)
+                    if not chunk:
+                        break
+                    sock.sendall(struct.pack("<4sI", b"DATA", len(chunk)) + chunk)
+            sock.sendall(struct.pack("<4sI", b"DONE", int(os.path.getmtime(filename))))
+            self.sync_status(sock)
+            sock.sendall(struct.pack("<4sI", b"QUIT", 0))
+        finally:
+            sock.close()
+
+    def pull(self, serial, remote, filename):
+        sock = self.sync(serial)
+        try:
+            path = remote.encode("utf-8")
+            sock.sendall(struct.pack("<4sI", b"RECV", len(path)) + path)
+            with open(filename, "wb") as f:
+                while True:
+                    status, length = struct.unpack("<4sI", self.recv(sock, 8))
+                    if status == b"DATA":
+                        f.write(self.recv(sock, length))
+                    elif status == b"DONE":
+                        break
+                    elif status == b"FAIL":
+                        raise EnvironmentError("adb: %s" % self.recv(sock, length).decode("utf-8"))
+                    else:
+                        raise EnvironmentError("adb: unexpected sync status %r." % status)
+            sock.sendall(struct.pack("<4sI", b"QUIT", 0))
+        finally:
+            sock.close()
+
+    def popen(self, serial, args):
+        '''
+        AdbSocketProcess running the adb command line args, or None if it is not supported.
+        the connection of its first request is made here, socket.error if the adb server is not reachable.
+        '''
+        command = self.__command(serial, list(args))
+        if command is None:
+            return None
+        return AdbSocketProcess(self.__connected, self.connect(), *command)
+
+    def __connected(self, process, sock, target, *args):
+        '''run target(process, *args) in the process thread, its first connect() returns sock.'''
+        self.__first.sock = sock
+        try:
+            return target(process, *args)
+        finally:
+            if self.__first.sock is not None:  # not used
+                self.__first.sock.close()
+                self.__first.sock = None
+
+    def __command(self, serial, args):
+        '''(target, *args) of the AdbSocketProcess running the command line args, None if not supported.'''
+        if not args:
+            return None
+        name, args = args[0], args[1:]
+        if name == "devices" and not args:
+            return self.__output, lambda: "List of devices attached\n%s\n" % self.devices()
+        elif name == "version" and not args:
+            return self.__output, lambda: "Android Debug Bridge version 1.0.%d\n" % self.version()
+        elif name == "forward" and args == ["--list"]:
+            return self.__output, self.forward_list
+        elif name == "forward" and len(args) == 2:
+            return (lambda p: self.forward(serial, *args),)
+        elif name == "shell" and args:
+            return self.__shell, serial, " ".join(args)
+        elif name == "push" and len(args) == 2:
+            local, remote = args
+            if remote.endswith("/"):
+                remote += os.path.basename(local)
+            return (lambda p: self.push(serial, local, remote),)
+        elif name == "pull" and len(args) == 2:
+            return (lambda p: self.pull(serial, *args),)
+        elif name == "install" and args:
+            return self.__install, serial, args[-1], " ".join(args[:-1])
+        return None
+
+    def __output(self, process, fn):
+        process.write(fn().encode("utf-8"))
+
+    def __shell(self, process, serial, command, write=None):
+        '''stream the output of the command and return its exit status.
+
+        the shell service has no exit status, the command echoes it as a last ":<status>" line.
+        '''
+        write = write or process.write
+        sock = self.shell(serial, "%s; echo :$?" % command)
+        process.attach(sock)
+        pending = b""
+        while True:
+            try:
+                data = sock.recv(64 * 1024)
+            except socket.error:
+                break
+            if not data:
+                break
+            pending += data
+            index = pending.rfind(b"\n", 0, len(pending) - 1)  # hold back the last line
+            if index >= 0:
+                write(pending[:index + 1])
+                pending = pending[index + 1:]
+        output, sep, status = pending.rstrip(b"\r\n").rpartition(b":")
+        if sep and status.isdigit():
+            write(output)
+            return int(status)
+        write(pending)  # killed or disconnected before the status was echoed
+        return 1
+
+    def __install(self, process, serial, filename, options):
+        remote = "/data/local/tmp/%s" % os.path.basename(filename)
+        self.push(serial, filename, remote)
+        out = []
+        try:
+            returncode = self.__shell(process, serial, "pm install %s %s" % (options, remote), out.append)
+        finally:
+            self.shell(serial, "rm %s" % remote).close()
+        output = b"".join(out)
+        process.write(output)
+        if b"Success" not in output:
+            failure = [line for line in output.decode("utf-8", "replace").splitlines() if "Failure" in line]
+            raise EnvironmentError(failure[-1] if failure else "pm install exited with %s." % returncode)
+
+
+class AdbDeviceTracker(object):
+
+    '''
+    Live table of devices attached to an adb server, kept up to date from the
+    host:track-devices stream in a background thread. Adb instances of the same
+    adb server answer devices() from the table while the tracker is running.
+    Usage:
+    tracker = Adb().track_devices()
+    @tracker.on_detach
+    def detached(serial, state):
+        ...
+    '''
+
+    __trackers = {}
+    __trackers_lock = threading.Lock()
+
+    def __init__(self, host="localhost", port=5037, reconnect_interval=1):
+        self.client = AdbClient(host, port)
+        self.reconnect_interval = reconnect_interval
+        self.__devices = {}
+        self.__lock = threading.Lock()
+        self.__ready = threading.Event()
+        self.__stopped = threading.Event()
+        self.__attach_callbacks, self.__detach_callbacks = [], []
+        self.__sock, self.__thread = None, None
+
+    @classmethod
+    def get(cls, host="localhost", port=5037):
+        '''the shared tracker of the adb server, started on first use.'''
+        key = (str(host), int(port))
+        with cls.__trackers_lock:
+            if key not in cls.__trackers:
+                cls.__trackers[key] = cls(*key).start()
+            return cls.__trackers[key]
+
+    @classmethod
+    def running(cls, host="localhost", port=5037):
+        '''the shared tracker of the adb server if it is running, else None.'''
+        return cls.__trackers.get((str(host), int(port)))
+
+    def start(self):
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__stopped.set()
+        with self.__lock:
+            if self.__sock is not None:
+                try:
+                    self.__sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        with self.__trackers_lock:
+            for key, tracker in list(self.__trackers.items()):
+                if tracker is self:
+                    del self.__trackers[key]
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def on_attach(self, fn):
+        '''register fn(serial, state) called when a device appears or changes its state.'''
+        self.__attach_callbacks.append(fn)
+        return fn
+
+    def on_detach(self, fn):
+        '''register fn(serial, state) called when a device disappears, with its last state.'''
+        self.__detach_callbacks.append(fn)
+        return fn
+
+    def devices(self, timeout=5):
+        '''dict of attached devices like Adb.devices(), None if the table is not available.'''
+        if not self.__ready.wait(timeout):
+            return None
+        with self.__lock:
+            return dict(self.__devices)
+
+    def __run(self):
+        while not self.__stopped.is_set():
+            try:
+                sock = self.client.connect()
+                with self.__lock:
+                    self.__sock = sock
+                if self.__stopped.is_set():
+                    break
+                self.client.request(sock, "host:track-devices")
+                sock.settimeout(None)
+                while True:
+                    self.__update(self.client.message(sock))
+                    self.__ready.set()
+            except (socket.error, EnvironmentError, ValueError):
+                pass
+            finally:
+                with self.__lock:
+                    if self.__sock is not None:
+                        self.__sock.close()
+                        self.__sock = None
+            # the table is unavailable until reconnected, the first snapshot is compared to the last one.
+            self.__ready.clear()
+            self.__stopped.wait(self.reconnect_interval)
+        with self.__lock:
+            self.__devices = {}
+
+    def __update(self, message):
+        devices = dict(line.split("\t", 1) for line in message.splitlines() if "\t" in line)
+        with self.__lock:
+            previous, self.__devices = self.__devices, devices
+        for serial, state in previous.items():
+            if serial not in devices:
+                self.__notify(self.__detach_callbacks, serial, state)
+        for serial, state in devices.items():
+            if previous.get(serial) != state:
+                self.__notify(self.__attach_callbacks, serial, state)
+
+    @staticmethod
+    def __notify(callbacks, serial, state):
+        '''call every callback, an error of one is logged, it must not stop the tracker thread.'''
+        for fn in callbacks:
+            try:
+                fn(serial, state)
+            except Exception:
+                logger.exception("device tracker callback %r failed for %s.", fn, serial)
+
+
+class AdbMetadataCache(object):
+
+    '''
+    process wide cache of adb and device metadata shared by all Adb and AutomatorServer objects.
+    Keys are tuples like ("version", host, port) or ("props", host, port, serial),
+    entries expire after the ttl of their kind in seconds, None to never expire.
+    '''
+
+    ttl = {
+        "adb": None,  # adb executable, keyed by $ANDROID_HOME, $PATH and os.name
+        "version": 300,  # adb server version
+        "forward_list": 10,  # forward table, invalidated by Adb.forward as well
+        "sdk": 3600,
+        "props": 3600  # ro.* properties of device
+    }
+
+    def __init__(self):
+        self.__entries = {}
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        '''cached value of key, raise KeyError if missing or expired.'''
+        with self.__lock:
+            value, expires = self.__entries[key]
+            if expires is not None and expires < monotonic():
+                del self.__entries[key]
+                raise KeyError(key)
+            return value
+
+    def set(self, key, value):
+        ttl = self.ttl.get(key[0])
+        with self.__lock:
+            self.__entries[key] = (value, None if ttl is None else monotonic() + ttl)
+        return value
+
+    def cached(self, key, fn):
+        '''cached value of key, or the result of fn() which is cached unless it raises.'''
+        try:
+            return self.get(key)
+        except KeyError:
+            return self.set(key, fn())
+
+    def invalidate(self, *prefix):
+        '''remove entries whose key starts with prefix, e.g. invalidate("props", host, port, serial).'''
+        with self.__lock:
+            for key in [k for k in self.__entries if k[:len(prefix)] == prefix]:
+                del self.__entries[key]
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+
+adb_metadata = AdbMetadataCache()
+
+
 class Adb(object):
 
-    def __init__(self, serial=None, adb_server_host=None, adb_server_port=None):
+    def __init__(self, serial=None, adb_server_host=None, adb_server_port=None, backend=None):
         self.__adb_cmd = None
         self.default_serial = serial if serial else os.environ.get("ANDROID_SERIAL", None)
         self.adb_server_host = str(adb_server_host if adb_server_host else 'localhost')
@@ -253,27 +1242,40 @@ class Adb(object):
             self.adbHostPortOptions += ["-H", self.adb_server_host]
         if self.adb_server_port != '5037':
             self.adbHostPortOptions += ["-P", self.adb_server_port]
+        # "socket" talks to the adb server directly, "subprocess" runs the adb binary.
+        self.backend = backend or os.environ.get("UIAUTOMATOR_ADB_BACKEND", "subprocess")
+        self.client = AdbClient(self.adb_server_host, self.adb_server_port)
 
     def adb(self):
         if self.__adb_cmd is None:
-            if "ANDROID_HOME" in os.environ:
-                filename = "adb.exe" if os.name == 'nt' else "adb"
-                adb_cmd = os.path.join(os.environ["ANDROID_HOME"], "platform-tools", filename)
-                if not os.path.exists(adb_cmd):
-                    raise EnvironmentError(
-                        "Adb not found in $ANDROID_HOME path: %s." % os.environ["ANDROID_HOME"])
-            else:
-                import distutils
-                if "spawn" not in dir(distutils):
-                    import distutils.spawn
-                adb_cmd = distutils.spawn.find_executable("adb")
-                if adb_cmd:
-                    adb_cmd = os.path.realpath(adb_cmd)
-                else:
-                    raise EnvironmentError("$ANDROID_HOME environment not set.")
+            key = ("adb", os.environ.get("ANDROID_HOME"), os.environ.get("PATH"), os.name)
+            try:
+                adb_cmd = adb_metadata.get(key)
+                if not os.path.exists(adb_cmd):  # adb moved or removed since cached
+                    raise KeyError(key)
+            except KeyError:
+                adb_cmd = adb_metadata.set(key, self.__find_adb())
             self.__adb_cmd = adb_cmd
         return self.__adb_cmd
 
+    def __find_adb(self):
+        if "ANDROID_HOME" in os.environ:
+            filename = "adb.exe" if os.name == 'nt' else "adb"
+            adb_cmd = os.path.join(os.environ["ANDROID_HOME"], "platform-tools", filename)
+            if not os.path.exists(adb_cmd):
+                raise EnvironmentError(
+                    "Adb not found in $ANDROID_HOME path: %s." % os.environ["ANDROID_HOME"])
+        else:
+            import distutils
+            if "spawn" not in dir(distutils):
+                import distutils.spawn
+            adb_cmd = distutils.spawn.find_executable("adb")
+            if adb_cmd:
+                adb_cmd = os.path.realpath(adb_cmd)
+            else:
+                raise EnvironmentError("$ANDROID_HOME environment not set.")
+        return adb_cmd
+
     def cmd(self, *args, **kwargs):
         '''adb command, add -s serial by default. return the subprocess.Popen object.'''
         serial = self.device_serial()
@@ -286,11 +1288,43 @@ class Adb(object):
 
     def raw_cmd(self, *args):
         '''adb command. return the subprocess.Popen object.'''
+        if self.backend == "socket":
+            serial, cmd_args = None, list(args)
+            if cmd_args[:1] == ["-s"]:
+                serial, cmd_args = cmd_args[1].strip("'"), cmd_args[2:]
+            try:
+                process = self.client.popen(serial, cmd_args)
+            except socket.error:  # fall back to adb binary, which starts adb server if needed.
+                process = None
+            if process is not None:
+                return process
         cmd_line = [self.adb()] + self.adbHostPortOptions + list(args)
         if os.name != "nt":
             cmd_line = [" ".join(cmd_line)]
         return subprocess.Popen(cmd_line, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
+    def exec_out(self, out, *args):
+        '''
+        adb exec-out, copy the output of the device command args to the writable file object out
+        chunk by chunk. return the number of bytes, raise EnvironmentError if the command failed.
+        '''
+        if self.backend == "socket":
+            try:
+                sock = self.client.exec_out(self.device_serial(), " ".join(args))
+            except socket.error:  # fall back to adb binary, which starts adb server if needed.
+                pass
+            else:
+                try:
+                    return copy_chunks(sock.recv, out.write)
+                finally:
+                    sock.close()
+        p = self.cmd("exec-out", *args)
+        size = copy_chunks(p.stdout.read, out.write)
+        err = p.stderr.read()
+        if p.wait() != 0:
+            raise EnvironmentError("adb exec-out %s failed: %s" % (" ".join(args), err.decode("utf-8", "replace").strip()))
+        return size
+
     def device_serial(self):
         if not self.default_serial:
             devices = self.devices()
@@ -303,8 +1337,17 @@ class Adb(object):
                 raise EnvironmentError("Device not attached.")
         return self.default_serial
 
+    def track_devices(self):
+        '''start (or get) the device tracker of the adb server, devices() is answered from it afterwards.'''
+        return AdbDeviceTracker.get(self.adb_server_host, self.adb_server_port)
+
     def devices(self):
         '''get a dict of attached devices. key is the device serial, value is device name.'''
+        tracker = AdbDeviceTracker.running(self.adb_server_host, self.adb_server_port)
+        if tracker is not None:
+            devices = tracker.devices(timeout=1)
+            if devices is not None:
+                return devices
         out = self.raw_cmd("devices").communicate()[0].decode("utf-8")
         match = "List of devices attached"
         index = out.find(match)
@@ -314,25 +1357,65 @@ class Adb(object):
 
     def forward(self, local_port, device_port):
         '''adb port forward. return 0 if success, else non-zero.'''
-        return self.cmd("forward", "tcp:%d" % local_port, "tcp:%d" % device_port).wait()
+        try:
+            return self.cmd("forward", "tcp:%d" % local_port, "tcp:%d" % device_port).wait()
+        finally:
+            adb_metadata.invalidate("forward_list", self.adb_server_host, self.adb_server_port)
 
     def forward_list(self):
         '''adb forward --list'''
         version = self.version()
         if int(version[1]) <= 1 and int(version[2]) <= 0 and int(version[3]) < 31:
             raise EnvironmentError("Low adb version.")
-        lines = self.raw_cmd("forward", "--list").communicate()[0].decode("utf-8").strip().splitlines()
-        return [line.strip().split() for line in lines]
+
+        def forward_list():
+            lines = self.raw_cmd("forward", "--list").communicate()[0].decode("utf-8").strip().splitlines()
+            return [line.strip().split() for line in lines]
+        forwards = adb_metadata.cached(("forward_list", self.adb_server_host, self.adb_server_port), forward_list)
+        return [list(forward) for forward in forwards]
 
     def version(self):
         '''adb version'''
-        match = re.search(r"(\d+)\.(\d+)\.(\d+)", self.raw_cmd("version").communicate()[0].decode("utf-8"))
-        return [match.group(i) for i in range(4)]
+        def version():
+            match = re.search(r"(\d+)\.(\d+)\.(\d+)", self.raw_cmd("version").communicate()[0].decode("utf-8"))
+            return [match.group(i) for i in range(4)]
+        return list(adb_metadata.cached(("version", self.adb_server_host, self.adb_server_port), version))
+
+    def getprop(self, name=None):
+        '''
+        device property by name, or dict of all properties if name is None.
+        ro.* properties are read once and cached, others are read from device every time.
+        '''
+        if name is not None and not name.startswith("ro."):
+            return self.cmd("shell", "getprop", name).communicate()[0].decode("utf-8").strip()
+
+        def props():
+            out = self.cmd("shell", "getprop").communicate()[0].decode("utf-8")
+            props = dict(re.findall(r"^\[([^\]]+)\]: \[(.*)\]\s*$", out, re.M))
+            if not props:
+                raise EnvironmentError("getprop failed: %s" % out.strip())
+            return props
+        if name is None:
+            return props()
+        key = ("props", self.adb_server_host, self.adb_server_port, self.device_serial())
+        ro_props = adb_metadata.cached(key, lambda: dict((k, v) for k, v in props().items() if k.startswith("ro.")))
+        return ro_props.get(name, "")
+
+    def invalidate(self):
+        '''forget cached metadata of the adb server and the device.'''
+        adb_metadata.invalidate("version", self.adb_server_host, self.adb_server_port)
+        adb_metadata.invalidate("forward_list", self.adb_server_host, self.adb_server_port)
+        if self.default_serial:
+            adb_metadata.invalidate("props", self.adb_server_host, self.adb_server_port, self.default_serial)
+            adb_metadata.invalidate("sdk", self.adb_server_host, self.adb_server_port, self.default_serial)
 
 
 _init_local_port = LOCAL_PORT - 1
 
 
+_local_port_lock = threading.Lock()
+
+
 def next_local_port(adbHost=None):
     def is_port_listening(port):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -340,10 +1423,159 @@ def next_local_port(adbHost=None):
         s.close()
         return result == 0
     global _init_local_port
-    _init_local_port = _init_local_port + 1 if _init_local_port < 32764 else LOCAL_PORT
-    while is_port_listening(_init_local_port):
-        _init_local_port += 1
-    return _init_local_port
+    with _local_port_lock:
+        _init_local_port = _init_local_port + 1 if _init_local_port < 32764 else LOCAL_PORT
+        while is_port_listening(_init_local_port):
+            _init_local_port += 1
+        return _init_local_port
+
+
+def runtime_dir():
+    '''directory for state shared by all uiautomator processes of the user on this host.'''
+    if os.environ.get("UIAUTOMATOR_RUNTIME_DIR"):
+        return os.environ["UIAUTOMATOR_RUNTIME_DIR"]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "uiautomator")
+    user = os.getuid() if hasattr(os, "getuid") else os.environ.get("USERNAME", "default")
+    return os.path.join(tempfile.gettempdir(), "uiautomator-%s" % user)
+
+
+class LocalPortAllocator(object):
+
+    '''
+    allocate local ports for adb forward, one per device serial and adb server host.
+    Ports are recorded in a registry file under runtime_dir(), locked for every change,
+    so threads and processes on the same host never pick the same port.
+    '''
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.__lock = threading.Lock()
+
+    @property
+    def registry(self):
+        return os.path.join(self.directory or runtime_dir(), "ports.json")
+
+    def reserve(self, serial, host=None, port=None):
+        '''reserve port (e.g. already forwarded for the device) or a free one for serial. return the port.'''
+        with self.__locked() as ports:
+            if port is None:
+                for _ in range(32765 - LOCAL_PORT):
+                    port = next_local_port(host)
+                    if "%s:%d" % (host or "localhost", port) not in ports:
+                        break
+                else:
+                    raise EnvironmentError("No free local port.")
+            owner = ports.get("%s:%d" % (host or "localhost", port))
+            if owner is not None and owner["pid"] != os.getpid():
+                if owner["serial"] != (serial if serial is None else str(serial)):
+                    raise EnvironmentError("Local port %d is reserved for device %s by process %d." %
+                                           (port, owner["serial"], owner["pid"]))
+                return port  # forward of the same device shared with another process, which still owns it.
+            ports["%s:%d" % (host or "localhost", port)] = {
+                "serial": serial if serial is None else str(serial),
+                "host": str(host or "localhost"),
+                "pid": os.getpid()
+            }
+        return port
+
+    def release(self, port, host=None):
+        '''release the port reserved by this process.'''
+        key = "%s:%d" % (host or "localhost", port)
+        with self.__locked() as ports:
+            if key in ports and ports[key]["pid"] == os.getpid():
+                del ports[key]
+
+    def release_all(self):
+        '''release all ports reserved by this process.'''
+        if not os.path.exists(self.registry):
+            return
+        with self.__locked() as ports:
+            for key in [k for k, owner in ports.items() if owner["pid"] == os.getpid()]:
+                del ports[key]
+
+    def reserved(self):
+        '''dict of "host:port" to {"serial", "host", "pid"} of all live reservations.'''
+        with self.__locked() as ports:
+            return dict(ports)
+
+    @contextlib.contextmanager
+    def __locked(self):
+        '''yield the reservations of live processes, saved back if changed, under thread and file lock.'''
+        with self.__lock:
+            registry = self.registry
+            if not os.path.isdir(os.path.dirname(registry)):
+                try:
+                    os.makedirs(os.path.dirname(registry), 0o700)
+                except OSError:
+                    pass  # created by another process
+            with open(registry + ".lock", "a+b") as lock_file:
+                _lock_file(lock_file, True)
+                try:
+                    try:
+                        with open(registry) as f:
+                            ports = json.load(f)
+                    except (IOError, ValueError):
+                        ports = {}
+                    ports = dict((k, v) for k, v in ports.items() if _pid_alive(v.get("pid")))
+                    origin = dict(ports)
+                    yield ports
+                    if ports != origin:
+                        with open(registry, "w") as f:
+                            json.dump(ports, f)
+                finally:
+                    _lock_file(lock_file, False)
+
+
+def _lock_file(f, lock):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if lock else fcntl.LOCK_UN)
+    elif msvcrt is not None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if lock else msvcrt.LK_UNLCK, 1)
+
+
+def _pid_alive(pid):
+    if not isinstance(pid, int):
+        return False
+    if pid == os.getpid():
+        return True
+    if os.name == "nt":  # os.kill(pid, 0) terminates the process on windows.
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return kernel32.GetLastError() == 5  # ERROR_ACCESS_DENIED, alive but owned by another user
+        try:
+            code = ctypes.c_ulong()
+            return not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)) or code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == 1  # EPERM, alive but owned by another user
+    return True
+
+
+port_allocator = LocalPortAllocator()
+atexit.register(port_allocator.release_all)
+
+
+_file_checksums = {}
+
+
+def file_checksum(filename):
+    '''md5 of the file, cached by path, size and modification time.'''
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if key not in _file_checksums:
+        m = hashlib.md5()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                m.update(chunk)
+        _file_checksums[key] = m.hexdigest()
+    return _file_checksums[key]
 
 
 class NotFoundHandler(object):
@@ -372,43 +1604,130 @@ class AutomatorServer(object):
     __apk_files = ["libs/app-uiautomator.apk", "libs/app-uiautomator-test.apk"]
     __androidx_apk_files = ["libs/app-uiautomator-androidx.apk", "libs/app-uiautomator-test-androidx.apk"]
 
+    # checksums of the files deployed on device, to skip deploying unchanged files.
+    checksum_file = "/data/local/tmp/uiautomator.md5"
+
     __sdk = 0
 
     handlers = NotFoundHandler()  # handler UI Not Found exception
 
+    # rpc methods changing the screen, each call through jsonrpc increases actions.
+    action_methods = frozenset([
+        "click", "clickAndWaitForNewWindow", "longClick", "swipe", "swipePoints", "drag", "dragTo",
+        "setText", "clearTextField", "pressKey", "pressKeyCode", "gesture", "pinchIn", "pinchOut",
+        "scrollTo", "scrollForward", "scrollBackward", "scrollToBeginning", "scrollToEnd",
+        "flingForward", "flingBackward", "flingToBeginning", "flingToEnd", "setOrientation",
+        "freezeRotation", "wakeUp", "sleep", "openNotification", "openQuickSettings"
+    ])
+
     def __init__(self, serial=None, local_port=None, device_port=None, adb_server_host=None, adb_server_port=None):
         self.uiautomator_process = None
+        self.start_timings = collections.OrderedDict()
+        self.actions = 0  # count of action_methods called, cached ui object info is dropped when it changes
+        self.__http = None
+        self.__deploy_skipped = False
+        self.__serial = serial
+        self.__adb_server_host = adb_server_host
+        self.__reserved = False  # True while local port is reserved in port_allocator, None once released
         self.adb = Adb(serial=serial, adb_server_host=adb_server_host, adb_server_port=adb_server_port)
         self.device_port = int(device_port) if device_port else DEVICE_PORT
         if local_port:
             self.local_port = local_port
         else:
             try:  # first we will try to use the local port already adb forwarded
-                for s, lp, rp in self.adb.forward_list():
-                    if s == self.adb.device_serial() and rp == 'tcp:%d' % self.device_port:
-                        self.local_port = int(lp[4:])
-                        break
-                else:
-                    self.local_port = next_local_port(adb_server_host)
+                self.__serial = self.adb.device_serial()
+                forwards = dict(((s, rp), lp) for s, lp, rp in self.adb.forward_list())
+                lp = forwards.get((self.__serial, 'tcp:%d' % self.device_port))
+                self.local_port = port_allocator.reserve(self.__serial, adb_server_host, int(lp[4:]) if lp else None)
             except:
-                self.local_port = next_local_port(adb_server_host)
+                self.local_port = port_allocator.reserve(self.__serial, adb_server_host)
+            self.__reserved = True
 
     def push(self):
-        base_dir = os.path.dirname(__file__)
-        for jar, url in self.__jar_files.items():
-            filename = os.path.join(base_dir, url)
-            self.adb.cmd("push", filename, "/data/local/tmp/").wait()
+        deploy, _ = self.deployment(17)
+        self.__deploy(deploy)
         return list(self.__jar_files.keys())
 
     def install(self):
-        base_dir = os.path.dirname(__file__)
-        for apk in self.__apk_files:
-            self.adb.cmd("install", "-r -t", os.path.join(base_dir, apk)).wait()
+        self.__deploy(self.deployment(21)[0])
 
     def install_androidx(self):
+        self.__deploy(self.deployment(28)[0])
+
+    def __deploy(self, commands):
+        '''run the adb commands deploying files in parallel, unless the same files are on device.'''
+        checksums = self.file_checksums(commands)
+        deployed = self.deployed_checksums()
+        if all(deployed.get(name) == checksum for name, checksum in checksums.items()):
+            self.__deploy_skipped = True
+            return False
+        self.__deploy_skipped = False
+        processes = [self.adb.cmd(*args) for args in commands]
+        for p in processes:  # wait for all, a failed one must not leave zombies
+            p.communicate()  # drain the pipes, wait() blocks forever once one is full
+        if all(p.returncode == 0 for p in processes):
+            deployed.update(checksums)
+            self.save_checksums(deployed)
+        return True
+
+    @staticmethod
+    def file_checksums(commands):
+        '''dict of file name to md5 of the local files of adb push or install commands.'''
+        files = [args[1] if args[0] == "push" else args[-1] for args in commands]
+        return dict((os.path.basename(f), file_checksum(f)) for f in files)
+
+    @staticmethod
+    def parse_checksums(out):
+        '''dict of file name to md5 from the text of the checksum file.'''
+        checksums = {}
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and re.match(r"^[0-9a-f]{32}$", fields[0]):
+                checksums[fields[1]] = fields[0]
+        return checksums
+
+    @staticmethod
+    def format_checksums(checksums):
+        '''content of the checksum file, md5sum format.'''
+        return "".join("%s  %s\n" % (checksums[name], name) for name in sorted(checksums)).encode("utf-8")
+
+    def deployed_checksums(self):
+        '''dict of file name to md5 of the files deployed on device.'''
+        try:
+            out = self.adb.cmd("shell", "cat", self.checksum_file).communicate()[0].decode("utf-8")
+        except:
+            return {}
+        return self.parse_checksums(out)
+
+    def save_checksums(self, checksums):
+        '''save checksums of the deployed files on device, None to clear them.'''
+        if not checksums:
+            self.adb.cmd("shell", "rm", "-f", self.checksum_file).wait()
+            return
+        fd, filename = tempfile.mkstemp()
+        try:
+            os.write(fd, self.format_checksums(checksums))
+            os.close(fd)
+            self.adb.cmd("push", filename, self.checksum_file).wait()
+        finally:
+            os.remove(filename)
+
+    @classmethod
+    def deployment(cls, sdk):
+        '''adb commands deploying the rpc server on the sdk level, and the adb command starting it.'''
         base_dir = os.path.dirname(__file__)
-        for apk in self.__androidx_apk_files:
-            self.adb.cmd("install", "-r -t", os.path.join(base_dir, apk)).wait()
+        if sdk < 18:
+            return ([["push", os.path.join(base_dir, url), "/data/local/tmp/"] for url in cls.__jar_files.values()],
+                    ["shell", "uiautomator", "runtest"] + list(cls.__jar_files.keys()) +
+                    ["-c", "com.github.uiautomatorstub.Stub"])
+        elif sdk >= 28:
+            return ([["install", "-r", "-t", os.path.join(base_dir, apk)] for apk in cls.__androidx_apk_files],
+                    ["shell", "am", "instrument", "-w",
+                     "com.github.uiautomator.test/androidx.test.runner.AndroidJUnitRunner"])
+        else:
+            return ([["install", "-r", "-t", os.path.join(base_dir, apk)] for apk in cls.__apk_files],
+                    ["shell", "am", "instrument", "-w",
+                     "com.github.uiautomator.test/android.support.test.runner.AndroidJUnitRunner"])
 
     @property
     def jsonrpc(self):
@@ -418,18 +1737,20 @@ class AutomatorServer(object):
         server = self
         ERROR_CODE_BASE = -32000
 
-        def _JsonRPCMethod(url, method, timeout, restart=True):
-            _method_obj = JsonRPCMethod(url, method, timeout)
+        def _JsonRPCMethod(url, method, timeout, restart=True, pool=None):
+            _method_obj = JsonRPCMethod(url, method, timeout, pool=pool)
+            URLError = urllib3.exceptions.HTTPError if os.name == "nt" else urllib2.URLError
 
             def wrapper(*args, **kwargs):
-                URLError = urllib3.exceptions.HTTPError if os.name == "nt" else urllib2.URLError
+                if method in server.action_methods:
+                    server.actions += 1
                 try:
                     return _method_obj(*args, **kwargs)
-                except (URLError, socket.error, HTTPException) as e:
+                except (URLError, urllib2.URLError, socket.error, HTTPException) as e:
                     if restart:
                         server.stop()
                         server.start(timeout=30)
-                        return _JsonRPCMethod(url, method, timeout, False)(*args, **kwargs)
+                        return _JsonRPCMethod(url, method, timeout, False, pool)(*args, **kwargs)
                     else:
                         raise
                 except JsonRPCError as e:
@@ -446,49 +1767,108 @@ class AutomatorServer(object):
                             self.handlers['on'] = True
                         return _method_obj(*args, **kwargs)
                     raise
+
+            def post(data):
+                '''post a batch of json-rpc requests, counting its actions like single calls.'''
+                server.actions += sum(1 for request in data if request.get("method") in server.action_methods)
+                try:
+                    return _method_obj.post(data)
+                except urllib2.HTTPError:  # the server answered, but rejects batches
+                    raise
+                except (URLError, urllib2.URLError, socket.error, HTTPException):
+                    if restart:
+                        server.stop()
+                        server.start(timeout=30)
+                        return _JsonRPCMethod(url, method, timeout, False, pool).post(data)
+                    raise
+            wrapper.post = post
             return wrapper
 
         return JsonRPCClient(self.rpc_uri,
                              timeout=timeout,
-                             method_class=_JsonRPCMethod)
+                             method_class=_JsonRPCMethod,
+                             pool=self.http)
 
     def __jsonrpc(self):
-        return JsonRPCClient(self.rpc_uri, timeout=int(os.environ.get("JSONRPC_TIMEOUT", 90)))
+        return JsonRPCClient(self.rpc_uri, timeout=int(os.environ.get("JSONRPC_TIMEOUT", 90)), pool=self.http)
+
+    @property
+    def http(self):
+        '''keep-alive connection pool to the rpc server.'''
+        host, port = self.adb.adb_server_host, self.local_port
+        if self.__http is None or (self.__http.host, self.__http.port) != (host, port):
+            self.__http = HTTPConnectionPool(host, port)
+        return self.__http
 
     def sdk_version(self):
         '''sdk version of connected device.'''
         if self.__sdk == 0:
+            def sdk_version():
+                return int(self.adb.cmd("shell", "getprop", "ro.build.version.sdk").communicate()[0].decode("utf-8").strip())
             try:
-                self.__sdk = int(self.adb.cmd("shell", "getprop", "ro.build.version.sdk").communicate()[0].decode("utf-8").strip())
+                key = ("sdk", self.adb.adb_server_host, self.adb.adb_server_port, self.adb.device_serial())
+                self.__sdk = adb_metadata.cached(key, sdk_version)
             except:
                 pass
         return self.__sdk
 
     def start(self, timeout=5):
-        if self.sdk_version() < 18:
-            files = self.push()
-            cmd = list(itertools.chain(
-                ["shell", "uiautomator", "runtest"],
-                files,
-                ["-c", "com.github.uiautomatorstub.Stub"]
-            ))
-        elif self.sdk_version() >= 28:
-            self.install_androidx()
-            cmd = ["shell", "am", "instrument", "-w",
-                   "com.github.uiautomator.test/androidx.test.runner.AndroidJUnitRunner"]           
-        else:
-            self.install()
-            cmd = ["shell", "am", "instrument", "-w",
-                   "com.github.uiautomator.test/android.support.test.runner.AndroidJUnitRunner"]
+        self.start_timings = collections.OrderedDict()
+        if self.__reserved is None:  # released by stop()
+            port_allocator.reserve(self.__serial, self.__adb_server_host, self.local_port)
+            self.__reserved = True
+        begin = monotonic()
+        deploy, cmd = self.deployment(self.sdk_version())
+        self.__deploy(deploy)
+        begin = self.__timing("deploy", begin)
 
         self.uiautomator_process = self.adb.cmd(*cmd)
+        begin = self.__timing("launch", begin)
         self.adb.forward(self.local_port, self.device_port)
+        begin = self.__timing("forward", begin)
+
+        ready = self.wait_ready(timeout)
+        self.__timing("ready", begin)
+        if not ready:
+            if self.__deploy_skipped:
+                # deployed files are gone from device though checksums are there, deploy again.
+                self.__deploy_skipped = False
+                self.uiautomator_process.kill()
+                self.save_checksums(None)
+                return self.start(timeout=timeout)
+            raise IOError("RPC server not started!%s" % self.__process_output())
 
-        while not self.alive and timeout > 0:
-            time.sleep(0.1)
-            timeout -= 0.1
-        if not self.alive:
-            raise IOError("RPC server not started!")
+    def __timing(self, phase, begin):
+        now = monotonic()
+        self.start_timings[phase] = now - begin
+        return now
+
+    def wait_ready(self, timeout=5):
+        '''
+        wait until the rpc server answers ping, return False if timeout or the server process exited.
+        ping is retried with exponential backoff until the deadline.
+        '''
+        deadline, delay = monotonic() + timeout, 0.01
+        while True:
+            if self.alive:
+                return True
+            if self.uiautomator_process is not None and self.uiautomator_process.poll() is not None:
+                return False  # instrumentation failed to start, no need to wait the timeout.
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.5)
+
+    def __process_output(self):
+        '''output of the exited server process, to tell why it failed.'''
+        if self.uiautomator_process is None or self.uiautomator_process.poll() is None:
+            return ""
+        try:
+            out = b"".join(o for o in self.uiautomator_process.communicate() if isinstance(o, bytes))
+            return "\n" + out.decode("utf-8", "replace").strip()
+        except:
+            return ""
 
     def ping(self):
         try:
@@ -506,7 +1886,7 @@ class AutomatorServer(object):
         if self.uiautomator_process and self.uiautomator_process.poll() is None:
             res = None
             try:
-                res = urllib2.urlopen(self.stop_uri)
+                res = self.http.urlopen("GET", self.stop_uri)
                 self.uiautomator_process.wait()
             except:
                 self.uiautomator_process.kill()
@@ -514,6 +1894,10 @@ class AutomatorServer(object):
                 if res is not None:
                     res.close()
                 self.uiautomator_process = None
+        self.http.clear()
+        if self.__reserved:
+            port_allocator.release(self.local_port, self.__adb_server_host)
+            self.__reserved = None
         try:
             out = self.adb.cmd("shell", "ps", "-C", "uiautomator").communicate()[0].decode("utf-8").strip().splitlines()
             if out:
@@ -536,23 +1920,155 @@ class AutomatorServer(object):
     def screenshot_uri(self):
         return "http://%s:%d/screenshot/0" % (self.adb.adb_server_host, self.local_port)
 
-    def screenshot(self, filename=None, scale=1.0, quality=100):
-        if self.sdk_version() >= 18:
-            try:
-                req = urllib2.Request("%s?scale=%f&quality=%f" % (self.screenshot_uri, scale, quality))
-                result = urllib2.urlopen(req, timeout=30)
-                if filename:
+    def screenshot(self, filename=None, scale=1.0, quality=100, buffer=None):
+        '''
+        take screenshot by the rpc server, None if it failed.
+        The image is copied chunk by chunk to filename, a path or a writable file object, and filename
+        is returned; or into buffer, a writable bytearray or memoryview, and the number of bytes is
+        returned. ValueError is raised if the image does not fit. Otherwise the image bytes are returned.
+        '''
+        if self.sdk_version() < 18:
+            return None
+        try:
+            result = self.http.urlopen("GET", "%s?scale=%f&quality=%f" % (self.screenshot_uri, scale, quality), timeout=30)
+        except Exception:
+            return None
+        try:
+            if buffer is not None:
+                view, size = memoryview(buffer), 0
+                for chunk in iter(lambda: result.read(hierarchy.CHUNK_SIZE), b""):
+                    if size + len(chunk) > len(view):
+                        raise ValueError("Screenshot is larger than the buffer of %d bytes." % len(view))
+                    view[size:size + len(chunk)] = chunk
+                    size += len(chunk)
+                return size
+            elif hasattr(filename, "write"):
+                copy_chunks(result.read, filename.write)
+                return filename
+            elif filename:
+                try:
                     with open(filename, 'wb') as f:
-                        f.write(result.read())
-                        return filename
-                else:
-                    return result.read()
-            except:
-                pass
-        return None
+                        copy_chunks(result.read, f.write)
+                except (EnvironmentError, HTTPException):
+                    if os.path.exists(filename):
+                        os.remove(filename)  # no truncated image left behind
+                    raise
+                return filename
+            else:
+                return result.read()
+        except (EnvironmentError, HTTPException):
+            return None  # the stream broke off, what was copied is truncated
+        finally:
+            result.close()
+
+
+class ScreenCapture(object):
+
+    '''
+    Screenshots of the rpc server taken by a background thread at up to fps frames per second.
+    The last size frames are kept in a ring of preallocated buffers, each image streamed into a
+    spare buffer which then takes the place of the oldest frame. A frame which can not be taken
+    in its time slot, because the previous one was slow, is dropped instead of queued.
+    Usage:
+    with d.capture(fps=10, scale=0.5, quality=50, size=64) as capture:
+        d(text="Settings").click()
+    for timestamp, image in capture.frames():
+        ...
+    capture.rate, capture.captured, capture.dropped
+    '''
+
+    def __init__(self, server, fps=5, scale=0.5, quality=50, size=32, frame_bytes=256 * 1024):
+        self.server, self.fps, self.scale, self.quality = server, fps, scale, quality
+        self.frame_bytes = frame_bytes  # doubled whenever an image does not fit
+        self.captured, self.dropped = 0, 0
+        self.__buffers = [bytearray(frame_bytes) for _ in range(size)]
+        self.__spare = bytearray(frame_bytes)
+        self.__times, self.__lengths = [None] * size, [0] * size
+        self.__next, self.__count = 0, 0  # ring slot of the next frame, frames in the ring
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        return self
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def frames(self):
+        '''[(timestamp, image bytes)] of the frames in the ring, oldest first.'''
+        with self.__lock:
+            return [(self.__times[i], bytes(self.__buffers[i][:self.__lengths[i]])) for i in self.__slots()]
+
+    @property
+    def timestamps(self):
+        '''time.time() each frame in the ring was requested at, oldest first.'''
+        with self.__lock:
+            return [self.__times[i] for i in self.__slots()]
 
-class AutomatorDevice(object):
+    @property
+    def rate(self):
+        '''frames per second achieved over the frames in the ring.'''
+        timestamps = self.timestamps
+        if len(timestamps) < 2 or timestamps[-1] <= timestamps[0]:
+            return 0.0
+        return (len(timestamps) - 1) / (timestamps[-1] - timestamps[0])
+
+    def __slots(self):
+        size = len(self.__buffers)
+        return [(self.__next - self.__count + i) % size for i in range(self.__count)]
+
+    def __run(self):
+        interval = 1.0 / self.fps
+        tick = monotonic()
+        while not self.__stopped.is_set():
+            self.__take(time.time())
+            tick += interval
+            now = monotonic()
+            if now > tick:  # the frame took longer than its slot, drop the missed ones
+                missed = int((now - tick) / interval) + 1
+                self.dropped += missed
+                tick += missed * interval
+            self.__stopped.wait(max(tick - monotonic(), 0))
+
+    def __take(self, timestamp):
+        try:
+            length = self.server.screenshot(None, self.scale, self.quality, self.__spare)
+        except ValueError:  # larger than the buffers, grow them for the next frames
+            self.frame_bytes *= 2
+            self.__spare, length = bytearray(self.frame_bytes), None
+        if not length:
+            self.dropped += 1
+            return
+        with self.__lock:
+            i = self.__next
+            self.__buffers[i], self.__spare = self.__spare, self.__buffers[i]
+            self.__times[i], self.__lengths[i] = timestamp, length
+            self.__next = (i + 1) % len(self.__buffers)
+            self.__count = min(self.__count + 1, len(self.__buffers))
+            self.captured += 1
+        if len(self.__spare) < self.frame_bytes:
+            self.__spare = bytearray(self.frame_bytes)
+
+
+# abstract base class, so the module level LazyAutomatorDevice proxy can be registered as a virtual subclass.
+_AutomatorDeviceBase = abc.ABCMeta("_AutomatorDeviceBase", (object,), {})
+
+
+class AutomatorDevice(_AutomatorDeviceBase):
 
     '''uiautomator wrapper of android device'''
 
@@ -566,6 +2082,9 @@ class AutomatorDevice(object):
         "width": "displayWidth",
         "height": "displayHeight"
     }
+    # deviceInfo fields kept for the session, updated by every deviceInfo call. Display size is not
+    # one of them, it follows the rotation, which the device or an app may change at any time.
+    static_info = ("sdkInt", "productName")
 
     def __init__(self, serial=None, local_port=None, adb_server_host=None, adb_server_port=None):
         self.server = AutomatorServer(
@@ -574,12 +2093,19 @@ class AutomatorDevice(object):
             adb_server_host=adb_server_host,
             adb_server_port=adb_server_port
         )
+        self.info_ttl = 1  # seconds to cache the other fields, e.g. displaySize, displayRotation, screenOn
+        self.__info = None  # (info, actions of the server, fetch time)
+        self.__static_info = {}
 
-    def __call__(self, **kwargs):
-        return AutomatorDeviceObject(self, Selector(**kwargs))
+    def __call__(self, selector=None, **kwargs):
+        '''ui object of the selector kwargs, or of a prebuilt (e.g. frozen) Selector.'''
+        return AutomatorDeviceObject(self, call_selector(selector, kwargs))
 
     def __getattr__(self, attr):
         '''alias of fields in info property.'''
+        field = self.__alias.get(attr, attr)
+        if field in self.__static_info:
+            return self.__static_info[field]
         info = self.info
         if attr in info:
             return info[attr]
@@ -590,8 +2116,32 @@ class AutomatorDevice(object):
 
     @property
     def info(self):
-        '''Get the device info.'''
-        return self.server.jsonrpc.deviceInfo()
+        '''
+        Get the device info. It is cached for info_ttl seconds (1 by default), and fetched
+        again as soon as any action (press, orientation, screen on/off, click...) goes
+        through the device.
+        '''
+        cache, actions = self.__info, self.server.actions
+        if cache is None or cache[1] != actions or monotonic() - cache[2] >= self.info_ttl:
+            info = self.server.jsonrpc.deviceInfo()
+            self.__static_info = dict((k, info[k]) for k in self.static_info if k in info)
+            self.__info = cache = (info, actions, monotonic())
+        return dict(cache[0])
+
+    def refresh(self):
+        '''drop cached device info, including the static fields.'''
+        self.__info, self.__static_info = None, {}
+
+    def batch(self):
+        '''
+        Send several rpc calls in one round-trip.
+        Usage:
+        with d.batch() as b:
+            ok = b.exist(Selector(text="OK"))
+            cancel = b.exist(Selector(text="Cancel"))
+        ok.result(), cancel.result()
+        '''
+        return self.server.jsonrpc.batch()
 
     def click(self, x, y):
         '''click at arbitrary coordinates.'''
@@ -620,17 +2170,61 @@ class AutomatorDevice(object):
         content = self.server.jsonrpc.dumpWindowHierarchy(compressed, None)
         if filename:
             with open(filename, "wb") as f:
-                f.write(content.encode("utf-8"))
+                for i in range(0, len(content), hierarchy.CHUNK_SIZE):
+                    f.write(content[i:i + hierarchy.CHUNK_SIZE].encode("utf-8"))
         if pretty and "\n " not in content:
-            xml_text = xml.dom.minidom.parseString(content.encode("utf-8"))
-            content = U(xml_text.toprettyxml(indent='  '))
+            out = io.StringIO()
+            hierarchy.write_pretty(content, out)
+            content = U(out.getvalue())
         return content
 
+    def snapshot(self, compressed=False):
+        '''dump window hierarchy once, selectors on the returned Hierarchy are evaluated locally.'''
+        return Hierarchy(self.server.jsonrpc.dumpWindowHierarchy(compressed, None))
+
     def screenshot(self, filename, scale=1.0, quality=100):
-        '''take screenshot.'''
+        '''take screenshot into filename, a path or a writable binary file object; it is returned, or None on failure.'''
+        try:
+            start = filename.tell() if hasattr(filename, "write") else None
+        except (EnvironmentError, ValueError):
+            start = None  # not seekable
         result = self.server.screenshot(filename, scale, quality)
         if result:
             return result
+        if not hasattr(filename, "write"):
+            return self.__adb_screenshot(filename, scale, quality)
+
+        if start is not None:  # drop whatever a broken stream wrote before the fallback
+            filename.seek(start)
+            filename.truncate()
+        fd, path = tempfile.mkstemp(suffix=".png")  # the adb fallbacks write to a local file
+        os.close(fd)
+        try:
+            if self.__adb_screenshot(path, scale, quality) is None:
+                return None
+            with open(path, "rb") as f:
+                copy_chunks(f.read, filename.write)
+            return filename
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __adb_screenshot(self, filename, scale, quality):
+        if scale == 1.0:  # screencap can not scale, stream its png instead of a file on the device
+            try:
+                f = open(filename, "w+b")
+            except EnvironmentError:
+                pass  # e.g. no such directory, left to the fallback below
+            else:
+                try:
+                    with f:
+                        if self.server.adb.exec_out(f, "screencap", "-p"):
+                            f.seek(0)
+                            if f.read(len(PNG_SIGNATURE)) == PNG_SIGNATURE:  # not an error message
+                                return filename
+                except EnvironmentError:
+                    pass
+                os.remove(filename)  # no partial image left behind if the fallback below fails
 
         device_file = self.server.jsonrpc.takeScreenshot("screenshot.png",
                                                          scale, quality)
@@ -641,6 +2235,57 @@ class AutomatorDevice(object):
         self.server.adb.cmd("shell", "rm", device_file).wait()
         return filename if p.returncode is 0 else None
 
+    def capture(self, fps=5, scale=0.5, quality=50, size=32):
+        '''
+        start taking screenshots in background, the last size frames are kept, see ScreenCapture.
+        Usage:
+        capture = d.capture(fps=10)
+        d(text="Settings").click()
+        frames = capture.stop().frames()
+        '''
+        return ScreenCapture(self.server, fps, scale, quality, size).start()
+
+    def screenshot_array(self, scale=1.0):
+        '''
+        screenshot as a numpy uint8 array of shape (height, width, 4), RGBA, numpy is required.
+        The raw frame of adb exec-out screencap is used, without png encoding and decoding, and
+        scale must be 1/n: every n-th pixel is kept as a view of it, the size rounded down like
+        the rpc server does. Devices without exec-out fall back to decoding the png of the rpc
+        server scaled to the same size, which requires PIL (pip install uiautomator[array]).
+        '''
+        step = int(round(1.0 / scale)) if 0 < scale <= 1 else 0
+        if step < 1 or abs(scale * step - 1) > 1e-6:
+            raise ValueError("scale must be 1/n, e.g. 1, 0.5 or 0.25, got %r." % (scale,))
+        if numpy is None:
+            raise ImportError("screenshot_array requires numpy.")
+        try:
+            frame = self.__screencap_raw()
+        except EnvironmentError:
+            frame = None
+        if frame is not None:
+            if step == 1:
+                return frame
+            height, width = frame.shape[0] // step * step, frame.shape[1] // step * step
+            return frame[:height:step, :width:step]
+        png = self.server.screenshot(None, scale, 100)
+        if not png:
+            raise IOError("Screenshot failed.")
+        from PIL import Image
+        return numpy.asarray(Image.open(io.BytesIO(png)).convert("RGBA"))
+
+    def __screencap_raw(self):
+        '''RGBA_8888 frame of screencap, None if the output is in another format.'''
+        out = io.BytesIO()
+        self.server.adb.exec_out(out, "screencap")
+        data = out.getbuffer() if hasattr(out, "getbuffer") else bytearray(out.getvalue())
+        if len(data) < 12:
+            return None
+        width, height, pixel_format = struct.unpack_from("<3I", data)
+        header = len(data) - width * height * 4  # 12 bytes, 16 with the color space since android 8
+        if pixel_format != 1 or header not in (12, 16):
+            return None
+        return numpy.frombuffer(data, numpy.uint8, width * height * 4, header).reshape(height, width, 4)
+
     def freeze_rotation(self, freeze=True):
         '''freeze or unfreeze the device rotation in current status.'''
         self.server.jsonrpc.freezeRotation(freeze)
@@ -851,13 +2496,31 @@ class AutomatorDevice(object):
     @property
     def wait(self):
         '''
-        Waits for the current application to idle or window update event occurs.
+        Waits for the current application to idle or window update event occurs,
+        or for several ui objects, answered from hierarchy snapshots.
         Usage:
         d.wait.idle(timeout=1000)
         d.wait.update(timeout=1000, package_name="com.android.settings")
+        # the first one appearing, each is a Selector, a ui object or a dict of selector kwargs
+        d.wait.any(dialog, d(text="Home"), {"text": "Settings"}, timeout=10000)
+        d.wait.all(d(text="OK"), d(text="Cancel"))  # True once all exist at the same time
+        d.wait.gone_all(d(text="Loading"), d(className="android.widget.ProgressBar"))
+        # ms the hierarchy took to stop changing for 500ms, None if it still changed after 10s
+        settle_ms = d.wait.stable(window_ms=500, timeout=10000, screenshot=False)
         '''
-        @param_to_property(action=["idle", "update"])
-        def _wait(action, timeout=1000, package_name=None):
+        @param_to_property(action=["idle", "update", "any", "all", "gone_all", "stable"])
+        def _wait(*args, **kwargs):
+            if "action" in kwargs:
+                action = kwargs.pop("action")
+            else:
+                action, args = args[0], args[1:]
+            if action in ("any", "all", "gone_all"):
+                return self.__wait_selectors(action, args, **kwargs)
+            elif action == "stable":
+                return self.__wait_stable(*args, **kwargs)
+            return _wait_rpc(action, *args, **kwargs)
+
+        def _wait_rpc(action, timeout=1000, package_name=None):
             if timeout / 1000 + 5 > int(os.environ.get("JSONRPC_TIMEOUT", 90)):
                 http_timeout = timeout / 1000 + 5
             else:
@@ -868,6 +2531,33 @@ class AutomatorDevice(object):
                 return self.server.jsonrpc_wrap(timeout=http_timeout).waitForWindowUpdate(package_name, timeout)
         return _wait
 
+    def __wait_selectors(self, action, selectors, timeout=3000):
+        '''
+        poll hierarchy snapshots until the condition of action holds for the selectors,
+        polling faster first and slower later, within one deadline of timeout ms.
+        '''
+        selectors = [(arg, wait_selector(arg)) for arg in selectors]
+        deadline, delay = monotonic() + timeout / 1000.0, 0.05
+        while True:
+            done, result = wait_condition(action, self.snapshot(), selectors)
+            remaining = deadline - monotonic()
+            if done or remaining <= 0:
+                return result
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1.0)
+
+    def __wait_stable(self, window_ms=500, timeout=10000, screenshot=False):
+        '''
+        poll until the screen is unchanged for window_ms, see stable_poll.
+        return the ms the screen took to settle, or None if it still changed at timeout.
+        '''
+        poll = stable_poll(window_ms, timeout)
+        delay = next(poll)
+        while isinstance(delay, float):
+            time.sleep(delay)
+            delay = poll.send(stable_digest(self.snapshot(), self.server.screenshot(None, 0.1, 10) if screenshot else None))
+        return delay
+
     def exists(self, **kwargs):
         '''Check if the specified ui object by kwargs exists.'''
         return self(**kwargs).exists
@@ -882,10 +2572,14 @@ class AutomatorDeviceUiObject(object):
 
     __alias = {'description': "contentDescription"}
 
-    def __init__(self, device, selector):
+    def __init__(self, device, selector, info=None):
         self.device = device
         self.jsonrpc = device.server.jsonrpc
         self.selector = selector
+        self.ttl = None  # seconds to cache info, None to fetch it every time
+        self.__cache = None  # (info, actions of the server, fetch time)
+        if info is not None:  # prefetched, e.g. from a hierarchy dump
+            self.__cache = (info, device.server.actions, monotonic())
 
     @property
     def exists(self):
@@ -905,7 +2599,48 @@ class AutomatorDeviceUiObject(object):
     @property
     def info(self):
         '''ui object info.'''
-        return self.jsonrpc.objInfo(self.selector)
+        if self.__cache is not None:
+            info, actions, timestamp = self.__cache
+            if actions == self.device.server.actions and (self.ttl is None or monotonic() - timestamp < self.ttl):
+                return info
+            self.__cache = None
+        info = self.jsonrpc.objInfo(self.selector)
+        if self.ttl is not None:
+            self.__cache = (info, self.device.server.actions, monotonic())
+        return info
+
+    def cached(self, ttl=5):
+        '''
+        cache info, so its attributes, for ttl seconds. The cache is dropped as soon as any
+        action (click, set_text, swipe, scroll, fling, drag, press...) goes through the device.
+        Usage:
+        clock = d(resourceId="com.android.systemui:id/clock").cached(ttl=2)
+        clock.text, clock.bounds, clock.enabled  # one objInfo call
+        '''
+        self.ttl = ttl
+        return self
+
+    def refresh(self):
+        '''drop cached info, next attribute access fetches it again.'''
+        self.__cache = None
+        return self
+
+    def screenshot_array(self, scale=1.0):
+        '''
+        screenshot of the object, a view of the device screenshot_array cropped to its visibleBounds.
+        Usage:
+        pixels = d(resourceId="com.android.systemui:id/clock").screenshot_array()
+        '''
+        bounds = self.info["visibleBounds"]
+        info = self.device.info  # display size and rotation as of now, they follow auto-rotation
+        frame = self.device.screenshot_array(scale)
+        width, height = info["displayWidth"], info["displayHeight"]
+        if (frame.shape[1] > frame.shape[0]) != (width > height):  # frame in the natural orientation
+            frame = numpy.rot90(frame, info.get("displayRotation", 0))
+        x, y = frame.shape[1] / float(width), frame.shape[0] / float(height)
+        top, bottom = [max(int(round(bounds[k] * y)), 0) for k in ("top", "bottom")]
+        left, right = [max(int(round(bounds[k] * x)), 0) for k in ("left", "right")]
+        return frame[top:bottom, left:right]
 
     def set_text(self, text):
         '''set the text field.'''
@@ -1094,8 +2829,8 @@ class AutomatorDeviceObject(AutomatorDeviceUiObject):
     on which user can perform actions, such as click, set text
     '''
 
-    def __init__(self, device, selector):
-        super(AutomatorDeviceObject, self).__init__(device, selector)
+    def __init__(self, device, selector, info=None):
+        super(AutomatorDeviceObject, self).__init__(device, selector, info)
 
     def child(self, **kwargs):
         '''set childSelector.'''
@@ -1189,38 +2924,47 @@ class AutomatorDeviceObject(AutomatorDeviceUiObject):
 
         return Iter()
 
+    def infos(self):
+        '''info of all matched objects, read from one hierarchy dump.'''
+        return [node.info for node in HierarchyObject(self.device.snapshot(), self.selector).nodes]
+
+    def all(self):
+        '''
+        all matched objects, like iterating over the object, but their info (and so their
+        attributes such as text or bounds) are read from one hierarchy dump instead of
+        one rpc call per object, until an action goes through the device or refresh().
+        Usage:
+        titles = [ui.text for ui in d(resourceId="android:id/title").all()]
+        '''
+        nodes = HierarchyObject(self.device.snapshot(), self.selector).nodes
+        if len(nodes) == 1:
+            return [AutomatorDeviceObject(self.device, self.selector, nodes[0].info)]
+        objs = []
+        for index, node in enumerate(nodes):
+            selector = self.selector.clone()
+            selector["instance"] = index
+            objs.append(AutomatorDeviceObject(self.device, selector, node.info))
+        return objs
+
     def right(self, **kwargs):
-        def onrightof(rect1, rect2):
-            left, top, right, bottom = intersect(rect1, rect2)
-            return rect2["left"] - rect1["right"] if top < bottom else -1
-        return self.__view_beside(onrightof, **kwargs)
+        return self.__view_beside("right", **kwargs)
 
     def left(self, **kwargs):
-        def onleftof(rect1, rect2):
-            left, top, right, bottom = intersect(rect1, rect2)
-            return rect1["left"] - rect2["right"] if top < bottom else -1
-        return self.__view_beside(onleftof, **kwargs)
+        return self.__view_beside("left", **kwargs)
 
     def up(self, **kwargs):
-        def above(rect1, rect2):
-            left, top, right, bottom = intersect(rect1, rect2)
-            return rect1["top"] - rect2["bottom"] if left < right else -1
-        return self.__view_beside(above, **kwargs)
+        return self.__view_beside("up", **kwargs)
 
     def down(self, **kwargs):
-        def under(rect1, rect2):
-            left, top, right, bottom = intersect(rect1, rect2)
-            return rect2["top"] - rect1["bottom"] if left < right else -1
-        return self.__view_beside(under, **kwargs)
-
-    def __view_beside(self, onsideof, **kwargs):
-        bounds = self.info["bounds"]
-        min_dist, found = -1, None
-        for ui in AutomatorDeviceObject(self.device, Selector(**kwargs)):
-            dist = onsideof(bounds, ui.info["bounds"])
-            if dist >= 0 and (min_dist < 0 or dist < min_dist):
-                min_dist, found = dist, ui
-        return found
+        return self.__view_beside("down", **kwargs)
+
+    def __view_beside(self, direction, **kwargs):
+        '''
+        nearest ui object matching kwargs on the side, looked up in one hierarchy
+        dump instead of querying every candidate.
+        '''
+        found = getattr(HierarchyObject(self.device.snapshot(), self.selector), direction)(**kwargs)
+        return AutomatorDeviceObject(self.device, found.selector) if found is not None else None
 
     @property
     def fling(self):
@@ -1290,4 +3034,42 @@ class AutomatorDeviceObject(AutomatorDeviceUiObject):
                 return __scroll_to(vertical, **kwargs)
         return _scroll
 
-device = AutomatorDevice()
+
+class LazyAutomatorDevice(object):
+
+    '''proxy of AutomatorDevice, the device is created on first use instead of at import time.'''
+
+    def __init__(self, *args, **kwargs):
+        object.__setattr__(self, "_LazyAutomatorDevice__args", (args, kwargs))
+        object.__setattr__(self, "_LazyAutomatorDevice__device", None)
+        object.__setattr__(self, "_LazyAutomatorDevice__lock", threading.Lock())
+
+    @property
+    def _device(self):
+        if self.__device is None:
+            with self.__lock:
+                if self.__device is None:
+                    args, kwargs = self.__args
+                    object.__setattr__(self, "_LazyAutomatorDevice__device", AutomatorDevice(*args, **kwargs))
+        return self.__device
+
+    def __call__(self, *args, **kwargs):
+        return self._device(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self._device, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._device, attr, value)
+
+    def __dir__(self):
+        return dir(self._device)
+
+    def __repr__(self):
+        if self.__device is None:
+            return "<%s (not created)>" % self.__class__.__name__
+        return repr(self.__device)
+
+
+AutomatorDevice.register(LazyAutomatorDevice)  # isinstance(device, AutomatorDevice) without creating it
+device = LazyAutomatorDevice()
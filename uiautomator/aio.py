@@ -0,0 +1,788 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Asyncio client of the uiautomator rpc server, python 3.6+ only.
+
+Usage:
+    from uiautomator.aio import AsyncAutomatorDevice
+
+    async def main():
+        d = AsyncAutomatorDevice("014E05DE0F02000E")
+        await d(text="Clock").click()
+"""
+
+import os
+import re
+import time
+import json
+import socket
+import asyncio
+import tempfile
+import collections
+import io
+
+from . import (Adb, AutomatorServer, JsonRPCMethod, JsonRPCError, Selector, DEVICE_PORT,
+               param_to_property, port_allocator, adb_metadata, urlsplit, hierarchy, Hierarchy, HierarchyObject,
+               dumps, call_selector, wait_selector, wait_condition, stable_poll, stable_digest)
+
+__all__ = ["AsyncAdb", "AsyncHTTPConnectionPool", "AsyncJsonRPCClient",
+           "AsyncAutomatorServer", "AsyncAutomatorDevice", "AsyncDevice"]
+
+
+class AsyncAdb(Adb):
+
+    '''Adb running commands with asyncio subprocesses instead of blocking Popen.'''
+
+    async def cmd(self, *args):
+        '''adb command, add -s serial by default. return the asyncio.subprocess.Process object.'''
+        serial = await self.device_serial()
+        if serial:
+            return await self.raw_cmd(*["-s", serial] + list(args))
+        else:
+            return await self.raw_cmd(*args)
+
+    async def raw_cmd(self, *args):
+        '''adb command. return the asyncio.subprocess.Process object.'''
+        return await asyncio.create_subprocess_exec(
+            self.adb(), *(self.adbHostPortOptions + list(args)),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+    async def run(self, *args):
+        '''run adb command with serial and return its stdout as text.'''
+        out, _ = await (await self.cmd(*args)).communicate()
+        return out.decode("utf-8")
+
+    async def device_serial(self):
+        if not self.default_serial:
+            devices = await self.devices()
+            if devices:
+                if len(devices) == 1:
+                    self.default_serial = list(devices.keys())[0]
+                else:
+                    raise EnvironmentError("Multiple devices attached but default android serial not set.")
+            else:
+                raise EnvironmentError("Device not attached.")
+        return self.default_serial
+
+    async def devices(self):
+        '''get a dict of attached devices. key is the device serial, value is device name.'''
+        out, _ = await (await self.raw_cmd("devices")).communicate()
+        out = out.decode("utf-8")
+        match = "List of devices attached"
+        index = out.find(match)
+        if index < 0:
+            raise EnvironmentError("adb is not working.")
+        return dict([s.split("\t") for s in out[index + len(match):].strip().splitlines() if s.strip()])
+
+    async def forward(self, local_port, device_port):
+        '''adb port forward. return 0 if success, else non-zero.'''
+        try:
+            return await (await self.cmd("forward", "tcp:%d" % local_port, "tcp:%d" % device_port)).wait()
+        finally:
+            adb_metadata.invalidate("forward_list", self.adb_server_host, self.adb_server_port)
+
+    async def forward_list(self):
+        '''adb forward --list'''
+        version = await self.version()
+        if int(version[1]) <= 1 and int(version[2]) <= 0 and int(version[3]) < 31:
+            raise EnvironmentError("Low adb version.")
+        key = ("forward_list", self.adb_server_host, self.adb_server_port)
+        try:
+            forwards = adb_metadata.get(key)
+        except KeyError:
+            out, _ = await (await self.raw_cmd("forward", "--list")).communicate()
+            forwards = adb_metadata.set(key, [line.strip().split() for line in out.decode("utf-8").strip().splitlines()])
+        return [list(forward) for forward in forwards]
+
+    async def exec_out(self, out, *args):
+        '''
+        adb exec-out, copy the output of the device command args to the writable file object out
+        chunk by chunk. return the number of bytes, raise EnvironmentError if the command failed.
+        '''
+        p = await self.cmd("exec-out", *args)
+        size = 0
+        while True:
+            chunk = await p.stdout.read(hierarchy.CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+            size += len(chunk)
+        err = await p.stderr.read()
+        if await p.wait() != 0:
+            raise EnvironmentError("adb exec-out %s failed: %s" % (" ".join(args), err.decode("utf-8", "replace").strip()))
+        return size
+
+    async def getprop(self, name=None):
+        '''
+        device property by name, or dict of all properties if name is None.
+        ro.* properties are read once and cached, others are read from device every time.
+        '''
+        if name is not None and not name.startswith("ro."):
+            return (await self.run("shell", "getprop", name)).strip()
+        if name is not None:
+            key = ("props", self.adb_server_host, self.adb_server_port, await self.device_serial())
+            try:
+                return adb_metadata.get(key).get(name, "")
+            except KeyError:
+                pass
+        out = await self.run("shell", "getprop")
+        props = dict(re.findall(r"^\[([^\]]+)\]: \[(.*)\]\s*$", out, re.M))
+        if not props:
+            raise EnvironmentError("getprop failed: %s" % out.strip())
+        if name is None:
+            return props
+        return adb_metadata.set(key, dict((k, v) for k, v in props.items() if k.startswith("ro."))).get(name, "")
+
+    async def version(self):
+        '''adb version'''
+        key = ("version", self.adb_server_host, self.adb_server_port)
+        try:
+            return list(adb_metadata.get(key))
+        except KeyError:
+            out, _ = await (await self.raw_cmd("version")).communicate()
+            match = re.search(r"(\d+)\.(\d+)\.(\d+)", out.decode("utf-8"))
+            return list(adb_metadata.set(key, [match.group(i) for i in range(4)]))
+
+
+class _StaleConnection(EOFError):
+
+    '''kept-alive connection closed by the server before it read the request.'''
+
+
+class AsyncHTTPConnectionPool(object):
+
+    '''keep-alive http/1.1 connections to one host:port over asyncio streams.
+    It has the same eviction and stale connection retry policy as HTTPConnectionPool.
+    '''
+
+    def __init__(self, host, port, maxsize=4, idle_timeout=30):
+        self.host, self.port = host, port
+        self.maxsize, self.idle_timeout = maxsize, idle_timeout
+        self.__idle = collections.deque()
+
+    async def __get(self):
+        now = time.monotonic()
+        while self.__idle:
+            reader, writer, last_used = self.__idle.pop()
+            if now - last_used < self.idle_timeout and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return reader, writer, False
+
+    def release(self, reader, writer):
+        '''put the connection back to the pool.'''
+        if len(self.__idle) < self.maxsize:
+            self.__idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    def clear(self):
+        '''close all idle connections.'''
+        while self.__idle:
+            self.__idle.pop()[1].close()
+
+    async def urlopen(self, method, url, body=None, headers=None, timeout=30):
+        '''send the request, return the status code and the response body.'''
+        parts = urlsplit(url)
+        path = "%s?%s" % (parts.path or "/", parts.query) if parts.query else (parts.path or "/")
+        lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s:%s" % (self.host, self.port)]
+        for k, v in (headers or {}).items():
+            lines.append("%s: %s" % (k, v))
+        lines.append("Content-Length: %d" % len(body or b""))
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b"")
+        while True:
+            reader, writer, reused = await asyncio.wait_for(self.__get(), timeout)
+            try:
+                return await asyncio.wait_for(self.__exchange(reader, writer, request), timeout)
+            except _StaleConnection:
+                writer.close()
+                if not reused:
+                    raise
+            except BaseException:  # timeouts and cancellation too, the connection state is unknown
+                writer.close()
+                raise
+
+    async def __exchange(self, reader, writer, request):
+        # only a connection closed before the server read the request is stale, and retried by urlopen
+        try:
+            writer.write(request)
+            await writer.drain()
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError) as e:
+            raise _StaleConnection("Connection closed by server: %s" % e)
+        status_line = await reader.readline()
+        if not status_line:
+            raise _StaleConnection("Connection closed by server.")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = line.decode("latin-1").partition(":")
+            headers[k.strip().lower()] = v.strip()
+        keep_alive = headers.get("connection", "").lower() != "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            data = b"".join(chunks)
+        elif "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+        else:
+            data, keep_alive = await reader.read(), False
+        if keep_alive:
+            self.release(reader, writer)
+        else:
+            writer.close()
+        return status, data
+
+
+class AsyncJsonRPCClient(object):
+
+    '''json-rpc client whose methods are coroutines.'''
+
+    def __init__(self, url, timeout=30, pool=None, restart=None):
+        self.url, self.timeout, self.pool, self.restart = url, timeout, pool, restart
+
+    def __getattr__(self, method):
+        client = self
+
+        async def call(*args, **kwargs):
+            try:
+                return await client.call(method, *args, **kwargs)
+            except (OSError, EOFError, ValueError, asyncio.TimeoutError):
+                if client.restart is None:
+                    raise
+                await client.restart()
+            except JsonRPCError as e:
+                if client.restart is None or e.code < -32001:
+                    raise
+                await client.restart()
+            return await client.call(method, *args, **kwargs)
+        return call
+
+    async def call(self, method, *args, **kwargs):
+        data = JsonRPCMethod(self.url, method).request(*args, **kwargs)
+        status, body = await self.pool.urlopen("POST", self.url,
+                                               body=dumps(data).encode("utf-8"),
+                                               headers={"Content-Type": "application/json"},
+                                               timeout=self.timeout)
+        jsonresult = json.loads(body.decode("utf-8"))
+        if "error" in jsonresult and jsonresult["error"]:
+            raise JsonRPCMethod.error(jsonresult["error"])
+        return jsonresult["result"]
+
+
+class AsyncAutomatorServer(object):
+
+    """start and quit rpc server on device with asyncio.
+    """
+
+    def __init__(self, serial=None, local_port=None, device_port=None, adb_server_host=None, adb_server_port=None):
+        self.uiautomator_process = None
+        self.adb = AsyncAdb(serial=serial, adb_server_host=adb_server_host, adb_server_port=adb_server_port)
+        self.device_port = int(device_port) if device_port else DEVICE_PORT
+        self.local_port = local_port
+        self.__serial = serial
+        self.__reserved = False  # True while local port is reserved in port_allocator, None once released
+        self.__sdk = 0
+        self.__http = None
+
+    async def setup(self):
+        '''resolve the local port, reusing the port already adb forwarded.'''
+        if self.local_port is None:
+            try:
+                self.__serial = await self.adb.device_serial()
+                forwards = dict(((s, rp), lp) for s, lp, rp in await self.adb.forward_list())
+                lp = forwards.get((self.__serial, 'tcp:%d' % self.device_port))
+                self.local_port = port_allocator.reserve(self.__serial, self.adb.adb_server_host,
+                                                         int(lp[4:]) if lp else None)
+            except Exception:
+                self.local_port = port_allocator.reserve(self.__serial, self.adb.adb_server_host)
+            self.__reserved = True
+        elif self.__reserved is None:  # released by stop()
+            port_allocator.reserve(self.__serial, self.adb.adb_server_host, self.local_port)
+            self.__reserved = True
+        return self
+
+    @property
+    def http(self):
+        '''keep-alive connection pool to the rpc server.'''
+        host, port = self.adb.adb_server_host, self.local_port
+        if self.__http is None or (self.__http.host, self.__http.port) != (host, port):
+            self.__http = AsyncHTTPConnectionPool(host, port)
+        return self.__http
+
+    @property
+    def jsonrpc(self):
+        return self.jsonrpc_wrap(timeout=int(os.environ.get("jsonrpc_timeout", 90)))
+
+    def jsonrpc_wrap(self, timeout):
+        async def restart():
+            await self.stop()
+            await self.start(timeout=30)
+        return AsyncJsonRPCClient(self.rpc_uri, timeout=timeout, pool=self.http, restart=restart)
+
+    async def sdk_version(self):
+        '''sdk version of connected device.'''
+        if self.__sdk == 0:
+            try:
+                key = ("sdk", self.adb.adb_server_host, self.adb.adb_server_port, await self.adb.device_serial())
+                try:
+                    self.__sdk = adb_metadata.get(key)
+                except KeyError:
+                    sdk = int((await self.adb.run("shell", "getprop", "ro.build.version.sdk")).strip())
+                    self.__sdk = adb_metadata.set(key, sdk)
+            except Exception:
+                pass
+        return self.__sdk
+
+    async def start(self, timeout=5):
+        await self.setup()
+        deploy, cmd = AutomatorServer.deployment(await self.sdk_version())
+        deployed = await self.__deploy(deploy)
+        self.uiautomator_process = await self.adb.cmd(*cmd)
+        await self.adb.forward(self.local_port, self.device_port)
+
+        if not await self.wait_ready(timeout):
+            if self.uiautomator_process.returncode is None:
+                self.uiautomator_process.kill()
+            self.uiautomator_process = None
+            if not deployed:
+                # deployed files are gone from device though checksums are there, deploy again.
+                await self.save_checksums(None)
+                return await self.start(timeout=timeout)
+            raise IOError("RPC server not started!")
+
+    async def __deploy(self, commands):
+        '''run the adb commands deploying files in parallel, unless the same files are on device.'''
+        checksums = AutomatorServer.file_checksums(commands)
+        deployed = await self.deployed_checksums()
+        if all(deployed.get(name) == checksum for name, checksum in checksums.items()):
+            return False
+        processes = [await self.adb.cmd(*args) for args in commands]
+        await asyncio.gather(*[p.communicate() for p in processes])  # drain the pipes, wait() may block on a full one
+        if all(p.returncode == 0 for p in processes):
+            deployed.update(checksums)
+            await self.save_checksums(deployed)
+        return True
+
+    async def deployed_checksums(self):
+        '''dict of file name to md5 of the files deployed on device.'''
+        try:
+            return AutomatorServer.parse_checksums(await self.adb.run("shell", "cat", AutomatorServer.checksum_file))
+        except Exception:
+            return {}
+
+    async def save_checksums(self, checksums):
+        '''save checksums of the deployed files on device, None to clear them.'''
+        if not checksums:
+            await (await self.adb.cmd("shell", "rm", "-f", AutomatorServer.checksum_file)).wait()
+            return
+        fd, filename = tempfile.mkstemp()
+        try:
+            os.write(fd, AutomatorServer.format_checksums(checksums))
+            os.close(fd)
+            await (await self.adb.cmd("push", filename, AutomatorServer.checksum_file)).wait()
+        finally:
+            os.remove(filename)
+
+    async def wait_ready(self, timeout=5):
+        '''wait until the rpc server answers ping, with exponential backoff, False if it failed.'''
+        loop = asyncio.get_event_loop()
+        deadline, delay = loop.time() + timeout, 0.01
+        while True:
+            if await self.alive():
+                return True
+            if self.uiautomator_process is not None and self.uiautomator_process.returncode is not None:
+                return False
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.5)
+
+    async def ping(self):
+        try:
+            return await AsyncJsonRPCClient(self.rpc_uri, timeout=5, pool=self.http).ping()
+        except Exception:
+            return None
+
+    async def alive(self):
+        '''Check if the rpc server is alive.'''
+        return await self.ping() == "pong"
+
+    async def stop(self):
+        '''Stop the rpc server.'''
+        if self.uiautomator_process and self.uiautomator_process.returncode is None:
+            try:
+                await self.http.urlopen("GET", self.stop_uri, timeout=5)
+                await asyncio.wait_for(self.uiautomator_process.wait(), 5)
+            except Exception:
+                self.uiautomator_process.kill()
+            finally:
+                self.uiautomator_process = None
+        self.http.clear()
+        if self.__reserved:
+            port_allocator.release(self.local_port, self.adb.adb_server_host)
+            self.__reserved = None
+        try:
+            out = (await self.adb.run("shell", "ps", "-C", "uiautomator")).strip().splitlines()
+            if out:
+                index = out[0].split().index("PID")
+                for line in out[1:]:
+                    if len(line.split()) > index:
+                        await (await self.adb.cmd("shell", "kill", "-9", line.split()[index])).wait()
+        except Exception:
+            pass
+
+    @property
+    def stop_uri(self):
+        return "http://%s:%d/stop" % (self.adb.adb_server_host, self.local_port)
+
+    @property
+    def rpc_uri(self):
+        return "http://%s:%d/jsonrpc/0" % (self.adb.adb_server_host, self.local_port)
+
+    @property
+    def screenshot_uri(self):
+        return "http://%s:%d/screenshot/0" % (self.adb.adb_server_host, self.local_port)
+
+    async def screenshot(self, filename=None, scale=1.0, quality=100):
+        if await self.sdk_version() >= 18:
+            try:
+                status, data = await self.http.urlopen(
+                    "GET", "%s?scale=%f&quality=%f" % (self.screenshot_uri, scale, quality), timeout=30)
+                if filename:
+                    with open(filename, 'wb') as f:
+                        f.write(data)
+                        return filename
+                else:
+                    return data
+            except Exception:
+                pass
+        return None
+
+
+def _http_timeout(timeout):
+    return max(timeout / 1000 + 5, int(os.environ.get("JSONRPC_TIMEOUT", 90)))
+
+
+class AsyncAutomatorDevice(object):
+
+    '''asyncio uiautomator wrapper of android device, all actions are coroutines.
+    Usage:
+    d = AsyncAutomatorDevice(serial)
+    await d(text="Clock").click()
+    info = await d.info
+    '''
+
+    __orientation = (  # device orientation
+        (0, "natural", "n", 0),
+        (1, "left", "l", 90),
+        (2, "upsidedown", "u", 180),
+        (3, "right", "r", 270)
+    )
+
+    def __init__(self, serial=None, local_port=None, adb_server_host=None, adb_server_port=None):
+        self.server = AsyncAutomatorServer(
+            serial=serial,
+            local_port=local_port,
+            adb_server_host=adb_server_host,
+            adb_server_port=adb_server_port
+        )
+
+    def __call__(self, selector=None, **kwargs):
+        return AsyncAutomatorDeviceObject(self, call_selector(selector, kwargs))
+
+    @property
+    def info(self):
+        '''Get the device info.'''
+        return self.server.jsonrpc.deviceInfo()
+
+    def click(self, x, y):
+        '''click at arbitrary coordinates.'''
+        return self.server.jsonrpc.click(x, y)
+
+    def long_click(self, x, y):
+        '''long click at arbitrary coordinates.'''
+        return self.swipe(x, y, x + 1, y + 1)
+
+    def swipe(self, sx, sy, ex, ey, steps=100):
+        return self.server.jsonrpc.swipe(sx, sy, ex, ey, steps)
+
+    def drag(self, sx, sy, ex, ey, steps=100):
+        '''Swipe from one point to another point.'''
+        return self.server.jsonrpc.drag(sx, sy, ex, ey, steps)
+
+    async def dump(self, filename=None, compressed=True, pretty=True):
+        '''dump device window and pull to local file.'''
+        content = await self.server.jsonrpc.dumpWindowHierarchy(compressed, None)
+        if filename:
+            with open(filename, "wb") as f:
+                for i in range(0, len(content), hierarchy.CHUNK_SIZE):
+                    f.write(content[i:i + hierarchy.CHUNK_SIZE].encode("utf-8"))
+        if pretty and "\n " not in content:
+            out = io.StringIO()
+            hierarchy.write_pretty(content, out)
+            content = out.getvalue()
+        return content
+
+    async def snapshot(self, compressed=False):
+        '''dump window hierarchy once, selectors on the returned Hierarchy are evaluated locally.'''
+        return Hierarchy(await self.server.jsonrpc.dumpWindowHierarchy(compressed, None))
+
+    async def screenshot(self, filename, scale=1.0, quality=100):
+        '''take screenshot.'''
+        result = await self.server.screenshot(filename, scale, quality)
+        if result:
+            return result
+
+        device_file = await self.server.jsonrpc.takeScreenshot("screenshot.png", scale, quality)
+        if not device_file:
+            return None
+        p = await self.server.adb.cmd("pull", device_file, filename)
+        await p.wait()
+        await (await self.server.adb.cmd("shell", "rm", device_file)).wait()
+        return filename if p.returncode == 0 else None
+
+    def freeze_rotation(self, freeze=True):
+        '''freeze or unfreeze the device rotation in current status.'''
+        return self.server.jsonrpc.freezeRotation(freeze)
+
+    @property
+    async def orientation(self):
+        '''device orientation: natural, left, upsidedown or right.'''
+        return self.__orientation[(await self.info)["displayRotation"]][1]
+
+    async def set_orientation(self, value):
+        '''orient the device to left/right or natural.'''
+        for values in self.__orientation:
+            if value in values:
+                return await self.server.jsonrpc.setOrientation(values[1])
+        raise ValueError("Invalid orientation.")
+
+    @property
+    def press(self):
+        '''
+        press key via name or key code.
+        Usage:
+        await d.press.back()
+        await d.press(89)
+        '''
+        @param_to_property(
+            key=["home", "back", "left", "right", "up", "down", "center",
+                 "menu", "search", "enter", "delete", "del", "recent",
+                 "volume_up", "volume_down", "volume_mute", "camera", "power"]
+        )
+        def _press(key, meta=None):
+            if isinstance(key, int):
+                return self.server.jsonrpc.pressKeyCode(key, meta) if meta else self.server.jsonrpc.pressKeyCode(key)
+            else:
+                return self.server.jsonrpc.pressKey(str(key))
+        return _press
+
+    def wakeup(self):
+        '''turn on screen in case of screen off.'''
+        return self.server.jsonrpc.wakeUp()
+
+    def sleep(self):
+        '''turn off screen in case of screen on.'''
+        return self.server.jsonrpc.sleep()
+
+    @property
+    def wait(self):
+        '''
+        Waits for the current application to idle or window update event occurs.
+        Usage:
+        await d.wait.idle(timeout=1000)
+        await d.wait.update(timeout=1000, package_name="com.android.settings")
+        await d.wait.any(d(text="OK"), {"text": "Cancel"}, timeout=10000)  # also all and gone_all
+        settle_ms = await d.wait.stable(window_ms=500, timeout=10000)
+        '''
+        @param_to_property(action=["idle", "update", "any", "all", "gone_all", "stable"])
+        def _wait(*args, **kwargs):
+            if "action" in kwargs:
+                action = kwargs.pop("action")
+            else:
+                action, args = args[0], args[1:]
+            if action in ("any", "all", "gone_all"):
+                return self.__wait_selectors(action, args, **kwargs)
+            elif action == "stable":
+                return self.__wait_stable(*args, **kwargs)
+            return _wait_rpc(action, *args, **kwargs)
+
+        def _wait_rpc(action, timeout=1000, package_name=None):
+            jsonrpc = self.server.jsonrpc_wrap(timeout=_http_timeout(timeout))
+            if action == "idle":
+                return jsonrpc.waitForIdle(timeout)
+            elif action == "update":
+                return jsonrpc.waitForWindowUpdate(package_name, timeout)
+        return _wait
+
+    async def __wait_selectors(self, action, selectors, timeout=3000):
+        '''poll hierarchy snapshots until the condition holds, with backoff, within timeout ms.'''
+        selectors = [(arg, wait_selector(arg)) for arg in selectors]
+        loop = asyncio.get_event_loop()
+        deadline, delay = loop.time() + timeout / 1000.0, 0.05
+        while True:
+            done, result = wait_condition(action, await self.snapshot(), selectors)
+            remaining = deadline - loop.time()
+            if done or remaining <= 0:
+                return result
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1.0)
+
+    async def __wait_stable(self, window_ms=500, timeout=10000, screenshot=False):
+        '''ms the screen took to settle for window_ms, or None at timeout, see uiautomator.stable_poll.'''
+        poll = stable_poll(window_ms, timeout)
+        delay = next(poll)
+        while isinstance(delay, float):
+            await asyncio.sleep(delay)
+            image = await self.server.screenshot(None, 0.1, 10) if screenshot else None
+            delay = poll.send(stable_digest(await self.snapshot(), image))
+        return delay
+
+    def exists(self, **kwargs):
+        '''Check if the specified ui object by kwargs exists.'''
+        return self(**kwargs).exists
+
+AsyncDevice = AsyncAutomatorDevice
+
+
+class AsyncAutomatorDeviceObject(object):
+
+    '''asyncio counterpart of AutomatorDeviceObject, all actions are coroutines.'''
+
+    def __init__(self, device, selector):
+        self.device = device
+        self.jsonrpc = device.server.jsonrpc
+        self.selector = selector
+
+    @property
+    def exists(self):
+        '''check if the object exists in current window.'''
+        return self.jsonrpc.exist(self.selector)
+
+    @property
+    def info(self):
+        '''ui object info.'''
+        return self.jsonrpc.objInfo(self.selector)
+
+    @property
+    def count(self):
+        return self.jsonrpc.count(self.selector)
+
+    async def infos(self):
+        '''info of all matched objects, read from one hierarchy dump.'''
+        return [node.info for node in HierarchyObject(await self.device.snapshot(), self.selector).nodes]
+
+    def child(self, **kwargs):
+        '''set childSelector.'''
+        return AsyncAutomatorDeviceObject(self.device, self.selector.clone().child(**kwargs))
+
+    def sibling(self, **kwargs):
+        '''set fromParent selector.'''
+        return AsyncAutomatorDeviceObject(self.device, self.selector.clone().sibling(**kwargs))
+
+    child_selector, from_parent = child, sibling
+
+    def instance(self, index):
+        '''the index-th object matching the selector.'''
+        selector = self.selector.clone()
+        selector["instance"] = index
+        return AsyncAutomatorDeviceObject(self.device, selector)
+
+    def set_text(self, text):
+        '''set the text field.'''
+        if text in [None, ""]:
+            return self.jsonrpc.clearTextField(self.selector)
+        else:
+            return self.jsonrpc.setText(self.selector, text)
+
+    def clear_text(self):
+        '''clear text. alias for set_text(None).'''
+        return self.set_text(None)
+
+    @property
+    def click(self):
+        '''
+        click on the ui object.
+        Usage:
+        await d(text="Clock").click()
+        await d(text="OK").click.wait(timeout=3000)
+        await d(text="John").click.topleft()
+        '''
+        @param_to_property(action=["tl", "topleft", "br", "bottomright", "wait"])
+        def _click(action=None, timeout=3000):
+            if action is None:
+                return self.jsonrpc.click(self.selector)
+            elif action in ["tl", "topleft", "br", "bottomright"]:
+                return self.jsonrpc.click(self.selector, action)
+            else:
+                return self.jsonrpc.clickAndWaitForNewWindow(self.selector, timeout)
+        return _click
+
+    @property
+    def long_click(self):
+        '''
+        Perform a long click action on the object.
+        Usage:
+        await d(text="Image").long_click()
+        await d(text="Image").long_click.topleft()
+        '''
+        @param_to_property(corner=["tl", "topleft", "br", "bottomright"])
+        def _long_click(corner=None):
+            if corner:
+                return self.jsonrpc.longClick(self.selector, corner)
+            else:
+                return self.jsonrpc.longClick(self.selector)
+        return _long_click
+
+    def drag_to(self, *args, **kwargs):
+        '''drag the ui object to point (x, y) or to another ui object.'''
+        if len(args) >= 2 or "x" in kwargs or "y" in kwargs:
+            drag_to = lambda x, y, steps=100: self.jsonrpc.dragTo(self.selector, x, y, steps)
+        else:
+            drag_to = lambda steps=100, **kwargs: self.jsonrpc.dragTo(self.selector, Selector(**kwargs), steps)
+        return drag_to(*args, **kwargs)
+
+    @property
+    def swipe(self):
+        '''
+        Perform swipe action.
+        Usages:
+        await d().swipe.right()
+        await d().swipe("right", steps=20, percent=0.5)
+        '''
+        @param_to_property(direction=["up", "down", "right", "left"])
+        def _swipe(direction="left", steps=10, percent=1):
+            if percent == 1:
+                return self.jsonrpc.swipe(self.selector, direction, steps)
+            else:
+                return self.jsonrpc.swipe(self.selector, direction, percent, steps)
+        return _swipe
+
+    @property
+    def wait(self):
+        '''
+        Wait until the ui object gone or exist.
+        Usage:
+        await d(text="Clock").wait.gone()
+        await d(text="Settings").wait.exists()
+        '''
+        @param_to_property(action=["exists", "gone"])
+        def _wait(action, timeout=3000):
+            jsonrpc = self.device.server.jsonrpc_wrap(timeout=_http_timeout(timeout))
+            method = jsonrpc.waitUntilGone if action == "gone" else jsonrpc.waitForExists
+            return method(self.selector, timeout)
+        return _wait
@@ -0,0 +1,607 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Window hierarchy snapshot, Selector evaluated locally against one dumpWindowHierarchy."""
+
+import re
+import sys
+import bisect
+import hashlib
+import itertools
+from xml.parsers import expat
+
+__all__ = ["Node", "Hierarchy", "HierarchyObject", "PrefixTrie", "SpatialIndex", "iter_events", "iter_nodes", "write_pretty"]
+
+try:
+    _unicode = unicode
+    _intern = lambda s: intern(s) if isinstance(s, str) else s  # py2 interns byte strings only
+except NameError:
+    _unicode = str
+    _intern = sys.intern
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _chunks(source, chunk_size):
+    '''utf-8 encoded chunks of xml text, bytes or a file object.'''
+    if hasattr(source, "read"):
+        for chunk in iter(lambda: source.read(chunk_size), source.read(0)):
+            yield chunk if isinstance(chunk, bytes) else chunk.encode("utf-8")
+    else:
+        for i in range(0, len(source), chunk_size):
+            chunk = source[i:i + chunk_size]
+            yield chunk if isinstance(chunk, bytes) else chunk.encode("utf-8")
+
+
+def iter_events(source, chunk_size=CHUNK_SIZE):
+    '''
+    parse xml incrementally with expat, yield ("start", tag, [(name, value)...]), ("end", tag, None)
+    and ("text", data, None) while reading the source, without building any tree.
+    '''
+    events = []
+    parser = expat.ParserCreate()
+    parser.ordered_attributes = True
+    parser.StartElementHandler = lambda tag, attrs: events.append(
+        ("start", tag, list(zip(attrs[0::2], attrs[1::2]))))
+    parser.EndElementHandler = lambda tag: events.append(("end", tag, None))
+    parser.CharacterDataHandler = lambda data: events.append(("text", data, None))
+    for chunk in _chunks(source, chunk_size):
+        parser.Parse(chunk, False)
+        for event in events:
+            yield event
+        del events[:]
+    parser.Parse(b"", True)
+    for event in events:
+        yield event
+
+
+def iter_nodes(source, chunk_size=CHUNK_SIZE):
+    '''yield (depth, attributes dict) of every node of a hierarchy dump in document order.'''
+    depth = 0
+    for event, tag, attrs in iter_events(source, chunk_size):
+        if tag == "node":
+            if event == "start":
+                yield depth, dict(attrs)
+                depth += 1
+            else:
+                depth -= 1
+
+
+def _escape(value):
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;") \
+        .replace("\n", "&#10;").replace("\r", "&#13;").replace("\t", "&#9;")
+
+
+def write_pretty(source, out, indent="  ", chunk_size=CHUNK_SIZE):
+    '''write the xml source indented to text file object out, element by element.'''
+    def write(text):
+        out.write(_unicode(text))
+    write('<?xml version="1.0" ?>\n')
+    depth, pending = 0, False  # pending: start tag written without ">" yet
+    for event, tag, attrs in iter_events(source, chunk_size):
+        if event == "start":
+            if pending:
+                write(">\n")
+            write("%s<%s%s" % (indent * depth, tag, "".join(' %s="%s"' % (k, _escape(v)) for k, v in attrs)))
+            depth, pending = depth + 1, True
+        elif event == "end":
+            depth -= 1
+            if pending:
+                write("/>\n")
+            else:
+                write("%s</%s>\n" % (indent * depth, tag))
+            pending = False
+        elif tag.strip():  # text data, there is none but whitespace in dumps usually
+            if pending:
+                write(">\n")
+                pending = False
+            write("%s%s\n" % (indent * depth, _escape(tag.strip())))
+
+
+class Node(object):
+
+    '''
+    one node of dumped window hierarchy.
+    Nodes are slotted and share interned class, package and resource-id strings,
+    the boolean attributes are bits of one int, so big hierarchies stay small in memory.
+    '''
+
+    __slots__ = ("parent", "children", "order", "end", "index", "text", "resource_id",
+                 "class_name", "package", "description", "flags", "bounds")
+
+    flag_attrs = [  # (dump attribute, Node property), bit i of flags is flag_attrs[i]
+        ("checkable", "checkable"), ("checked", "checked"), ("clickable", "clickable"),
+        ("enabled", "enabled"), ("focusable", "focusable"), ("focused", "focused"),
+        ("scrollable", "scrollable"), ("long-clickable", "long_clickable"),
+        ("password", "password"), ("selected", "selected")
+    ]
+    __bounds = re.compile(r"\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]")
+
+    def __init__(self, attrib, parent=None, order=0):
+        self.parent = parent
+        self.children = []
+        self.order = order  # position in document order
+        self.end = order + 1  # order after the last descendant
+        self.index = int(attrib.get("index") or 0)
+        self.text = attrib.get("text", "")
+        self.resource_id = _intern(attrib.get("resource-id", ""))
+        self.class_name = _intern(attrib.get("class", ""))
+        self.package = _intern(attrib.get("package", ""))
+        self.description = attrib.get("content-desc", "")
+        flags = 0
+        for bit, (name, _) in enumerate(self.flag_attrs):
+            if attrib.get(name) == "true":
+                flags |= 1 << bit
+        self.flags = flags
+        match = self.__bounds.match(attrib.get("bounds", ""))
+        self.bounds = tuple(int(v) for v in match.groups()) if match else (0, 0, 0, 0)  # left, top, right, bottom
+
+    @property
+    def info(self):
+        '''same fields as objInfo of the rpc server.'''
+        left, top, right, bottom = self.bounds
+        bounds = {"left": left, "top": top, "right": right, "bottom": bottom}
+        return {
+            "text": self.text,
+            "className": self.class_name,
+            "packageName": self.package,
+            "contentDescription": self.description,
+            "resourceName": self.resource_id or None,
+            "checkable": self.checkable,
+            "checked": self.checked,
+            "clickable": self.clickable,
+            "enabled": self.enabled,
+            "focusable": self.focusable,
+            "focused": self.focused,
+            "scrollable": self.scrollable,
+            "longClickable": self.long_clickable,
+            "selected": self.selected,
+            "childCount": len(self.children),
+            "bounds": bounds,
+            "visibleBounds": dict(bounds)
+        }
+
+    def __repr__(self):
+        return "<Node %s text=%r resource-id=%r>" % (self.class_name, self.text, self.resource_id)
+
+
+for _bit, (_, _attr) in enumerate(Node.flag_attrs):
+    setattr(Node, _attr, property(lambda self, mask=1 << _bit: self.flags & mask != 0))
+del _bit, _attr
+
+
+_patterns = {}
+
+
+def _fullmatch(pattern, value):
+    '''java String.matches, the whole value must match.'''
+    if pattern not in _patterns:
+        _patterns[pattern] = re.compile("(?:%s)\\Z" % pattern)
+    return _patterns[pattern].match(value) is not None
+
+
+# Selector field -> test of one node, same semantics as android UiSelector.
+_criteria = {
+    "text": lambda n, v: n.text == v,
+    "textContains": lambda n, v: v.lower() in n.text.lower(),
+    "textMatches": lambda n, v: _fullmatch(v, n.text),
+    "textStartsWith": lambda n, v: n.text.lower().startswith(v.lower()),
+    "className": lambda n, v: n.class_name == v,
+    "classNameMatches": lambda n, v: _fullmatch(v, n.class_name),
+    "description": lambda n, v: n.description == v,
+    "descriptionContains": lambda n, v: v.lower() in n.description.lower(),
+    "descriptionMatches": lambda n, v: _fullmatch(v, n.description),
+    "descriptionStartsWith": lambda n, v: n.description.lower().startswith(v.lower()),
+    "checkable": lambda n, v: n.checkable == v,
+    "checked": lambda n, v: n.checked == v,
+    "clickable": lambda n, v: n.clickable == v,
+    "longClickable": lambda n, v: n.long_clickable == v,
+    "scrollable": lambda n, v: n.scrollable == v,
+    "enabled": lambda n, v: n.enabled == v,
+    "focusable": lambda n, v: n.focusable == v,
+    "focused": lambda n, v: n.focused == v,
+    "selected": lambda n, v: n.selected == v,
+    "packageName": lambda n, v: n.package == v,
+    "packageNameMatches": lambda n, v: _fullmatch(v, n.package),
+    "resourceId": lambda n, v: n.resource_id == v,
+    "resourceIdMatches": lambda n, v: _fullmatch(v, n.resource_id),
+    "index": lambda n, v: n.index == v
+}
+
+
+class PrefixTrie(object):
+
+    '''nodes by lower cased value, to find values starting with a prefix without scanning all nodes.'''
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, value, node):
+        trie = self.root
+        for char in value.lower():
+            trie = trie.setdefault(char, {})
+        trie.setdefault(None, []).append(node)  # key None holds the nodes ending here
+
+    def find(self, prefix):
+        '''nodes whose value starts with prefix, case insensitive, in document order.'''
+        trie = self.root
+        for char in prefix.lower():
+            trie = trie.get(char)
+            if trie is None:
+                return []
+        nodes, stack = [], [trie]
+        while stack:
+            trie = stack.pop()
+            for key, value in trie.items():
+                if key is None:
+                    nodes.extend(value)
+                else:
+                    stack.append(value)
+        nodes.sort(key=lambda node: node.order)
+        return nodes
+
+
+# direction -> bounds (left, top, right, bottom) transformed so the direction is towards increasing x
+_transforms = {
+    "right": lambda l, t, r, b: (l, t, r, b),
+    "left": lambda l, t, r, b: (-r, t, -l, b),
+    "down": lambda l, t, r, b: (t, l, b, r),
+    "up": lambda l, t, r, b: (-b, l, -t, r)
+}
+
+
+def _distance(rect, bounds):
+    '''
+    gap between the right edge of rect and the left edge of bounds if bounds is on its right
+    and both overlap vertically, -1 otherwise (both transformed).
+    '''
+    if max(rect[1], bounds[1]) < min(rect[3], bounds[3]) and bounds[0] >= rect[2]:
+        return bounds[0] - rect[2]
+    return -1
+
+
+class SpatialIndex(object):
+
+    '''
+    uniform grid of node bounds, to find the nearest node on one side of a rect.
+    Every direction is searched as "right" on bounds mirrored/transposed by _transforms.
+    '''
+
+    directions = sorted(_transforms)
+
+    def __init__(self, nodes, direction, cell_size=128):
+        self.transform = _transforms[direction]
+        self.cell_size = cell_size
+        self.cells = {}  # (column, row) -> [(transformed bounds, node)]
+        self.columns = (0, -1)
+        for node in nodes:
+            bounds = self.transform(*node.bounds)
+            left, top, right, bottom = self.__cell_range(bounds)
+            for column in range(left, right + 1):
+                for row in range(top, bottom + 1):
+                    self.cells.setdefault((column, row), []).append((bounds, node))
+        if self.cells:
+            columns = [column for column, _ in self.cells]
+            self.columns = (min(columns), max(columns))
+
+    def __cell_range(self, bounds):
+        '''(first column, first row, last column, last row) covered by bounds.'''
+        left, top, right, bottom = bounds
+        size = self.cell_size
+        return left // size, top // size, max(left, right - 1) // size, max(top, bottom - 1) // size
+
+    def nearest(self, bounds, accept=None):
+        '''
+        nearest node beside bounds, ties broken by document order. Columns are scanned
+        outwards and the scan stops once a column cannot hold anything nearer.
+        '''
+        rect = self.transform(*bounds)
+        if rect[1] >= rect[3]:
+            return None
+        size = self.cell_size
+        _, top, _, bottom = self.__cell_range(rect)
+        best, best_key = None, None
+        for column in range(max(rect[2] // size, self.columns[0]), self.columns[1] + 1):
+            if best is not None and column * size - rect[2] > best_key[0]:
+                break
+            for row in range(top, bottom + 1):
+                for node_bounds, node in self.cells.get((column, row), ()):
+                    if accept is not None and node.order not in accept:
+                        continue
+                    dist = _distance(rect, node_bounds)
+                    if dist >= 0 and (best is None or (dist, node.order) < best_key):
+                        best, best_key = node, (dist, node.order)
+        return best
+
+
+class Hierarchy(object):
+
+    '''
+    parsed window hierarchy, Selector is evaluated on it without rpc calls.
+    Usage:
+    snapshot = d.snapshot()
+    if snapshot(text="Settings").exists:
+        print(snapshot(className="android.widget.TextView").count)
+    '''
+
+    # Selector field -> (mask bit, Node attribute) of the hash indexes
+    __indexed = [
+        ("resourceId", 0x200000, "resource_id"),
+        ("text", 0x01, "text"),
+        ("description", 0x40, "description"),
+        ("className", 0x10, "class_name"),
+        ("packageName", 0x080000, "package")
+    ]
+    # Selector field -> (mask bit, Node attribute) of the prefix tries
+    __prefixed = [
+        ("textStartsWith", 0x08, "text"),
+        ("descriptionStartsWith", 0x0200, "description")
+    ]
+    # nearest() measures up to this many nodes directly instead of using the grid
+    scan_limit = 32
+
+    def __init__(self, content):
+        self.content = content
+        self.rotation = 0
+        self.nodes = []  # all nodes in document order
+        self.roots = []
+        path = []  # open nodes
+        for event, tag, attrs in iter_events(content):
+            if event == "start" and tag == "node":
+                parent = path[-1] if path else None
+                node = Node(dict(attrs), parent, len(self.nodes))
+                self.nodes.append(node)
+                (parent.children if parent is not None else self.roots).append(node)
+                path.append(node)
+            elif event == "end" and tag == "node":
+                path.pop().end = len(self.nodes)
+            elif event == "start" and tag == "hierarchy":
+                self.rotation = int(dict(attrs).get("rotation") or 0)
+        self.__indexes = None
+        self.__tries = None
+        self.__grids = {}
+        self.__digest = None
+
+    def __call__(self, selector=None, **kwargs):
+        from . import call_selector
+        return HierarchyObject(self, call_selector(selector, kwargs))
+
+    def exists(self, **kwargs):
+        return self(**kwargs).exists
+
+    def xpath(self, expression):
+        '''
+        nodes matching an xpath expression in document order, see uiautomator.xpath.
+        Usage:
+        snapshot.xpath("//node[node[@text='Wi-Fi']]//android.widget.Switch")
+        '''
+        from .xpath import compile_xpath
+        return compile_xpath(expression).evaluate(self)
+
+    @property
+    def digest(self):
+        '''
+        md5 hex digest of the parsed nodes, tree shape and attributes included, so dumps of the
+        same screen are equal however they are formatted or their attributes are ordered.
+        '''
+        if self.__digest is None:
+            md5 = hashlib.md5()
+            for node in self.nodes:
+                parent = node.parent.order if node.parent is not None else -1
+                md5.update((u"%d\x1f%d\x1f%s\x1f%s\x1f%s\x1f%s\x1f%s\x1f%d\x1f%d,%d,%d,%d\x1e" % (
+                    (parent, node.index, node.text, node.resource_id, node.class_name, node.package,
+                     node.description, node.flags) + node.bounds)).encode("utf-8"))
+            self.__digest = md5.hexdigest()
+        return self.__digest
+
+    @property
+    def indexes(self):
+        '''{Node attribute: {value: [nodes in document order]}}, built on first use.'''
+        if self.__indexes is None:
+            indexes = dict((attr, {}) for _, _, attr in self.__indexed)
+            for node in self.nodes:
+                for attr, index in indexes.items():
+                    index.setdefault(getattr(node, attr), []).append(node)
+            self.__indexes = indexes
+        return self.__indexes
+
+    @property
+    def tries(self):
+        '''{Node attribute: PrefixTrie}, built on first use.'''
+        if self.__tries is None:
+            tries = dict((attr, PrefixTrie()) for _, _, attr in self.__prefixed)
+            for node in self.nodes:
+                for attr, trie in tries.items():
+                    trie.add(getattr(node, attr), node)
+            self.__tries = tries
+        return self.__tries
+
+    def grid(self, direction):
+        '''SpatialIndex of all nodes for the direction, built on first use.'''
+        if direction not in self.__grids:
+            self.__grids[direction] = SpatialIndex(self.nodes, direction)
+        return self.__grids[direction]
+
+    def nearest(self, bounds, direction, nodes):
+        '''
+        the node of nodes nearest to bounds on the side given by direction ("left", "right",
+        "up" or "down"), with the same overlap rules as AutomatorDeviceObject.left/right/up/down.
+        '''
+        if len(nodes) <= self.scan_limit:  # cheaper to measure each than to walk the grid
+            transform = _transforms[direction]
+            rect, best, best_key = transform(*bounds), None, None
+            for node in nodes:
+                dist = _distance(rect, transform(*node.bounds))
+                if dist >= 0 and (best is None or (dist, node.order) < best_key):
+                    best, best_key = node, (dist, node.order)
+            return best
+        accept = None if len(nodes) == len(self.nodes) else set(node.order for node in nodes)
+        return self.grid(direction).nearest(bounds, accept)
+
+    def candidates(self, selector):
+        '''
+        nodes from the most selective index usable for the selector, in document order,
+        None if no field of the selector is indexed.
+        '''
+        mask, best = selector["mask"], None
+        for field, bit, attr in self.__indexed:
+            if mask & bit:
+                nodes = self.indexes[attr].get(selector[field], [])
+                if best is None or len(nodes) < len(best):
+                    best = nodes
+        if best is None:
+            for field, bit, attr in self.__prefixed:
+                if mask & bit:
+                    nodes = self.tries[attr].find(selector[field])
+                    if best is None or len(nodes) < len(best):
+                        best = nodes
+        return best
+
+    def select(self, selector):
+        '''nodes matching the selector in document order.'''
+        return self.__select([(0, len(self.nodes))], selector, True)
+
+    def __select(self, ranges, selector, top=False):
+        candidates = self.candidates(selector)
+        if candidates is None:
+            scope = itertools.chain.from_iterable(self.nodes[start:end] for start, end in ranges)
+        elif ranges == [(0, len(self.nodes))]:
+            scope = candidates
+        else:
+            starts = [start for start, _ in ranges]
+
+            def in_ranges(node):
+                i = bisect.bisect_right(starts, node.order) - 1
+                return i >= 0 and node.order < ranges[i][1]
+            scope = (node for node in candidates if in_ranges(node))
+        nodes = [node for node in scope if self.match(node, selector)]
+        instance = selector.get("instance") if selector["mask"] & 0x01000000 else None
+        if not top and instance is not None:
+            nodes = nodes[instance:instance + 1]
+        for relation, sub in zip(selector["childOrSibling"], selector["childOrSiblingSelector"]):
+            nodes = self.__select(self.__scope(nodes, relation), sub)
+        if top and instance is not None:  # instance of the outermost selector indexes the final matches.
+            nodes = nodes[instance:instance + 1]
+        return nodes
+
+    def __scope(self, nodes, relation):
+        '''
+        sorted, disjoint (start, end) order ranges of the descendants of nodes ("child"),
+        or of their parents ("sibling").
+        '''
+        ranges = []
+        for node in nodes:
+            if relation == "child":
+                ranges.append((node.order + 1, node.end))
+            elif node.parent is not None:
+                ranges.append((node.parent.order + 1, node.parent.end))
+            else:
+                ranges.append((0, len(self.nodes)))
+        scope, last = [], 0
+        for start, end in sorted(ranges):
+            start = max(start, last)
+            if start < end:
+                scope.append((start, end))
+                last = end
+        return scope
+
+    @staticmethod
+    def match(node, selector):
+        '''check the node against fields of the selector itself, without child/sibling selectors.'''
+        for field, value in selector.items():
+            criterion = _criteria.get(field)
+            if criterion is not None and not criterion(node, value):
+                return False
+        return True
+
+
+class HierarchyObject(object):
+
+    '''ui object in a hierarchy snapshot, answered from memory.'''
+
+    __alias = {'description': "contentDescription"}
+
+    def __init__(self, hierarchy, selector):
+        self.hierarchy = hierarchy
+        self.selector = selector
+
+    @property
+    def nodes(self):
+        return self.hierarchy.select(self.selector)
+
+    @property
+    def exists(self):
+        return len(self.nodes) > 0
+
+    @property
+    def info(self):
+        nodes = self.nodes
+        if not nodes:
+            from . import JsonRPCError
+            raise JsonRPCError(-32002, "UiObjectNotFoundException")
+        return nodes[0].info
+
+    def __getattr__(self, attr):
+        '''alias of fields in info property.'''
+        info = self.info
+        if attr in info:
+            return info[attr]
+        elif attr in self.__alias:
+            return info[self.__alias[attr]]
+        else:
+            raise AttributeError("%s attribute not found!" % attr)
+
+    def child(self, **kwargs):
+        return HierarchyObject(self.hierarchy, self.selector.clone().child(**kwargs))
+
+    def sibling(self, **kwargs):
+        return HierarchyObject(self.hierarchy, self.selector.clone().sibling(**kwargs))
+
+    child_selector, from_parent = child, sibling
+
+    @property
+    def count(self):
+        selector = self.selector.clone()
+        if "instance" in selector:
+            del selector["instance"]
+        return len(self.hierarchy.select(selector))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index >= self.count:
+            raise IndexError()
+        selector = self.selector.clone()
+        selector["instance"] = index
+        return HierarchyObject(self.hierarchy, selector)
+
+    def __iter__(self):
+        return (self[i] for i in range(self.count))
+
+    def right(self, **kwargs):
+        return self.__beside("right", **kwargs)
+
+    def left(self, **kwargs):
+        return self.__beside("left", **kwargs)
+
+    def up(self, **kwargs):
+        return self.__beside("up", **kwargs)
+
+    def down(self, **kwargs):
+        return self.__beside("down", **kwargs)
+
+    def __beside(self, direction, **kwargs):
+        '''nearest object matching kwargs on the side, None if there is none.'''
+        from . import Selector
+        nodes = self.nodes
+        if not nodes:
+            self.info  # raises UiObjectNotFoundException
+        selector = Selector(**kwargs)
+        candidates = self.hierarchy.select(selector)
+        found = self.hierarchy.nearest(nodes[0].bounds, direction, candidates)
+        if found is None:
+            return None
+        if "instance" not in selector:
+            selector["instance"] = bisect.bisect_left([node.order for node in candidates], found.order)
+        return HierarchyObject(self.hierarchy, selector)
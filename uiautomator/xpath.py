@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""XPath 1.0 subset evaluated on a Hierarchy snapshot.
+
+Usage:
+    snapshot = d.snapshot()
+    # the check box in the row whose title is "Wi-Fi"
+    snapshot.xpath("//node[node[@text='Wi-Fi']]//android.widget.CheckBox")
+
+Supported: absolute and relative paths, "/" and "//", "." and "..", the axes child, descendant,
+descendant-or-self, parent, ancestor, ancestor-or-self, following-sibling, preceding-sibling,
+following, preceding and self, name tests "*", "node", "node()" or a class name, predicates with
+attributes of the dump ("@text", "@resource-id", "@clickable"...), every node has all of them so
+an attribute alone is true if it is not empty, positions ("[2]", "[last()]",
+"position()"), "and", "or", "not()", "contains()", "starts-with()", "ends-with()", "matches()",
+"count()", "string-length()", comparisons, "+", "-", unions with "|" and filters of a parenthesized
+node set ("(//node[@text='OK'])[2]", "(//node[@checkable='true'])[last()]/..").
+The dump's root element is "hierarchy" ("/hierarchy/node", "/hierarchy[@rotation=1]"), it is matched
+like any element but never returned as it is no ui node.
+A node set compares by the string values of its nodes, which are empty as dumps have no text content.
+"""
+
+import re
+import bisect
+import threading
+import collections
+
+from .hierarchy import Node, _fullmatch
+
+__all__ = ["XPath", "compile_xpath"]
+
+_token = re.compile(r"""\s*(?:
+    (?P<string>"[^"]*"|'[^']*')|
+    (?P<number>\d+(?:\.\d*)?|\.\d+)|
+    (?P<op>//|/|::|\.\.|\.|@|\[|\]|\(|\)|,|\||!=|<=|>=|=|<|>|\+|-|\*)|
+    (?P<name>[A-Za-z_][\w.\-]*(?<![.\-]))
+)""", re.X)
+
+# attribute of the dump -> its value on a Node
+_attributes = {
+    "index": lambda n: str(n.index),
+    "text": lambda n: n.text,
+    "resource-id": lambda n: n.resource_id,
+    "class": lambda n: n.class_name,
+    "package": lambda n: n.package,
+    "content-desc": lambda n: n.description,
+    "bounds": lambda n: "[%d,%d][%d,%d]" % n.bounds
+}
+for _name, _attr in Node.flag_attrs:
+    _attributes[_name] = lambda n, attr=_attr: "true" if getattr(n, attr) else "false"
+del _name, _attr
+
+# attribute of the root element -> its value from the Hierarchy
+_root_attributes = {"rotation": lambda h: str(h.rotation)}
+
+# attribute of the dump -> Node attribute of Hierarchy.indexes
+_indexed = {"text": "text", "resource-id": "resource_id", "class": "class_name",
+            "package": "package", "content-desc": "description"}
+
+
+class _Root(object):
+
+    '''the "hierarchy" root element of the dump, the parent of the top nodes.'''
+
+    order = -1  # before all nodes in document order
+    class_name = "hierarchy"
+
+    def __repr__(self):
+        return "<hierarchy>"
+
+
+_root = _Root()
+
+
+def _node(n):
+    '''n if it is a Node, not the document (None) or the root element.'''
+    return n is not None and n is not _root
+
+
+def _siblings(h, node):
+    return node.parent.children if node.parent is not None else h.roots
+
+
+def _ancestors(node):
+    node = node.parent
+    while node is not None:
+        yield node
+        node = node.parent
+    yield _root
+
+
+# axis -> nodes of the axis from a context node in axis order, None is the document.
+_axes = {
+    "child": lambda h, n: [_root] if n is None else h.roots if n is _root else n.children,
+    "descendant": lambda h, n: [_root] + h.nodes if n is None else h.nodes if n is _root else h.nodes[n.order + 1:n.end],
+    "descendant-or-self": lambda h, n: [_root] + h.nodes if n in (None, _root) else h.nodes[n.order:n.end],
+    "parent": lambda h, n: [n.parent if n.parent is not None else _root] if _node(n) else [],
+    "ancestor": lambda h, n: list(_ancestors(n)) if _node(n) else [],
+    "ancestor-or-self": lambda h, n: [n] + list(_ancestors(n)) if _node(n) else [n] if n is _root else [],
+    "following-sibling": lambda h, n: [s for s in _siblings(h, n) if s.order > n.order] if _node(n) else [],
+    "preceding-sibling": lambda h, n: [s for s in reversed(_siblings(h, n)) if s.order < n.order] if _node(n) else [],
+    "following": lambda h, n: h.nodes[n.end:] if _node(n) else [],
+    "preceding": lambda h, n: [p for p in reversed(h.nodes[:n.order]) if p.end <= n.order] if _node(n) else [],
+    "self": lambda h, n: [n] if n is not None else []
+}
+
+
+def _number(value):
+    if isinstance(value, list):
+        value = _string(value)
+    try:
+        return float(value)
+    except ValueError:
+        return float("nan")
+
+
+def _string(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, float):
+        return str(int(value)) if value == int(value) else str(value)
+    elif isinstance(value, list):  # string value of a node is its (empty) text content
+        return ""
+    return value
+
+
+def _compare(op, left, right):
+    if isinstance(left, bool) or isinstance(right, bool):
+        left, right = bool(left), bool(right)
+    elif isinstance(left, list) or isinstance(right, list):
+        # true if the string value of some node in the set satisfies the comparison
+        lefts = [_string([node]) for node in left] if isinstance(left, list) else [left]
+        rights = [_string([node]) for node in right] if isinstance(right, list) else [right]
+        return any(_compare(op, a, b) for a in lefts for b in rights)
+    elif isinstance(left, float) or isinstance(right, float) or op in ("<", "<=", ">", ">="):
+        left, right = _number(left), _number(right)
+    return {
+        "=": lambda a, b: a == b, "!=": lambda a, b: a != b,
+        "<": lambda a, b: a < b, "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b, ">=": lambda a, b: a >= b
+    }[op](left, right)
+
+
+# function -> (number of arguments, implementation on evaluated arguments)
+_functions = {
+    "not": (1, lambda v: not v),
+    "true": (0, lambda: True),
+    "false": (0, lambda: False),
+    "contains": (2, lambda a, b: _string(b) in _string(a)),
+    "starts-with": (2, lambda a, b: _string(a).startswith(_string(b))),
+    "ends-with": (2, lambda a, b: _string(a).endswith(_string(b))),
+    "matches": (2, lambda a, b: _fullmatch(_string(b), _string(a))),
+    "count": (1, lambda v: float(len(v))),
+    "string-length": (1, lambda v: float(len(_string(v)))),
+    "normalize-space": (1, lambda v: " ".join(_string(v).split())),
+    "string": (1, _string),
+    "number": (1, _number),
+    "boolean": (1, bool)
+}
+
+
+class _Step(object):
+
+    '''one location step: axis, name test and predicates, a filter on node sets.'''
+
+    def __init__(self, axis, name, predicates):
+        self.axis = axis
+        self.name = name
+        self.predicates = predicates  # [(expression, positional)]
+        self.positional = any(positional for _, positional in predicates)
+        self.hint = None  # (Node attribute, value) of an indexed "@attr='value'" predicate
+
+    def test(self, node):
+        if node is _root:  # the element named hierarchy, "node" names the elements below it
+            return self.name in ("*", "node()", "hierarchy")
+        return self.name in ("*", "node", "node()") or node.class_name == self.name
+
+    def __call__(self, h, contexts):
+        '''nodes of the step from all context nodes, in document order.'''
+        if self.positional:
+            found = {}
+            for context in contexts:
+                nodes = [n for n in _axes[self.axis](h, context) if self.test(n)]
+                for predicate, _ in self.predicates:
+                    size = len(nodes)
+                    nodes = [n for i, n in enumerate(nodes) if _truth(predicate(h, n, i + 1, size), i + 1)]
+                for node in nodes:
+                    found[node.order] = node
+            return [found[order] for order in sorted(found)]
+        if self.axis in ("descendant", "descendant-or-self"):
+            nodes = self.__descendants(h, contexts)
+        elif len(contexts) == 1:
+            nodes = sorted(_axes[self.axis](h, contexts[0]), key=lambda n: n.order)
+        else:
+            found = {}
+            for context in contexts:
+                for node in _axes[self.axis](h, context):
+                    found[node.order] = node
+            nodes = [found[order] for order in sorted(found)]
+        return [n for n in nodes if self.test(n) and all(p(h, n, 0, 0) for p, _ in self.predicates)]
+
+    def __descendants(self, h, contexts):
+        '''descendants of all contexts, each node once, from the index if the step has a hint.'''
+        offset = 0 if self.axis == "descendant-or-self" else 1
+        ranges, last = [], 0
+        for context in contexts:
+            start, end = (0, len(h.nodes)) if context in (None, _root) else (context.order + offset, context.end)
+            start = max(start, last)
+            if start < end:
+                ranges.append((start, end))
+                last = end
+        if self.hint is None:
+            root = [_root] if contexts[0] is None or (contexts[0] is _root and offset == 0) else []
+            return root + [n for start, end in ranges for n in h.nodes[start:end]]
+        candidates = h.indexes[self.hint[0]].get(self.hint[1], [])
+        if ranges == [(0, len(h.nodes))]:
+            return candidates
+        starts = [start for start, _ in ranges]
+
+        def in_ranges(node):
+            i = bisect.bisect_right(starts, node.order) - 1
+            return i >= 0 and node.order < ranges[i][1]
+        return [n for n in candidates if in_ranges(n)]
+
+
+def _walk(h, nodes, steps):
+    '''nodes of the location steps from the context nodes.'''
+    for step in steps:
+        nodes = step(h, nodes)
+        if not nodes:
+            break
+    return nodes
+
+
+def _truth(value, position):
+    '''value of a predicate, a number selects the node at that position.'''
+    if isinstance(value, float):
+        return value == position
+    return bool(value)
+
+
+class _Parser(object):
+
+    '''recursive descent parser, compiles the expression to closures f(hierarchy, node, position, size).'''
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens, pos = [], 0
+        expression = expression.rstrip()
+        while pos < len(expression):
+            match = _token.match(expression, pos)
+            if match is None or match.end() == pos:
+                self.error("unexpected character at %d" % pos)
+            self.tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            pos = match.end()
+        self.tokens.append((None, None))
+        self.pos = 0
+        self.positional = False  # position() or last() seen in current predicate
+
+    def error(self, message):
+        raise ValueError("Invalid xpath %r: %s" % (self.expression, message))
+
+    def peek(self, offset=0):
+        return self.tokens[self.pos + offset]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def accept(self, value):
+        if self.peek()[1] == value and self.peek()[0] in ("op", "name"):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, value):
+        if not self.accept(value):
+            self.error("expected %r, got %r" % (value, self.peek()[1]))
+
+    def parse(self):
+        expression = self.union()
+        if self.peek()[0] is not None:
+            self.error("unexpected %r" % self.peek()[1])
+        return expression
+
+    def union(self):
+        paths = [self.expr()]
+        while self.accept("|"):
+            paths.append(self.expr())
+        if len(paths) == 1:
+            return paths[0]
+
+        def union(h, n, pos, size):
+            found = {}
+            for path in paths:
+                for node in path(h, n, pos, size):
+                    found[node.order] = node
+            return [found[order] for order in sorted(found)]
+        return union
+
+    def expr(self):
+        return self.binary(self.and_expr, ("or",), None, names=True)
+
+    def and_expr(self):
+        return self.binary(self.comparison, ("and",), None, names=True)
+
+    def comparison(self):
+        return self.binary(self.additive, ("=", "!=", "<=", ">=", "<", ">"), _compare)
+
+    def additive(self):
+        def arithmetic(op, a, b):
+            return _number(a) + _number(b) if op == "+" else _number(a) - _number(b)
+        return self.binary(self.unary, ("+", "-"), arithmetic)
+
+    def binary(self, operand, operators, apply, names=False):
+        '''left associative operators, "and"/"or" are names and short circuit.'''
+        left = operand()
+        while self.peek()[1] in operators and self.peek()[0] == ("name" if names else "op"):
+            op = self.next()[1]
+            left = self.__binary(op, left, operand(), apply)
+        return left
+
+    @staticmethod
+    def __binary(op, left, right, apply):
+        if op == "or":
+            return lambda h, n, pos, size: bool(left(h, n, pos, size)) or bool(right(h, n, pos, size))
+        elif op == "and":
+            return lambda h, n, pos, size: bool(left(h, n, pos, size)) and bool(right(h, n, pos, size))
+        return lambda h, n, pos, size: apply(op, left(h, n, pos, size), right(h, n, pos, size))
+
+    def unary(self):
+        if self.accept("-"):
+            operand = self.unary()
+            return lambda h, n, pos, size: -_number(operand(h, n, pos, size))
+        return self.primary()
+
+    def primary(self):
+        kind, value = self.peek()
+        if kind == "string":
+            self.next()
+            return lambda h, n, pos, size: value[1:-1]
+        elif kind == "number":
+            self.next()
+            number = float(value)
+            return lambda h, n, pos, size: number
+        elif kind == "op" and value == "(":
+            self.next()
+            expression = self.union()
+            self.expect(")")
+            return self.filter(expression)
+        elif kind == "op" and value == "@":
+            self.next()
+            return self.attribute()
+        elif kind == "name" and self.peek(1) == ("op", "(") and value != "node":
+            return self.function()
+        return self.path()
+
+    def attribute(self):
+        name = self.next()[1]
+        if name not in _attributes and name not in _root_attributes:
+            self.error("unknown attribute @%s" % name)
+        get = _attributes.get(name, lambda n: "")
+        get_root = _root_attributes.get(name, lambda h: "")
+        return lambda h, n, pos, size: get(n) if _node(n) else get_root(h) if n is _root else ""
+
+    def function(self):
+        name = self.next()[1]
+        self.expect("(")
+        args = []
+        if not self.accept(")"):
+            args.append(self.expr())
+            while self.accept(","):
+                args.append(self.expr())
+            self.expect(")")
+        if name == "position" and not args:
+            self.positional = True
+            return lambda h, n, pos, size: float(pos)
+        elif name == "last" and not args:
+            self.positional = True
+            return lambda h, n, pos, size: float(size)
+        elif name not in _functions:
+            self.error("unknown function %s()" % name)
+        arity, function = _functions[name]
+        if name in ("string-length", "normalize-space", "string", "number") and not args:
+            args = [lambda h, n, pos, size: ""]  # no text content in dumps
+        if len(args) != arity:
+            self.error("%s() takes %d arguments" % (name, arity))
+        return lambda h, n, pos, size: function(*[arg(h, n, pos, size) for arg in args])
+
+    def filter(self, expression):
+        '''predicates and location steps after a parenthesized expression, "(//node)[2]/node".'''
+        predicates = []
+        while self.accept("["):
+            predicates.append(self.predicate()[0])
+        steps = self.steps([])
+        if not predicates and not steps:
+            return expression
+        error = "Invalid xpath %r: not a node set filtered" % self.expression
+
+        def filter(h, n, pos, size):
+            nodes = expression(h, n, pos, size)
+            if not isinstance(nodes, list):
+                raise ValueError(error)
+            for predicate in predicates:  # positions are in document order over the whole node set
+                size = len(nodes)
+                nodes = [m for i, m in enumerate(nodes) if _truth(predicate(h, m, i + 1, size), i + 1)]
+            return _walk(h, nodes, steps)
+        return filter
+
+    def path(self):
+        '''location path, the context node is None (the document) for absolute paths.'''
+        steps, absolute = [], False
+        if self.accept("//"):
+            absolute = True
+            steps.append(_Step("descendant-or-self", "node()", []))
+        elif self.accept("/"):
+            absolute = True
+            if not self.at_step():  # "/" alone is the document
+                return lambda h, n, pos, size: []
+        steps.append(self.step())
+        steps = self.steps(steps)
+        return lambda h, n, pos, size: _walk(h, [None] if absolute else [n], steps)
+
+    def steps(self, steps):
+        '''steps with the "/step" and "//step" that follow, optimized.'''
+        while True:
+            if self.accept("//"):
+                steps.append(_Step("descendant-or-self", "node()", []))
+            elif not self.accept("/"):
+                break
+            steps.append(self.step())
+        return self.optimize(steps)
+
+    def at_step(self):
+        kind, value = self.peek()
+        return kind == "name" or (kind == "op" and value in ("*", ".", ".."))
+
+    def step(self):
+        if self.accept("."):
+            return _Step("self", "node()", [])
+        elif self.accept(".."):
+            return _Step("parent", "node()", [])
+        axis = "child"
+        if self.peek()[0] == "name" and self.peek(1) == ("op", "::"):
+            axis = self.next()[1]
+            self.next()
+            if axis not in _axes:
+                self.error("unknown axis %s" % axis)
+        kind, name = self.next()
+        if kind != "name" and name != "*":
+            self.error("expected a name test, got %r" % name)
+        if name == "node" and self.accept("("):
+            self.expect(")")
+            name = "node()"
+        step = _Step(axis, name, [])
+        while self.accept("["):
+            expression, positional, tokens = self.predicate()
+            step.predicates.append((expression, positional))
+            if len(tokens) == 4 and tokens[0] == ("op", "@") and tokens[1][1] in _indexed \
+                    and tokens[2] == ("op", "=") and tokens[3][0] == "string":
+                step.hint = _indexed[tokens[1][1]], tokens[3][1][1:-1]  # "@attr='value'"
+        step.positional = any(positional for _, positional in step.predicates)
+        return step
+
+    def predicate(self):
+        '''expression of a predicate after its "[", (expression, positional, tokens).'''
+        start, saved, self.positional = self.pos, self.positional, False
+        expression = self.expr()
+        tokens = self.tokens[start:self.pos]
+        positional = self.positional or [t[0] for t in tokens] == ["number"]
+        self.positional = saved
+        self.expect("]")
+        return expression, positional, tokens
+
+    @staticmethod
+    def optimize(steps):
+        '''"//name[...]" is descendant::name[...] unless it has positional predicates.'''
+        optimized = []
+        for step in steps:
+            previous = optimized[-1] if optimized else None
+            if previous is not None and previous.axis == "descendant-or-self" and previous.name == "node()" \
+                    and not previous.predicates and step.axis == "child" and not step.positional:
+                step.axis = "descendant"
+                optimized[-1] = step
+            else:
+                optimized.append(step)
+        return optimized
+
+
+class XPath(object):
+
+    '''compiled xpath expression, evaluate it on any number of Hierarchy snapshots.'''
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.__plan = _Parser(expression).parse()
+
+    def evaluate(self, hierarchy):
+        '''matched nodes in document order.'''
+        nodes = self.__plan(hierarchy, None, 1, 1)
+        if not isinstance(nodes, list):
+            raise ValueError("Invalid xpath %r: not a location path" % self.expression)
+        return [n for n in nodes if n is not _root]
+
+    def __repr__(self):
+        return "XPath(%r)" % self.expression
+
+
+COMPILED_SIZE = 256  # most recently used expressions kept compiled
+_compiled = collections.OrderedDict()
+_compiled_lock = threading.Lock()
+
+
+def compile_xpath(expression):
+    '''compiled XPath of the expression, the COMPILED_SIZE most recently used ones are cached.'''
+    with _compiled_lock:
+        xpath = _compiled.pop(expression, None)
+        if xpath is None:
+            xpath = XPath(expression)
+            if len(_compiled) >= COMPILED_SIZE:
+                _compiled.popitem(last=False)
+        _compiled[expression] = xpath
+        return xpath